@@ -0,0 +1,319 @@
+from __future__ import annotations
+
+import json
+import os
+import shutil
+from ast import literal_eval
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from source.common.postal_codes import POSTAL_CODE_DTYPE
+
+# Storage of the dataframes passed between the steps of the pipeline.
+# The format is chosen by the extension of the path: '.parquet' files keep the types of the columns
+# (lists, categories and dates), '.csv' files are kept as an export option and for the legacy files.
+# A '.parquet' path may also be a directory of part files written by `FrameWriter` (see `partitioned`),
+# which is read as the concatenation of its parts
+
+LIST_COLUMNS = ["postal_codes", "provinces"]
+# List columns stored as numpy arrays of the given type
+ARRAY_COLUMNS = {"postal_codes": POSTAL_CODE_DTYPE}
+CATEGORICAL_COLUMNS = ["disaster", "province"]
+DATE_COLUMNS = ["date"]
+# Key of the metadata of the pipeline in the schema of the parquet files (see `write_frame`)
+METADATA_KEY = b"pipeline_metadata"
+# Name of the part files of a partitioned parquet directory, in the order of their rows
+PART_NAME_FORMAT = "part-{:05d}.parquet"
+
+
+def is_parquet_path(path: str) -> bool:
+    return str(path).endswith(".parquet")
+
+
+def get_part_paths(path: str) -> list[str]:
+    """Returns the paths of the part files of a partitioned parquet directory, in the order of their rows"""
+    return [os.path.join(path, name) for name in sorted(os.listdir(path))
+            if name.startswith("part-") and name.endswith(".parquet")]
+
+
+def get_frame_signature(path: str) -> list[list]:
+    """Returns the name, size and modification time of each file of a saved dataframe, to detect whether it was
+    modified. Partitioned parquet directories only cost a stat per part"""
+    file_paths = get_part_paths(path) if os.path.isdir(path) else [path]
+    signature = []
+    for file_path in file_paths:
+        file_stat = os.stat(file_path)
+        signature.append([os.path.basename(file_path), file_stat.st_size, file_stat.st_mtime_ns])
+    return signature
+
+
+def remove_frame(path: str) -> None:
+    """Removes a saved dataframe, either a file or a partitioned parquet directory, if it exists"""
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def write_frame(df: pd.DataFrame, path: str, metadata: dict | None = None) -> None:
+    """Saves a dataframe produced by a step of the pipeline. Parquet files don't store the index of the dataframe,
+    csv files store it as their first unnamed column
+
+    :param metadata: Json serializable information stored together with the dataframe (see `read_frame_metadata`).
+        Only parquet files can store it
+    """
+    df = df.copy(deep=False)
+    # A partitioned directory in the same path is replaced
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    if not is_parquet_path(path):
+        if metadata is not None:
+            raise ValueError(f"Cannot store metadata in '{path}', only parquet files can")
+        _prepare_csv_columns(df).to_csv(path)
+        return None
+    for col in CATEGORICAL_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if metadata is not None:
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                               METADATA_KEY: json.dumps(metadata).encode("utf-8")})
+    pq.write_table(table, path)
+    return None
+
+
+def read_frame_metadata(path: str) -> dict | None:
+    """Returns the metadata stored by `write_frame` in a parquet file, or None if it has none"""
+    schema_metadata = pq.read_schema(path).metadata or {}
+    if METADATA_KEY not in schema_metadata:
+        return None
+    return json.loads(schema_metadata[METADATA_KEY])
+
+
+def read_frame(path: str, columns: list[str] | None = None) -> pd.DataFrame:
+    """Loads a dataframe saved with `write_frame` (or by a legacy step as a csv file)
+
+    Parquet files are memory mapped, so the numeric columns are not copied when loaded.
+    In both formats the result has a default index, list columns contain lists (postal codes contain arrays),
+    label columns are categorical and dates are datetime64
+
+    :param columns: Read only this subset of columns (Default: all)
+    """
+    if is_parquet_path(path):
+        table = pa.concat_tables([pq.read_table(file_path, columns=columns, memory_map=True)
+                                  for file_path in _get_parquet_files(path)])
+        return _restore_categories(table.to_pandas(split_blocks=True, self_destruct=True))
+
+    df = pd.read_csv(path, usecols=None if columns is None else lambda col: col in columns)
+    return _restore_csv_types(df)
+
+
+def get_frame_columns(path: str) -> list[str]:
+    """Returns the names of the columns of a dataframe saved with `write_frame`, without reading its rows"""
+    if is_parquet_path(path):
+        return pq.read_schema(_get_parquet_files(path)[0]).names
+    return [col for col in pd.read_csv(path, nrows=0).columns if col != "Unnamed: 0"]
+
+
+def iter_frame_chunks(path: str, chunksize: int, columns: list[str] | None = None):
+    """Generator yielding a dataframe saved with `write_frame` (or `FrameWriter`) in chunks of at most *chunksize*
+    rows, with the same column types as `read_frame`. The index of each chunk continues the previous one"""
+    offset = 0
+    if is_parquet_path(path):
+        for file_path in _get_parquet_files(path):
+            parquet_file = pq.ParquetFile(file_path, memory_map=True)
+            for batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns):
+                chunk = _restore_categories(batch.to_pandas(split_blocks=True, self_destruct=True))
+                chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+                offset += len(chunk)
+                yield chunk
+        return None
+
+    reader = pd.read_csv(path, chunksize=chunksize, usecols=None if columns is None else lambda col: col in columns)
+    for chunk in reader:
+        chunk = _restore_csv_types(chunk)
+        chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+        offset += len(chunk)
+        yield chunk
+    return None
+
+
+class FrameWriter:
+    """Writes a dataframe to disk in several chunks, in the format of `write_frame`, without holding it in memory.
+    To be used as a context manager:
+
+    `with FrameWriter(path) as writer:
+        writer.write(chunk)`
+
+    Parquet outputs can also be partitioned: written as a directory of part files, where each `tell` closes the
+    current part. Resuming a partitioned output only replaces the parts after the position, so appending rows to it
+    never copies the previous ones
+    """
+
+    def __init__(self, path: str, resume_from: tuple[int, int] | None = None, partitioned: bool = False):
+        """
+        :param resume_from: A position returned by `tell` while writing *path*. The rows written after it are
+            discarded and the new rows follow the ones written before it (Default: the file is written from scratch).
+            Csv files are truncated in place. Parquet files cannot be modified, so they can only be resumed when
+            partitioned
+        :param partitioned: Parquet only. Write *path* as a directory of part files (see `get_part_paths`).
+            The new parts are written in a staging directory and moved into *path* when the writer is closed,
+            so *path* is left as it was if writing fails
+        """
+        if partitioned and not is_parquet_path(path):
+            raise ValueError(f"Only parquet outputs can be partitioned, not '{path}'")
+        self.path = path
+        self.partitioned = partitioned
+        self.n_of_rows = 0
+        self.parquet_writer = None
+        # File written by the parquet writer
+        self.parquet_path = path
+        # Schema of the parquet files, shared by all the parts of a partitioned output
+        self.schema = None
+        # Parts of a partitioned output before the current position, and the first part written by self
+        self.n_of_parts = 0
+        self.first_part = 0
+        self.staging_path = path + ".tmp"
+        if resume_from is not None:
+            self._resume(*resume_from)
+        elif not partitioned and os.path.isdir(path):
+            shutil.rmtree(path)
+        if partitioned:
+            if os.path.isdir(self.staging_path):
+                shutil.rmtree(self.staging_path)
+            os.makedirs(self.staging_path)
+
+    def _resume(self, n_of_rows: int, offset: int) -> None:
+        if self.partitioned:
+            part_paths = get_part_paths(self.path) if os.path.isdir(self.path) else []
+            if len(part_paths) < offset:
+                raise ValueError(f"Cannot resume writing '{self.path}', it has less than {offset} parts")
+            self.n_of_rows = n_of_rows
+            self.n_of_parts = self.first_part = offset
+            if offset > 0:
+                self.schema = pq.read_schema(part_paths[0])
+            return None
+        if is_parquet_path(self.path):
+            raise ValueError(f"Cannot resume writing '{self.path}', parquet files can only be resumed when partitioned")
+        with open(self.path, "r+b") as fstream:
+            fstream.truncate(offset)
+        self.n_of_rows = n_of_rows
+        return None
+
+    def tell(self) -> tuple[int, int]:
+        """Returns the position after the rows written so far, to resume writing from it (see `resume_from`).
+        Partitioned outputs start a new part after the position"""
+        if self.partitioned:
+            self._close_part()
+            return self.n_of_rows, self.n_of_parts
+        if is_parquet_path(self.path) or self.n_of_rows == 0:
+            return self.n_of_rows, 0
+        return self.n_of_rows, os.path.getsize(self.path)
+
+    def __enter__(self) -> FrameWriter:
+        return self
+
+    def write(self, chunk: pd.DataFrame) -> None:
+        """Appends the rows of *chunk*. All the chunks must have the same columns"""
+        chunk = chunk.copy(deep=False)
+        if not is_parquet_path(self.path):
+            chunk.index = pd.RangeIndex(self.n_of_rows, self.n_of_rows + len(chunk))
+            _prepare_csv_columns(chunk).to_csv(self.path, mode="w" if self.n_of_rows == 0 else "a",
+                                               header=self.n_of_rows == 0)
+            self.n_of_rows += len(chunk)
+            return None
+        if self.partitioned and len(chunk) == 0:
+            # Parts are never empty
+            return None
+        # The categories of each chunk may differ, so labels are written as plain strings
+        for col in CATEGORICAL_COLUMNS:
+            if col in chunk.columns:
+                chunk[col] = chunk[col].astype(object)
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        if self.schema is None:
+            self.schema = table.schema
+        else:
+            table = table.cast(self.schema)
+        if self.parquet_writer is None:
+            if self.partitioned:
+                self.parquet_path = os.path.join(self.staging_path, PART_NAME_FORMAT.format(self.n_of_parts))
+            self.parquet_writer = pq.ParquetWriter(self.parquet_path, self.schema)
+        self.parquet_writer.write_table(table)
+        self.n_of_rows += len(chunk)
+        return None
+
+    def _close_part(self) -> None:
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+            self.parquet_writer = None
+            if self.partitioned:
+                self.n_of_parts += 1
+
+    def close(self) -> None:
+        self._close_part()
+        if self.partitioned and os.path.isdir(self.staging_path):
+            self._publish_parts()
+
+    def _publish_parts(self) -> None:
+        """Moves the parts written by self into the output, replacing the ones after the resumed position"""
+        if not os.path.isdir(self.path):
+            remove_frame(self.path)
+            os.makedirs(self.path)
+        for part in range(self.first_part, self.n_of_parts):
+            part_name = PART_NAME_FORMAT.format(part)
+            os.replace(os.path.join(self.staging_path, part_name), os.path.join(self.path, part_name))
+        for part_path in get_part_paths(self.path)[self.n_of_parts:]:
+            os.remove(part_path)
+        os.rmdir(self.staging_path)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None and self.partitioned:
+            # The output is left as it was
+            if self.parquet_writer is not None:
+                self.parquet_writer.close()
+                self.parquet_writer = None
+            shutil.rmtree(self.staging_path, ignore_errors=True)
+            return None
+        self.close()
+
+
+def _get_parquet_files(path: str) -> list[str]:
+    """Returns the files of a parquet output, which is either a file or a partitioned directory"""
+    return get_part_paths(path) if os.path.isdir(path) else [path]
+
+
+def _prepare_csv_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Converts the columns that are not printed as python literals. Works in-place"""
+    for col in ARRAY_COLUMNS.keys():
+        if col in df.columns:
+            df[col] = [list(map(int, array)) for array in df[col]]
+    return df
+
+
+def _restore_categories(df: pd.DataFrame) -> pd.DataFrame:
+    """Makes the label columns categorical. Works in-place"""
+    for col in CATEGORICAL_COLUMNS:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype("category")
+    return df
+
+
+def _restore_csv_types(df: pd.DataFrame) -> pd.DataFrame:
+    """Parses the columns of a dataframe read from a csv file into the types of `read_frame`. Works in-place"""
+    # Legacy csv files were saved together with their index
+    if "Unnamed: 0" in df.columns:
+        df.drop(columns=["Unnamed: 0"], inplace=True)
+    for col in LIST_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].apply(literal_eval)
+    for col, dtype in ARRAY_COLUMNS.items():
+        if col in df.columns:
+            df[col] = [np.asarray(values, dtype=dtype) for values in df[col]]
+    _restore_categories(df)
+    for col in DATE_COLUMNS:
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col], errors="raise")
+    return df
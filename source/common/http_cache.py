@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import time
+import zlib
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+
+class CacheMissError(LookupError):
+    """Raised when a url is not cached and the cache is offline"""
+
+    def __init__(self, url: str):
+        self.url = url
+        super().__init__(f"'{url}' is not cached and the http cache is offline")
+
+
+class HttpCache:
+    """On-disk cache of the bodies of http responses, shared by the runs of the pipeline
+
+    Each body is stored compressed in a file named after the hash of its normalized url (see `normalize_url`),
+    together with the time it was stored. Bodies older than the time to live are ignored, and when the files
+    exceed the maximum size the least recently used ones are removed. Files are written to a temporary file and
+    renamed, so concurrent writers (threads or processes) never leave a partially written body.
+    When the cache is offline, urls that are not cached raise `CacheMissError` instead of being downloaded
+    """
+
+    CONFIG_PATH = os.path.join(os.path.dirname(__file__), "../../config/http_cache/http_cache.json")
+
+    # Built the first time it is needed (see `get_default`)
+    _default_cache = None
+
+    # Each file starts with the time its body was stored, as a big-endian double
+    _HEADER = struct.Struct(">d")
+    # Fraction of the maximum size kept after an eviction, so that evictions are not triggered by every write
+    EVICTION_TARGET = 0.9
+
+    def __init__(self,
+                 path: str,
+                 ttl_seconds: float | None = None,
+                 max_size_bytes: int | None = None,
+                 offline: bool = False,
+                 compression_level: int = 6):
+        """
+        :param path: Directory of the cache. Created if it doesn't exist
+        :param ttl_seconds: Time to live of the bodies (Default: forever)
+        :param max_size_bytes: Maximum total size of the files (Default: unbounded)
+        :param offline: Serve only cached bodies
+        :param compression_level: zlib compression level of the bodies
+        """
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_size_bytes = max_size_bytes
+        self.offline = offline
+        self.compression_level = compression_level
+        self.n_of_hits = 0
+        self.n_of_misses = 0
+        # Total size of the files, computed when first needed and updated with the writes of this process
+        self._size_bytes = None
+        os.makedirs(path, exist_ok=True)
+
+    @classmethod
+    def get_default(cls) -> HttpCache:
+        """Returns the cache configured in CONFIG_PATH, building it on the first call"""
+        if cls._default_cache is None:
+            with open(cls.CONFIG_PATH) as fstream:
+                config = json.load(fstream)
+            path = os.path.join(os.path.dirname(cls.CONFIG_PATH), config["path"])
+            ttl_hours, max_size_mb = config.get("ttl_hours"), config.get("max_size_mb")
+            cls._default_cache = HttpCache(path=os.path.normpath(path),
+                                           ttl_seconds=None if ttl_hours is None else ttl_hours * 3600,
+                                           max_size_bytes=None if max_size_mb is None else max_size_mb * 2 ** 20,
+                                           offline=config.get("offline", False))
+        return cls._default_cache
+
+    @staticmethod
+    def normalize_url(url: str) -> str:
+        """Returns a canonical form of a url: lowercase scheme and host, without default ports or fragment,
+        and with the query parameters sorted"""
+        parts = urlsplit(url.strip())
+        scheme = parts.scheme.lower()
+        netloc = parts.netloc.lower()
+        if (scheme, parts.port) in (("http", 80), ("https", 443)):
+            netloc = netloc.rsplit(":", 1)[0]
+        query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+        return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+    def get_file_path(self, url: str) -> str:
+        key = hashlib.sha256(self.normalize_url(url).encode("utf-8")).hexdigest()
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def get(self, url: str) -> bytes | None:
+        """Returns the cached body of a url, or None if it is not cached or has expired.
+        Offline caches serve expired bodies too, as they cannot be downloaded again"""
+        file_path = self.get_file_path(url)
+        try:
+            with open(file_path, "rb") as fstream:
+                data = fstream.read()
+            stored_time = self._HEADER.unpack_from(data)[0]
+            if not self.offline and self.ttl_seconds is not None and time.time() - stored_time > self.ttl_seconds:
+                self.n_of_misses += 1
+                return None
+            body = zlib.decompress(data[self._HEADER.size:])
+        except (FileNotFoundError, struct.error, zlib.error):
+            self.n_of_misses += 1
+            return None
+        # The modification time of a file is the last time it was used
+        try:
+            os.utime(file_path)
+        except FileNotFoundError:
+            pass
+        self.n_of_hits += 1
+        return body
+
+    def put(self, url: str, body: bytes) -> None:
+        """Stores the body of a url, replacing any previous body"""
+        file_path = self.get_file_path(url)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        data = self._HEADER.pack(time.time()) + zlib.compress(body, self.compression_level)
+        try:
+            replaced_size = os.path.getsize(file_path)
+        except FileNotFoundError:
+            replaced_size = 0
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(file_path), suffix=".tmp")
+        try:
+            with os.fdopen(file_descriptor, "wb") as fstream:
+                fstream.write(data)
+            os.replace(temporary_path, file_path)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+        if self.max_size_bytes is not None:
+            if self._size_bytes is None:
+                self._size_bytes = self._compute_size()
+            else:
+                self._size_bytes += len(data) - replaced_size
+            if self._size_bytes > self.max_size_bytes:
+                self.evict()
+
+    def check_online(self, url: str) -> None:
+        """Call before downloading a url that is not cached
+        :except CacheMissError: If the cache is offline"""
+        if self.offline:
+            raise CacheMissError(url)
+
+    def evict(self) -> None:
+        """Removes the least recently used files until they take less than EVICTION_TARGET of the maximum size,
+        and (unless the cache is offline) the files that haven't been used for longer than the time to live"""
+        entries = []
+        now = time.time()
+        for file_path in self._iter_file_paths():
+            try:
+                stat = os.stat(file_path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, file_path))
+        entries.sort()
+        total_size = sum(size for _, size, _ in entries)
+        target_size = None if self.max_size_bytes is None else self.max_size_bytes * self.EVICTION_TARGET
+        for last_used, size, file_path in entries:
+            is_expired = not self.offline and self.ttl_seconds is not None and now - last_used > self.ttl_seconds
+            if not is_expired and (target_size is None or total_size <= target_size):
+                continue
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+        self._size_bytes = total_size
+
+    def clear(self) -> None:
+        """Removes every cached body"""
+        for file_path in self._iter_file_paths():
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+        self._size_bytes = 0
+
+    def _iter_file_paths(self):
+        for directory in os.scandir(self.path):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    yield entry.path
+
+    def _compute_size(self) -> int:
+        total_size = 0
+        for file_path in self._iter_file_paths():
+            try:
+                total_size += os.path.getsize(file_path)
+            except FileNotFoundError:
+                pass
+        return total_size
+
+    def __len__(self):
+        """Number of cached bodies, including the expired ones"""
+        return sum(1 for _ in self._iter_file_paths())
+
+    def __repr__(self):
+        return (f"<HttpCache: '{self.path}', {self.n_of_hits} hits, {self.n_of_misses} misses"
+                f"{', offline' if self.offline else ''}>")
@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import os
+import unicodedata
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from source.common.sparse_adjacency import SparseAdjacency
+
+
+class LabelRegistry:
+    """Shared vocabulary of province and disaster labels
+
+    Each distinct label is normalized only once, and labels are encoded as categorical integer codes.
+    Province codes are the row indices of the province adjacency table, so they can be used to index it directly.
+    Labels missing from the vocabularies are appended to them, and keep their codes for the rest of the process
+    """
+
+    ADJACENCY_TABLE_PATH = os.path.join(os.path.dirname(__file__),
+                                        "../../data/provinces_adjacency/adjacency_table.csv")
+
+    PROVINCE_ALIASES = {'Alicante/Alacant': 'Alicante',
+                        'Araba/Álava': 'Araba',
+                        'Balears, Illes': 'Illes Balears',
+                        'Coruña, A': 'A Coruña',
+                        'Rioja, La': 'La Rioja',
+                        'Palmas, Las': 'Las Palmas',
+                        'Castellón/Castelló': 'Castellón',
+                        'Valencia/València': 'Valencia'}
+
+    KNOWN_DISASTERS = ["CAUSAS NATURALES/EMBATE DE MAR",
+                       "CAUSAS NATURALES/INUNDACIÓN EXTRAORDINARIA",
+                       "CAUSAS NATURALES/TEMPESTAD CICLÓNICA ATÍPICA"]
+
+    # Sets of provinces are stored as the bits of an unsigned 64-bit integer
+    MAX_MASK_PROVINCES = 64
+
+    _provinces: list[str] | None = None
+    _disasters: list[str] = list(KNOWN_DISASTERS)
+    _adjacency_table: np.ndarray | None = None
+    # Built when first needed and rebuilt when the province vocabulary grows (see `get_province_adjacency`)
+    _province_adjacency: SparseAdjacency | None = None
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def normalize_province(name: str) -> str:
+        """Returns the name of a province as it appears in the adjacency table (ascii, without the regional name)"""
+        name = LabelRegistry.PROVINCE_ALIASES.get(name, name)
+        return unicodedata.normalize('NFKD', name).encode('ascii', errors='ignore').decode('utf-8')
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def normalize_disaster(name: str) -> str:
+        return name.strip()
+
+    @classmethod
+    def _load_adjacency_table(cls) -> None:
+        if cls._provinces is not None:
+            return None
+        adjacencies = pd.read_csv(cls.ADJACENCY_TABLE_PATH, index_col=0)
+        cls._provinces = list(adjacencies.index)
+        cls._adjacency_table = adjacencies.loc[cls._provinces, cls._provinces].to_numpy(dtype=bool)
+        return None
+
+    @classmethod
+    def get_provinces(cls) -> list[str]:
+        """Returns the province vocabulary. The position of each province is its code"""
+        cls._load_adjacency_table()
+        return list(cls._provinces)
+
+    @classmethod
+    def get_disasters(cls) -> list[str]:
+        """Returns the disaster vocabulary. The position of each disaster is its code"""
+        return list(cls._disasters)
+
+    @classmethod
+    def get_adjacency_matrix(cls) -> np.ndarray:
+        """Returns a square boolean matrix, indexed by province codes, telling whether two provinces are adjacent.
+        Provinces missing from the adjacency table are only adjacent to themselves"""
+        cls._load_adjacency_table()
+        n_of_provinces = len(cls._provinces)
+        n_in_table = cls._adjacency_table.shape[0]
+        matrix = np.eye(n_of_provinces, dtype=bool)
+        matrix[:n_in_table, :n_in_table] = cls._adjacency_table
+        return matrix
+
+    @classmethod
+    def get_province_adjacency(cls) -> SparseAdjacency:
+        """Returns the adjacency matrix (see `get_adjacency_matrix`) in sparse format, whose powers give the
+        provinces within several hops of each other. The same instance is returned until the province vocabulary
+        grows, so the powers it caches are reused"""
+        cls._load_adjacency_table()
+        if cls._province_adjacency is None or len(cls._province_adjacency) != len(cls._provinces):
+            cls._province_adjacency = SparseAdjacency.from_dense(cls.get_adjacency_matrix())
+        return cls._province_adjacency
+
+    @classmethod
+    def get_adjacency_masks(cls, hops: int = 1, include_self: bool = True) -> np.ndarray:
+        """Returns, for each province code, the bitmask of its closed neighbourhood (the province and every province
+        adjacent to it). The bit of a province is its code, so a set of provinces is the bitwise or of their bits
+
+        :param hops: Radius of the neighbourhood. With 2 hops, the adjacent provinces of the adjacent provinces
+            are included too
+        :param include_self: Whether each province is in its own neighbourhood
+        :except ValueError: If there are more provinces than bits in a mask
+        """
+        adjacency = cls.get_province_adjacency()
+        if len(adjacency) > cls.MAX_MASK_PROVINCES:
+            raise ValueError(f"Cannot represent {len(adjacency)} provinces as {cls.MAX_MASK_PROVINCES}-bit masks")
+        return adjacency.to_masks(hops, include_self)
+
+    @staticmethod
+    def get_province_masks(codes: np.ndarray) -> np.ndarray:
+        """Returns the bit of each province code. Missing provinces (code -1) have no bits"""
+        codes = np.asarray(codes, dtype=np.int64)
+        bits = np.left_shift(np.uint64(1), np.maximum(codes, 0).astype(np.uint64))
+        return np.where(codes >= 0, bits, np.uint64(0))
+
+    @staticmethod
+    def decode_province_mask(mask: int | np.uint64) -> np.ndarray:
+        """Returns the sorted codes of the provinces of a bitmask"""
+        bits = np.unpackbits(np.array([mask], dtype="<u8").view(np.uint8), bitorder="little")
+        return np.flatnonzero(bits)
+
+    @classmethod
+    def encode_provinces(cls, values: pd.Series) -> pd.Categorical:
+        """Normalizes a series of province names and encodes them with the province vocabulary"""
+        cls._load_adjacency_table()
+        return cls._encode(values, cls._provinces, cls.normalize_province)
+
+    @classmethod
+    def encode_disasters(cls, values: pd.Series) -> pd.Categorical:
+        """Normalizes a series of disaster types and encodes them with the disaster vocabulary"""
+        return cls._encode(values, cls._disasters, cls.normalize_disaster)
+
+    @staticmethod
+    def _encode(values: pd.Series, vocabulary: list[str], normalize) -> pd.Categorical:
+        """Encodes the values with the vocabulary, normalizing only the distinct values. Mutates the vocabulary"""
+        values = pd.Series(values)
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            codes = values.cat.codes.to_numpy()
+            distinct_values = values.cat.categories
+        else:
+            codes, distinct_values = pd.factorize(values)
+        positions = {label: code for code, label in enumerate(vocabulary)}
+        mapping = np.empty(len(distinct_values) + 1, dtype=np.int64)
+        # The last position of the mapping keeps the missing values missing (code -1)
+        mapping[-1] = -1
+        for i, value in enumerate(distinct_values):
+            label = normalize(str(value))
+            if label not in positions:
+                positions[label] = len(vocabulary)
+                vocabulary.append(label)
+            mapping[i] = positions[label]
+        return pd.Categorical.from_codes(mapping[codes], categories=list(vocabulary))
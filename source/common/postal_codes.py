@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import numpy as np
+import pandas as pd
+
+# Compact representation of sets of postal codes: sorted numpy arrays of unique int32 values.
+# Spanish postal codes have 5 digits, which allows to union many sets at once by sorting (group, code) pairs
+
+POSTAL_CODE_DTYPE = np.int32
+POSTAL_CODE_LIMIT = 100000
+
+
+def to_postal_code_array(codes) -> np.ndarray:
+    """Converts an iterable of postal codes into a set of postal codes. Missing codes are discarded"""
+    codes = np.asarray(codes, dtype=float).ravel()
+    return np.unique(codes[~np.isnan(codes)].astype(POSTAL_CODE_DTYPE))
+
+
+def union_postal_codes(code_sets) -> np.ndarray:
+    """Returns the union of several sets of postal codes"""
+    code_sets = list(code_sets)
+    if len(code_sets) == 0:
+        return np.empty(0, dtype=POSTAL_CODE_DTYPE)
+    return np.unique(np.concatenate(code_sets).astype(POSTAL_CODE_DTYPE))
+
+
+def union_postal_codes_by_group(codes: pd.Series, group_ids: np.ndarray, n_groups: int) -> list[np.ndarray]:
+    """Computes the union of the postal codes of each group of rows in a single vectorized pass
+
+    :param codes: Either a numeric column with a single postal code per row (missing codes are discarded)
+        or a column of sets of postal codes
+    :param group_ids: Group of each row, between 0 and *n_groups* - 1. Rows with a negative group are ignored
+    :param n_groups: Total number of groups
+    :return: A list containing the set of postal codes of each group
+    """
+    group_ids = np.asarray(group_ids, dtype=np.int64)
+    if codes.dtype == object:
+        code_sets = codes.tolist()
+        lengths = np.fromiter((len(code_set) for code_set in code_sets), dtype=np.int64, count=len(code_sets))
+        flat_codes = np.concatenate(code_sets) if len(code_sets) > 0 else np.empty(0)
+        flat_codes = np.asarray(flat_codes, dtype=np.int64)
+        flat_groups = np.repeat(group_ids, lengths)
+    else:
+        flat_codes = codes.to_numpy(dtype=float)
+        is_valid = ~np.isnan(flat_codes)
+        flat_codes = flat_codes[is_valid].astype(np.int64)
+        flat_groups = group_ids[is_valid]
+    is_grouped = flat_groups >= 0
+    keys = np.unique(flat_groups[is_grouped] * POSTAL_CODE_LIMIT + flat_codes[is_grouped])
+    key_groups = keys // POSTAL_CODE_LIMIT
+    unique_codes = (keys % POSTAL_CODE_LIMIT).astype(POSTAL_CODE_DTYPE)
+    return np.split(unique_codes, np.searchsorted(key_groups, np.arange(1, n_groups)))
+
+
+class PostalPrefixIndex:
+    """Neighbourhoods of postal codes at a finer level than provinces
+
+    Two sets of postal codes are neighbours when they share a prefix of *prefix_digits* digits
+    (the first 2 digits of a spanish postal code are its province, the 3rd usually its area within the province).
+    The prefixes of each row of a frame are stored in CSR format, so the prefixes of the clusters of rows
+    can be computed at once with a single sort (see `get_cluster_keys`)
+    """
+
+    def __init__(self, code_sets: list[np.ndarray], prefix_digits: int = 3):
+        """
+        :param code_sets: Set of postal codes of each row (see `to_postal_code_array`)
+        :param prefix_digits: Number of digits of the prefixes, between 1 and 5
+        """
+        if not 1 <= prefix_digits <= 5:
+            raise ValueError("The prefixes must have between 1 and 5 digits")
+        self.prefix_digits = prefix_digits
+        self.n_of_prefixes = 10 ** prefix_digits
+        lengths = np.fromiter((len(code_set) for code_set in code_sets), dtype=np.int64, count=len(code_sets))
+        flat_codes = np.concatenate(code_sets).astype(np.int64) if len(code_sets) > 0 else np.empty(0, np.int64)
+        keys = np.unique(np.repeat(np.arange(len(code_sets)), lengths) * self.n_of_prefixes
+                         + flat_codes // 10 ** (5 - prefix_digits))
+        self._set_keys(keys, len(code_sets))
+
+    def _set_keys(self, keys: np.ndarray, n_of_rows: int) -> None:
+        """Sets the prefixes of the rows from their sorted (row, prefix) pairs, encoded as in `get_cluster_keys`"""
+        self.indptr = np.searchsorted(keys // self.n_of_prefixes, np.arange(n_of_rows + 1))
+        self.prefixes = keys % self.n_of_prefixes
+
+    def group_rows(self, rows: np.ndarray, group_ids: np.ndarray, n_of_groups: int) -> PostalPrefixIndex:
+        """Returns an index whose rows are groups of the rows of self, with the union of their prefixes
+
+        :param rows: Rows of the groups, as indexes of the code sets used to build the index
+        :param group_ids: Group of each row, between 0 and *n_of_groups* - 1
+        """
+        index = PostalPrefixIndex([], self.prefix_digits)
+        index._set_keys(self.get_cluster_keys(rows, group_ids), n_of_groups)
+        return index
+
+    def get_prefixes(self, codes: np.ndarray) -> np.ndarray:
+        """Returns the sorted distinct prefixes of a set of postal codes"""
+        return np.unique(np.asarray(codes, dtype=np.int64) // 10 ** (5 - self.prefix_digits))
+
+    def share_prefix(self, codes: np.ndarray, other_codes: np.ndarray) -> bool:
+        """Checks whether two sets of postal codes are neighbours"""
+        return len(np.intersect1d(self.get_prefixes(codes), self.get_prefixes(other_codes))) > 0
+
+    def get_cluster_keys(self, rows: np.ndarray, cluster_ids: np.ndarray) -> np.ndarray:
+        """Returns the sorted (cluster, prefix) pairs of some clusters of rows, encoded as
+        cluster * 10^prefix_digits + prefix
+
+        :param rows: Rows of the clusters, as indexes of the code sets used to build the index
+        :param cluster_ids: Cluster of each row
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        counts = self.indptr[rows + 1] - self.indptr[rows]
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        prefixes = self.prefixes[np.repeat(self.indptr[rows], counts) + offsets]
+        return np.unique(np.repeat(np.asarray(cluster_ids, dtype=np.int64), counts) * self.n_of_prefixes + prefixes)
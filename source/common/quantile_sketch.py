@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+from math import ceil
+
+import numpy as np
+
+
+class KLLSketch:
+    """Mergeable sketch of the distribution of a stream of values, used to approximate its quantiles
+    without keeping the whole stream in memory (Karnin, Lang and Liberty, 2016)
+
+    Values are kept in levels, each value of level h standing for 2^h values of the stream.
+    When a level grows over its capacity it is sorted and every other value is promoted to the next level.
+    The rank error of the quantiles is about 1.7 / *k*, and the memory used is proportional to *k*.
+    Sketches built from different parts of a stream (eg: in different processes) can be merged into one
+    """
+
+    CAPACITY_DECAY = 2 / 3
+
+    def __init__(self, k: int = 200, seed: int | None = None):
+        """
+        :param k: Capacity of the top level. Greater values give more precise quantiles
+        :param seed: Seed of the random choices made when compacting, for reproducible sketches
+        """
+        if k < 8:
+            raise ValueError("k must be at least 8")
+        self.k = k
+        self.levels = [np.empty(0)]
+        self.count = 0
+        self.rng = np.random.default_rng(seed)
+
+    @staticmethod
+    def k_for_error(error: float) -> int:
+        """Returns the smallest k giving a rank error of about *error* (eg: 0.01 for a 1% error)"""
+        return max(8, ceil(1.7 / error))
+
+    def update(self, values) -> None:
+        """Adds a batch of values to the sketch. Missing values are ignored"""
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        self.count += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+
+    def merge(self, other: KLLSketch) -> None:
+        """Adds all the values summarized by *other* to self"""
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for h, level in enumerate(other.levels):
+            self.levels[h] = np.concatenate([self.levels[h], level])
+        self.count += other.count
+        self._compress()
+
+    def _capacity(self, level: int) -> int:
+        depth = len(self.levels) - level - 1
+        return max(2, ceil(self.k * self.CAPACITY_DECAY ** depth))
+
+    def _compress(self) -> None:
+        h = 0
+        while h < len(self.levels):
+            level = self.levels[h]
+            if len(level) <= self._capacity(h):
+                h += 1
+                continue
+            if h + 1 == len(self.levels):
+                self.levels.append(np.empty(0))
+            level = np.sort(level)
+            # With an odd number of values, one of them stays in this level so no weight is lost
+            kept = level[:len(level) % 2]
+            compacted = level[len(level) % 2:]
+            promoted = compacted[self.rng.integers(2)::2]
+            self.levels[h] = kept
+            self.levels[h + 1] = np.concatenate([self.levels[h + 1], promoted])
+            h += 1
+
+    def _weighted_values(self) -> tuple[np.ndarray, np.ndarray]:
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level), 2 ** h, dtype=np.int64) for h, level in enumerate(self.levels)])
+        order = np.argsort(values, kind="stable")
+        return values[order], np.cumsum(weights[order])
+
+    def quantile(self, q: float | np.ndarray) -> float | np.ndarray:
+        """Returns the approximate value below which a fraction *q* of the values lie
+
+        :except ValueError: If the sketch is empty"""
+        if self.count == 0:
+            raise ValueError("Cannot compute quantiles of an empty sketch")
+        values, cumulative_weights = self._weighted_values()
+        ranks = np.clip(np.ceil(np.asarray(q) * cumulative_weights[-1]), 1, None)
+        positions = np.minimum(np.searchsorted(cumulative_weights, ranks), len(values) - 1)
+        return values[positions]
+
+    def __len__(self):
+        """Number of values summarized by the sketch"""
+        return self.count
+
+    def __repr__(self):
+        return f"<KLLSketch: k={self.k}, {self.count} values, {sum(len(level) for level in self.levels)} stored>"
@@ -1,19 +1,24 @@
-def retriable(max_n_of_tries: int):
+from typing import Callable
+
+
+def retriable(max_n_of_tries: int | Callable[[], int]):
     """
     Decorator. Will call the function it decorates up to n times, retrying if the function raises any exception
     After n tries, if the function excepts the exception will be raised anyway.
 
-    :param max_n_of_tries: The maximum number of retries allowed
+    :param max_n_of_tries: The maximum number of retries allowed, or a callable returning it.
+        The callable is evaluated on each call, which allows to read the maximum from a config loaded lazily
     """
     def inner(func):
         def wrapper(*args, **kwargs):
+            n_of_tries = max_n_of_tries() if callable(max_n_of_tries) else max_n_of_tries
             total_tries = 0
             while True:
                 try:
                     return func(*args, **kwargs)
                 except Exception as e:
                     total_tries += 1
-                    if total_tries >= max_n_of_tries:
+                    if total_tries >= n_of_tries:
                         raise e
         return wrapper
     return inner
@@ -0,0 +1,57 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class SingleFlightCache:
+    """Memoizes the results of coroutines by key. Concurrent calls with the same key share a single execution
+    (single-flight), and later calls return the memoized result
+
+    Failed or cancelled executions are not memoized, so the next call with their key executes them again.
+    Results are kept across event loops, while executions are only shared within the loop that started them
+    """
+
+    def __init__(self):
+        self._results: dict[Hashable, Any] = {}
+        self._in_flight: dict[Hashable, asyncio.Future] = {}
+        self.n_of_hits = 0
+        self.n_of_misses = 0
+
+    async def get(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """Returns the result of *factory()* for *key*, executing it only if it is neither memoized nor running
+
+        :param factory: Creates the awaitable computing the result. It is only called on a miss
+        """
+        if key in self._results:
+            self.n_of_hits += 1
+            return self._results[key]
+        execution = self._in_flight.get(key)
+        if execution is None:
+            self.n_of_misses += 1
+            execution = asyncio.ensure_future(factory())
+            self._in_flight[key] = execution
+            execution.add_done_callback(lambda finished: self._on_done(key, finished))
+        else:
+            self.n_of_hits += 1
+        # A cancelled caller doesn't cancel the execution shared with other callers
+        return await asyncio.shield(execution)
+
+    def _on_done(self, key: Hashable, execution: asyncio.Future) -> None:
+        self._in_flight.pop(key, None)
+        if not execution.cancelled() and execution.exception() is None:
+            self._results[key] = execution.result()
+
+    def clear(self) -> None:
+        """Forgets the memoized results"""
+        self._results.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._results
+
+    def __len__(self):
+        """Number of memoized results"""
+        return len(self._results)
+
+    def __repr__(self):
+        return f"<SingleFlightCache: {len(self)} results, {self.n_of_hits} hits, {self.n_of_misses} misses>"
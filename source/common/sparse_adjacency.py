@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import numpy as np
+
+
+class SparseAdjacency:
+    """Boolean adjacency matrix of n nodes in compressed sparse row (CSR) format
+
+    The neighbours of node i are `indices[indptr[i]:indptr[i + 1]]`, sorted. When the matrix contains its
+    diagonal (closed neighbourhoods, like the province adjacency table), its k-th power links the nodes that are
+    at most k hops apart. Powers are computed with a vectorized boolean product and cached
+    """
+
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self._powers = {1: self}
+
+    @classmethod
+    def from_pairs(cls, rows: np.ndarray, cols: np.ndarray, n_of_nodes: int) -> SparseAdjacency:
+        """Builds the matrix with a True in each (rows[i], cols[i]). Repeated pairs are ignored"""
+        keys = np.unique(np.asarray(rows, dtype=np.int64) * n_of_nodes + np.asarray(cols, dtype=np.int64))
+        indptr = np.searchsorted(keys // n_of_nodes, np.arange(n_of_nodes + 1), side="left")
+        return SparseAdjacency(indptr, keys % n_of_nodes)
+
+    @classmethod
+    def from_dense(cls, matrix: np.ndarray) -> SparseAdjacency:
+        rows, cols = np.nonzero(matrix)
+        return cls.from_pairs(rows, cols, matrix.shape[0])
+
+    @classmethod
+    def identity(cls, n_of_nodes: int) -> SparseAdjacency:
+        return SparseAdjacency(np.arange(n_of_nodes + 1), np.arange(n_of_nodes))
+
+    def __len__(self):
+        """Number of nodes"""
+        return len(self.indptr) - 1
+
+    def get_n_of_edges(self) -> int:
+        return len(self.indices)
+
+    def multiply(self, other: SparseAdjacency) -> SparseAdjacency:
+        """Boolean product: node i is linked to node k if some node j is linked to k in *other* and i is linked to j"""
+        rows = np.repeat(np.arange(len(self)), np.diff(self.indptr))
+        counts = other.indptr[self.indices + 1] - other.indptr[self.indices]
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cols = other.indices[np.repeat(other.indptr[self.indices], counts) + offsets]
+        return SparseAdjacency.from_pairs(np.repeat(rows, counts), cols, len(self))
+
+    def power(self, k: int) -> SparseAdjacency:
+        """Returns the k-th boolean power of the matrix (the identity for k = 0). Powers are cached"""
+        if k < 0:
+            raise ValueError("Only non-negative powers are supported")
+        if k == 0:
+            return SparseAdjacency.identity(len(self))
+        if k not in self._powers:
+            self._powers[k] = self.power(k - 1).multiply(self)
+        return self._powers[k]
+
+    def neighbours(self, nodes: np.ndarray, k: int = 1) -> np.ndarray:
+        """Returns the sorted nodes linked to any of *nodes* in the k-th power of the matrix"""
+        matrix = self.power(k)
+        nodes = np.asarray(nodes, dtype=np.int64)
+        counts = matrix.indptr[nodes + 1] - matrix.indptr[nodes]
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return np.unique(matrix.indices[np.repeat(matrix.indptr[nodes], counts) + offsets])
+
+    def to_masks(self, k: int = 1, include_self: bool = True) -> np.ndarray:
+        """Returns, for each node, the bitmask of the nodes linked to it in the k-th power of the matrix
+
+        :param include_self: Whether the bit of each node is set in its own mask
+        :except ValueError: If there are more than 64 nodes
+        """
+        if len(self) > 64:
+            raise ValueError(f"Cannot represent {len(self)} nodes as 64-bit masks")
+        matrix = self.power(k)
+        rows = np.repeat(np.arange(len(self)), np.diff(matrix.indptr))
+        bits = np.left_shift(np.uint64(1), matrix.indices.astype(np.uint64))
+        if not include_self:
+            bits[matrix.indices == rows] = 0
+        masks = np.zeros(len(self), dtype=np.uint64)
+        np.bitwise_or.at(masks, rows, bits)
+        return masks
+
+    def __repr__(self):
+        return f"<SparseAdjacency: {len(self)} nodes, {self.get_n_of_edges()} edges>"
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import numpy as np
+
+
+class UnionFind:
+    """Disjoint sets of the integers 0..n-1, stored as an array of parent pointers
+
+    Every parent pointer points to an element lower or equal than itself, so the root of each set is its lowest
+    element and the pointers cannot form cycles. This allows to join many pairs of sets at once with vectorized
+    operations instead of a python loop over the pairs
+    """
+
+    def __init__(self, n: int):
+        self.parent = np.arange(n, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.parent)
+
+    def find(self, elements: np.ndarray | int) -> np.ndarray | int:
+        """Returns the root of the set of each element"""
+        roots = self.parent[elements]
+        while True:
+            grand_parents = self.parent[roots]
+            if np.all(grand_parents == roots):
+                return roots
+            roots = grand_parents
+
+    def compress(self) -> None:
+        """Makes every element point directly to its root"""
+        while True:
+            grand_parents = self.parent[self.parent]
+            if np.array_equal(grand_parents, self.parent):
+                return None
+            self.parent = grand_parents
+
+    def union(self, a: np.ndarray | int, b: np.ndarray | int) -> int:
+        """Joins the sets of each pair of elements (a[i], b[i])
+
+        :return: The number of sets that were joined (0 if all the pairs were already in the same set)
+        """
+        a = np.atleast_1d(np.asarray(a, dtype=np.int64))
+        b = np.atleast_1d(np.asarray(b, dtype=np.int64))
+        n_of_joins = 0
+        while len(a) > 0:
+            roots_a = self.find(a)
+            roots_b = self.find(b)
+            is_split = roots_a != roots_b
+            a, b = roots_a[is_split], roots_b[is_split]
+            if len(a) == 0:
+                break
+            # Hook the higher root under the lower one. When several pairs hook the same root only the lowest
+            # target is applied, and the other pairs are joined in the next iterations
+            high, low = np.maximum(a, b), np.minimum(a, b)
+            np.minimum.at(self.parent, high, low)
+            # Every hooked root stops being a root
+            n_of_joins += len(np.unique(high))
+            a, b = high, low
+        self.compress()
+        return n_of_joins
+
+    def get_labels(self) -> np.ndarray:
+        """Returns the label of the set of each element, numbered from 0 in order of their lowest element"""
+        self.compress()
+        _, labels = np.unique(self.parent, return_inverse=True)
+        return labels.astype(np.int64)
+
+    def n_of_sets(self) -> int:
+        return int(np.count_nonzero(self.parent == np.arange(len(self.parent))))
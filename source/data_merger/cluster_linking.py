@@ -0,0 +1,360 @@
+from __future__ import annotations
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+
+from source.common.postal_codes import PostalPrefixIndex
+from source.data_merger.cluster_store import ClusterStore
+
+
+class ClusterLinking:
+    """Groups the rows of the expedients into clusters representing the same disaster
+
+    Two clusters are compatible (see `DisasterLinker.is_compatible_with`) when they have the same disaster type,
+    their time frames are closer than the days leniency and at least a pair of their provinces are adjacent.
+    The provinces of a cluster are kept as a bitmask (see `LabelRegistry.get_adjacency_masks`) together with the
+    mask of their closed neighbourhood, so two clusters are adjacent when the neighbourhood of one and the
+    provinces of the other share a bit, and the masks of merged clusters are the bitwise or of their masks.
+    Optionally, clusters whose postal codes share a prefix are adjacent too (see `PostalPrefixIndex`).
+    Merging two clusters only widens their time frame and adds provinces, so a cluster compatible with one of
+    them is also compatible with the merged cluster. Because of this, the clusters can be found by repeatedly
+    joining all the compatible pairs of clusters at once, until no pair of clusters is compatible.
+
+    The clusters and their aggregates are kept in a `ClusterStore`. Each round partitions them by disaster type,
+    sorts them by start date and only compares the clusters starting within the days leniency of the end of each
+    other, so a round costs O(n log n + candidate pairs)
+    """
+
+    # Maximum number of candidate pairs held in memory at once
+    MAX_PAIRS_PER_BATCH = 1_000_000
+
+    @classmethod
+    def link(cls,
+             store: ClusterStore,
+             days_leniency: int,
+             debug_messages_on: bool = False,
+             postal_index: PostalPrefixIndex | None = None) -> None:
+        """Merges the clusters of a store until no pair of them is compatible. Mutates the store in-place
+
+        :param store: The initial clusters, with their aggregates
+        :param days_leniency: Maximum number of days between two compatible time frames
+        :param postal_index: If given, clusters whose postal codes share a prefix are adjacent too
+            (see `PostalPrefixIndex`)
+        """
+        n_of_rounds = 0
+        while True:
+            n_of_rounds += 1
+            n_of_clusters = len(store.get_cluster_ids())
+            n_of_joins = 0
+            for first, second in cls._find_store_pairs(store, days_leniency, postal_index):
+                n_of_joins += store.merge_pairs(first, second)
+            if debug_messages_on:
+                print(f"Round {n_of_rounds}: {n_of_clusters} clusters, {n_of_joins} joins")
+            if n_of_joins == 0:
+                return None
+
+    @classmethod
+    def link_parallel(cls,
+                      store: ClusterStore,
+                      days_leniency: int,
+                      n_workers: int,
+                      split_by_time: bool = True,
+                      debug_messages_on: bool = False,
+                      postal_index: PostalPrefixIndex | None = None) -> None:
+        """Same as `link`, but links independent partitions of the clusters in a pool of processes
+
+        Clusters of different disaster types are never compatible, and neither are clusters whose time frames are
+        separated by a gap longer than the days leniency from every cluster in between. The clusters are split
+        into partitions by disaster type and, if *split_by_time*, by those gaps, and the partitions are assigned
+        to *n_workers* shards balanced by number of clusters. Each shard is linked in a process, and its merges
+        are applied to the store. The id of a cluster is its lowest row, so the result doesn't depend on the
+        number of workers and is the same as the result of `link`
+
+        :param n_workers: Number of processes (and shards) to use. With less than 2, `link` is used instead
+        :param split_by_time: Whether to also split the clusters of each disaster type into time components
+        """
+        if n_workers < 2:
+            return cls.link(store, days_leniency, debug_messages_on, postal_index)
+        cluster_ids = store.get_cluster_ids()
+        partition_ids = cls.get_partition_ids(store.disaster_codes[cluster_ids],
+                                              store.start_days[cluster_ids],
+                                              store.end_days[cluster_ids],
+                                              days_leniency if split_by_time else None)
+        partition_sizes = np.bincount(partition_ids)
+        # Assign the largest partitions first, each one to the least loaded shard
+        shard_of_partition = np.empty(len(partition_sizes), dtype=np.int64)
+        shard_loads = np.zeros(n_workers, dtype=np.int64)
+        for partition in np.argsort(-partition_sizes, kind="stable"):
+            shard = int(np.argmin(shard_loads))
+            shard_of_partition[partition] = shard
+            shard_loads[shard] += partition_sizes[partition]
+        shard_ids = shard_of_partition[partition_ids]
+        shards = [cluster_ids[shard_ids == shard] for shard in range(n_workers) if shard_loads[shard] > 0]
+        if debug_messages_on:
+            print(f"Linking {len(cluster_ids)} clusters in {len(partition_sizes)} partitions and {len(shards)} shards")
+
+        # The rows of each shard store are the clusters of the shard, which keep their aggregates
+        shard_stores = [ClusterStore(row_indexes=np.arange(len(shard)),
+                                     start_days=store.start_days[shard],
+                                     end_days=store.end_days[shard],
+                                     total_costs=store.total_costs[shard],
+                                     claims=store.claims[shard],
+                                     disaster_codes=store.disaster_codes[shard],
+                                     province_masks=store.province_masks[shard],
+                                     neighbourhood_masks=store.neighbourhood_masks[shard]) for shard in shards]
+        shard_postal_indexes = [None] * len(shards)
+        if postal_index is not None:
+            cluster_of_rows = store.find(np.arange(len(store)))
+            position_of_clusters = np.full(len(store), -1, dtype=np.int64)
+            for i, shard in enumerate(shards):
+                position_of_clusters[shard] = np.arange(len(shard))
+                is_in_shard = np.isin(cluster_of_rows, shard)
+                shard_postal_indexes[i] = postal_index.group_rows(
+                    store.row_indexes[is_in_shard], position_of_clusters[cluster_of_rows[is_in_shard]], len(shard))
+
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            shard_labels = list(executor.map(cls._link_shard, shard_stores, repeat(days_leniency),
+                                             shard_postal_indexes))
+        for shard, labels in zip(shards, shard_labels):
+            store.merge_pairs(shard, shard[labels])
+        return None
+
+    @classmethod
+    def _link_shard(cls,
+                    store: ClusterStore,
+                    days_leniency: int,
+                    postal_index: PostalPrefixIndex | None) -> np.ndarray:
+        """Links a store in a process of the pool, and returns the cluster of each of its rows"""
+        cls.link(store, days_leniency, postal_index=postal_index)
+        return store.find(np.arange(len(store)))
+
+    @staticmethod
+    def get_partition_ids(disaster_codes: np.ndarray,
+                          start_days: np.ndarray,
+                          end_days: np.ndarray,
+                          days_leniency: int | None = None) -> np.ndarray:
+        """Splits clusters into partitions that can be linked independently
+
+        :param days_leniency: If given, the clusters of each disaster type are also split where the next cluster
+            starts more than *days_leniency* days after the end of every cluster before it
+        :return: The partition of each cluster, numbered from 0 in order of disaster type and time
+        """
+        partition_ids = np.empty(len(disaster_codes), dtype=np.int64)
+        n_of_partitions = 0
+        for code in np.unique(disaster_codes):
+            members = np.flatnonzero(disaster_codes == code)
+            members = members[np.argsort(start_days[members], kind="stable")]
+            is_partition_start = np.zeros(len(members), dtype=bool)
+            is_partition_start[0] = True
+            if days_leniency is not None:
+                # Latest end of the clusters starting before each cluster
+                latest_ends = np.maximum.accumulate(end_days[members])
+                is_partition_start[1:] = start_days[members[1:]] > latest_ends[:-1] + days_leniency
+            partition_ids[members] = n_of_partitions + np.cumsum(is_partition_start) - 1
+            n_of_partitions += int(is_partition_start.sum())
+        return partition_ids
+
+    @classmethod
+    def link_new_clusters(cls,
+                          store: ClusterStore,
+                          new_cluster_ids: np.ndarray,
+                          days_leniency: int,
+                          debug_messages_on: bool = False,
+                          postal_index: PostalPrefixIndex | None = None) -> np.ndarray:
+        """Same as `link`, for a store in which only some clusters may be compatible with others, like a linked
+        store to which new rows have been appended. Mutates the store in-place
+
+        Only the clusters changed in the last round (at first, the new clusters) can be compatible with other
+        clusters, so each round only looks for pairs among them and the clusters of their disaster type whose time
+        frames are within the days leniency of theirs
+
+        :param new_cluster_ids: The clusters that may be compatible with other clusters
+        :return: The ids of the clusters containing the new clusters, in increasing order
+        """
+        changed_ids = np.unique(store.find(np.asarray(new_cluster_ids, dtype=np.int64)))
+        n_of_rounds = 0
+        while True:
+            n_of_rounds += 1
+            cluster_ids = store.get_cluster_ids()
+            is_near = np.isin(cluster_ids, changed_ids)
+            for code in np.unique(store.disaster_codes[changed_ids]):
+                changed = changed_ids[store.disaster_codes[changed_ids] == code]
+                changed = changed[np.argsort(store.start_days[changed], kind="stable")]
+                # Latest end of the changed clusters starting before the end (plus the leniency) of each cluster
+                latest_ends = np.maximum.accumulate(store.end_days[changed])
+                n_of_previous = np.searchsorted(store.start_days[changed],
+                                                store.end_days[cluster_ids] + days_leniency, side="right")
+                is_near |= ((store.disaster_codes[cluster_ids] == code) & (n_of_previous > 0)
+                            & (latest_ends[np.maximum(n_of_previous - 1, 0)] + days_leniency
+                               >= store.start_days[cluster_ids]))
+            n_of_joins = 0
+            for first, second in cls._find_store_pairs(store, days_leniency, postal_index, cluster_ids[is_near]):
+                n_of_joins += store.merge_pairs(first, second)
+            if debug_messages_on:
+                print(f"Round {n_of_rounds}: {len(changed_ids)} changed clusters, {is_near.sum()} near clusters, "
+                      f"{n_of_joins} joins")
+            changed_ids = np.unique(store.find(changed_ids))
+            if n_of_joins == 0:
+                return changed_ids
+
+    @classmethod
+    def sweep_leniency(cls,
+                       store: ClusterStore,
+                       leniencies: list[int],
+                       debug_messages_on: bool = False,
+                       postal_index: PostalPrefixIndex | None = None) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """Links the clusters of a store for several days leniencies in a single pass. Mutates the store in-place
+
+        Compatibility is monotone in the leniency, so the clusters for a leniency are unions of the clusters for
+        any lower leniency. The compatible pairs for the greatest leniency are found once and sorted by the
+        minimum leniency that makes them compatible (the days between their time frames), and are merged in that
+        order. After merging the pairs of each requested leniency, the clusters are completed with `link`, as the
+        time frames of merged clusters may have become compatible with other clusters
+
+        :param leniencies: The days leniencies to evaluate
+        :param postal_index: See `link`
+        :return: Two dataframes:
+            - The assignments: for each row of the store (indexed by its index in 'expedients') and each leniency
+              (a column), the id of its cluster. The id of a cluster is the index of its first row
+            - The merges, like a dendrogram: each row tells that the cluster 'merged' joined the cluster 'into'
+              (both identified by their first row when they merged) at a leniency of 'days_leniency'
+        """
+        leniencies = sorted(set(leniencies))
+        first, second, gaps = cls._find_pairs_by_leniency(store, leniencies[-1], postal_index)
+        store.merge_history = []
+        merges = []
+        assignments = {}
+
+        def record_merges(days_leniency: int) -> None:
+            for merged, into in store.merge_history:
+                merges.append(pd.DataFrame({"days_leniency": days_leniency,
+                                            "merged": store.row_indexes[merged],
+                                            "into": store.row_indexes[into]}))
+            store.merge_history.clear()
+
+        # Pairs are merged in batches of pairs needing the same leniency
+        gap_starts = np.flatnonzero(np.diff(gaps, prepend=-1)) if len(gaps) > 0 else np.empty(0, dtype=np.int64)
+        gap_ends = np.append(gap_starts[1:], len(gaps))
+        next_gap = 0
+        for days_leniency in leniencies:
+            while next_gap < len(gap_starts) and gaps[gap_starts[next_gap]] <= days_leniency:
+                batch = slice(gap_starts[next_gap], gap_ends[next_gap])
+                store.merge_pairs(first[batch], second[batch])
+                record_merges(int(gaps[gap_starts[next_gap]]))
+                next_gap += 1
+            cls.link(store, days_leniency, debug_messages_on, postal_index)
+            record_merges(days_leniency)
+            assignments[days_leniency] = store.row_indexes[store.find(np.arange(len(store)))]
+            if debug_messages_on:
+                print(f"Leniency {days_leniency}: {len(store.get_cluster_ids())} clusters")
+        store.merge_history = None
+
+        assignments = pd.DataFrame(assignments, index=pd.Index(store.row_indexes, name="row"))
+        assignments.columns.name = "days_leniency"
+        merges = (pd.concat(merges, ignore_index=True) if len(merges) > 0
+                  else pd.DataFrame({"days_leniency": [], "merged": [], "into": []}, dtype=np.int64))
+        return assignments, merges
+
+    @classmethod
+    def _find_pairs_by_leniency(cls,
+                                store: ClusterStore,
+                                max_days_leniency: int,
+                                postal_index: PostalPrefixIndex | None = None
+                                ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns the pairs of clusters compatible with a leniency of *max_days_leniency*, sorted by the minimum
+        leniency making them compatible, together with that leniency"""
+        firsts, seconds = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+        for first, second in cls._find_store_pairs(store, max_days_leniency, postal_index):
+            firsts.append(first)
+            seconds.append(second)
+        first, second = np.concatenate(firsts), np.concatenate(seconds)
+        gaps = np.maximum.reduce([store.start_days[second] - store.end_days[first],
+                                  store.start_days[first] - store.end_days[second],
+                                  np.zeros(len(first), dtype=np.int64)])
+        order = np.argsort(gaps, kind="stable")
+        return first[order], second[order], gaps[order]
+
+    @classmethod
+    def _find_store_pairs(cls,
+                          store: ClusterStore,
+                          days_leniency: int,
+                          postal_index: PostalPrefixIndex | None,
+                          cluster_ids: np.ndarray | None = None) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+        """Generator yielding, in batches, the ids of the pairs of compatible clusters of a store
+
+        Pairs may be repeated when a postal index is given
+
+        :param cluster_ids: Only look for pairs among these clusters (Default: all the clusters)
+        """
+        if cluster_ids is None:
+            cluster_ids = store.get_cluster_ids()
+        cluster_codes = store.disaster_codes[cluster_ids]
+        for code in np.unique(cluster_codes):
+            partition = cluster_ids[cluster_codes == code]
+            for first, second in cls.find_compatible_pairs(store.start_days[partition],
+                                                           store.end_days[partition],
+                                                           store.province_masks[partition],
+                                                           store.neighbourhood_masks[partition],
+                                                           days_leniency):
+                yield partition[first], partition[second]
+        if postal_index is None:
+            return
+        # Clusters sharing a postal prefix are found with another sweep over the (cluster, prefix) pairs,
+        # in which every pair with the same disaster type and prefix is adjacent. The groups of pairs with the
+        # same disaster type and prefix are shifted apart in time, so that they are swept at once
+        cluster_of_rows = store.find(np.arange(len(store)))
+        is_searched = np.isin(cluster_of_rows, cluster_ids)
+        cluster_keys = postal_index.get_cluster_keys(store.row_indexes[is_searched], cluster_of_rows[is_searched])
+        key_clusters = cluster_keys // postal_index.n_of_prefixes
+        key_groups = (store.disaster_codes[key_clusters] * postal_index.n_of_prefixes
+                      + cluster_keys % postal_index.n_of_prefixes)
+        group_ranks = np.unique(key_groups, return_inverse=True)[1]
+        group_shift = (store.end_days[cluster_ids].max() - store.start_days[cluster_ids].min() + days_leniency + 1
+                       if len(cluster_ids) > 0 else 0)
+        key_shifts = group_ranks * group_shift
+        same_masks = np.ones(len(cluster_keys), dtype=np.uint64)
+        for first, second in cls.find_compatible_pairs(store.start_days[key_clusters] + key_shifts,
+                                                       store.end_days[key_clusters] + key_shifts,
+                                                       same_masks,
+                                                       same_masks,
+                                                       days_leniency):
+            yield key_clusters[first], key_clusters[second]
+
+    @classmethod
+    def find_compatible_pairs(cls,
+                              start_days: np.ndarray,
+                              end_days: np.ndarray,
+                              provinces: np.ndarray,
+                              neighbourhoods: np.ndarray,
+                              days_leniency: int) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+        """Generator yielding, in batches, the pairs of compatible clusters of a single disaster type
+
+        :param provinces: Bitmask of the provinces of each cluster
+        :param neighbourhoods: Bitmask of the provinces adjacent to any province of each cluster
+        :return: Pairs of arrays (first, second) with the positions of each compatible pair of clusters
+        """
+        order = np.argsort(start_days, kind="stable")
+        sorted_starts = start_days[order]
+        sorted_ends = end_days[order]
+        # Every cluster starting between the start of a cluster and the end of its leniency window overlaps it
+        window_ends = np.searchsorted(sorted_starts, sorted_ends + days_leniency, side="right")
+        n_of_candidates = window_ends - np.arange(len(order)) - 1
+        total_candidates = np.concatenate([[0], np.cumsum(n_of_candidates)])
+
+        batch_start = 0
+        while batch_start < len(order):
+            batch_end = np.searchsorted(total_candidates, total_candidates[batch_start] + cls.MAX_PAIRS_PER_BATCH,
+                                        side="right") - 1
+            batch_end = max(batch_end, batch_start + 1)
+            counts = n_of_candidates[batch_start:batch_end]
+            first = np.repeat(np.arange(batch_start, batch_end), counts)
+            offsets = np.arange(len(first)) - np.repeat(np.cumsum(counts) - counts, counts)
+            second = first + 1 + offsets
+            first, second = order[first], order[second]
+            is_adjacent = (neighbourhoods[first] & provinces[second]) != 0
+            yield first[is_adjacent], second[is_adjacent]
+            batch_start = batch_end
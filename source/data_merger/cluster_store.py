@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import numpy as np
+
+from source.common.union_find import UnionFind
+
+
+class ClusterStore:
+    """Compact storage of a partition of the rows of the expedients into clusters
+
+    The clusters are stored as parallel numpy arrays instead of python objects. Each row starts as a cluster
+    of its own, and the id of a cluster is the id of its root row in the union-find structure. The aggregates
+    of a cluster (time frame, cost, claims, disaster type and province masks) are only kept up to date in its root,
+    and are updated in O(1) when two clusters are merged. The rows of each cluster are only listed when requested
+    """
+
+    def __init__(self,
+                 row_indexes: np.ndarray,
+                 start_days: np.ndarray,
+                 end_days: np.ndarray,
+                 total_costs: np.ndarray,
+                 claims: np.ndarray,
+                 disaster_codes: np.ndarray,
+                 province_masks: np.ndarray,
+                 neighbourhood_masks: np.ndarray):
+        """
+        :param row_indexes: Index in 'expedients' of each row of the store
+        :param start_days: Start of the time frame of each row, in days
+        :param end_days: End of the time frame of each row, in days
+        :param total_costs: Cost of each row. Missing costs count as 0
+        :param claims: Number of claims of each row
+        :param disaster_codes: Code of the disaster type of each row
+        :param province_masks: Bitmask of the province of each row
+        :param neighbourhood_masks: Bitmask of the closed neighbourhood of the province of each row
+        """
+        self.row_indexes = np.asarray(row_indexes, dtype=np.int64)
+        self.start_days = np.array(start_days, dtype=np.int64)
+        self.end_days = np.array(end_days, dtype=np.int64)
+        self.total_costs = np.nan_to_num(np.array(total_costs, dtype=float))
+        self.claims = np.array(claims, dtype=np.int64)
+        self.disaster_codes = np.array(disaster_codes, dtype=np.int64)
+        self.province_masks = np.array(province_masks, dtype=np.uint64)
+        self.neighbourhood_masks = np.array(neighbourhood_masks, dtype=np.uint64)
+        self.union_find = UnionFind(len(self.row_indexes))
+        # Rows sorted by cluster, computed when the members of the clusters are requested
+        self._members_order = None
+        self._members_offsets = None
+        # If it is a list, each merge appends to it a pair of arrays (merged clusters, clusters they merged into)
+        self.merge_history: list[tuple[np.ndarray, np.ndarray]] | None = None
+
+    # Arrays saved by `save`, besides the parents of the union-find structure
+    SAVED_ARRAYS = ["row_indexes", "start_days", "end_days", "total_costs", "claims",
+                    "disaster_codes", "province_masks", "neighbourhood_masks"]
+
+    def __len__(self):
+        """Number of rows in the store"""
+        return len(self.row_indexes)
+
+    def save(self, path: str) -> None:
+        """Saves the clusters and their aggregates as a .npz file"""
+        np.savez(path, parent=self.union_find.parent, **{name: getattr(self, name) for name in self.SAVED_ARRAYS})
+
+    @classmethod
+    def load(cls, path: str) -> ClusterStore:
+        """Loads a store saved with `save`"""
+        with np.load(path) as arrays:
+            store = ClusterStore(**{name: arrays[name] for name in cls.SAVED_ARRAYS})
+            store.union_find.parent = arrays["parent"].astype(np.int64)
+        return store
+
+    def append(self, other: ClusterStore) -> None:
+        """Appends the rows and clusters of another store. The ids of its clusters are shifted by len(self)"""
+        offset = len(self)
+        for name in self.SAVED_ARRAYS:
+            setattr(self, name, np.concatenate([getattr(self, name), getattr(other, name)]))
+        parent = np.concatenate([self.union_find.parent, other.union_find.parent + offset])
+        self.union_find = UnionFind(len(parent))
+        self.union_find.parent = parent
+        self._members_order = None
+
+    def set_row_labels(self,
+                       disaster_codes: np.ndarray,
+                       province_masks: np.ndarray,
+                       neighbourhood_masks: np.ndarray) -> None:
+        """Replaces the disaster code and the province masks of each row, and recomputes those of the clusters.
+        Used when the codes of the labels may have changed (see `LabelRegistry`), like in a loaded store"""
+        province_masks = np.asarray(province_masks, dtype=np.uint64)
+        neighbourhood_masks = np.asarray(neighbourhood_masks, dtype=np.uint64)
+        self.disaster_codes = np.array(disaster_codes, dtype=np.int64)
+        self.province_masks = province_masks.copy()
+        self.neighbourhood_masks = neighbourhood_masks.copy()
+        roots = self.find(np.arange(len(self)))
+        np.bitwise_or.at(self.province_masks, roots, province_masks)
+        np.bitwise_or.at(self.neighbourhood_masks, roots, neighbourhood_masks)
+
+    def find(self, cluster_ids: np.ndarray | int) -> np.ndarray | int:
+        """Returns the id of the cluster currently containing each row (or cluster) id"""
+        return self.union_find.find(cluster_ids)
+
+    def get_cluster_ids(self) -> np.ndarray:
+        """Returns the ids of the current clusters, in increasing order"""
+        return np.flatnonzero(self.union_find.parent == np.arange(len(self)))
+
+    def merge(self, a: int, b: int) -> int:
+        """Merges the clusters containing the rows *a* and *b*
+
+        :return: The id of the merged cluster
+        """
+        root_a, root_b = int(self.find(a)), int(self.find(b))
+        if root_a == root_b:
+            return root_a
+        low, high = min(root_a, root_b), max(root_a, root_b)
+        self.union_find.parent[high] = low
+        self._fold_into(np.array([low]), np.array([high]))
+        self._members_order = None
+        if self.merge_history is not None:
+            self.merge_history.append((np.array([high]), np.array([low])))
+        return low
+
+    def merge_pairs(self, first: np.ndarray, second: np.ndarray) -> int:
+        """Merges the clusters of each pair of rows (first[i], second[i]) at once
+
+        :return: The number of merges (the decrease in the number of clusters)
+        """
+        if len(first) == 0:
+            return 0
+        previous_roots = np.unique(np.concatenate([self.find(first), self.find(second)]))
+        n_of_merges = self.union_find.union(first, second)
+        if n_of_merges == 0:
+            return 0
+        # The aggregates of each root that got hooked are folded into the root of its new cluster
+        hooked_roots = previous_roots[self.union_find.parent[previous_roots] != previous_roots]
+        self._fold_into(self.union_find.parent[hooked_roots], hooked_roots)
+        self._members_order = None
+        if self.merge_history is not None:
+            self.merge_history.append((hooked_roots, self.union_find.parent[hooked_roots]))
+        return n_of_merges
+
+    def _fold_into(self, targets: np.ndarray, sources: np.ndarray) -> None:
+        np.minimum.at(self.start_days, targets, self.start_days[sources])
+        np.maximum.at(self.end_days, targets, self.end_days[sources])
+        np.add.at(self.total_costs, targets, self.total_costs[sources])
+        np.add.at(self.claims, targets, self.claims[sources])
+        np.bitwise_or.at(self.province_masks, targets, self.province_masks[sources])
+        np.bitwise_or.at(self.neighbourhood_masks, targets, self.neighbourhood_masks[sources])
+
+    def get_labels(self) -> np.ndarray:
+        """Returns the label of the cluster of each row, numbered from 0 in order of their first row"""
+        return self.union_find.get_labels()
+
+    def get_members(self, cluster_id: int) -> np.ndarray:
+        """Returns the indexes in 'expedients' of the rows of a cluster
+
+        The first call after a merge sorts the rows by cluster, the following calls are O(size of the cluster)
+        """
+        if self._members_order is None:
+            self.union_find.compress()
+            self._members_order = np.argsort(self.union_find.parent, kind="stable")
+            sorted_roots = self.union_find.parent[self._members_order]
+            self._members_offsets = np.searchsorted(sorted_roots, np.arange(len(self) + 1))
+        cluster_id = int(self.find(cluster_id))
+        start, end = self._members_offsets[cluster_id], self._members_offsets[cluster_id + 1]
+        return self.row_indexes[self._members_order[start:end]]
@@ -1,6 +1,20 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import numpy as np
-import datetime
+
+from source.common.frame_storage import (read_frame, read_frame_metadata, write_frame, get_frame_signature,
+                                        is_parquet_path, FrameWriter)
+from source.common.label_registry import LabelRegistry
+from source.common.postal_codes import union_postal_codes_by_group
+
+
+def alphabetical_order(column: pd.Series) -> pd.Series:
+    """Sort key ordering categorical labels alphabetically instead of by their code"""
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.cat.reorder_categories(sorted(column.cat.categories))
+    return column
 
 
 # A sligth modification of the script provided by matheus. Merges by disaster type, date and location
@@ -8,20 +22,289 @@ class ExpedientMerger:
 
     INPUT_PATH = "../../input-output/raw_expedients.csv"
     OUTPUT_PATH = "../../input-output/merged_expedients_1.csv"
+    # Last run of each province and disaster, used when merging new batches of expedients incrementally
+    STATE_PATH = "../../input-output/merged_expedients_1_state.parquet"
+
+    @classmethod
+    def merge_csv(cls, chunksize: int | None = None, sorted_by_date: bool = False, n_workers: int = 1):
+        """The input and output paths are defined as class attributes
+        The output format is chosen by the extension of the output path (see `common.frame_storage`)
+
+        :param chunksize: If provided, the input is streamed in chunks of *chunksize* rows
+            instead of being loaded at once (see `merge_csv_streaming`)
+        :param sorted_by_date: Only used when streaming. Whether the rows of the input are ordered by date
+        :param n_workers: Only used when not streaming. If greater than 1, the expedients are split by province
+            and disaster and merged in a pool of *n_workers* processes (see `merge_shards_in_parallel`)
+        """
+        if chunksize is not None:
+            df = cls.merge_csv_streaming(chunksize, sorted_by_date)
+        else:
+            # Importing the disaster data
+            disaster_df = cls.read_raw_expedients()
+            disaster_df = cls.clean_expedients(disaster_df)
+            if n_workers > 1:
+                df = cls.merge_shards_in_parallel(disaster_df, n_workers)
+            else:
+                df = cls._merge_shard(disaster_df)
+
+        write_frame(df, cls.OUTPUT_PATH)
+        print("INFO: Merge by disaster type and date completed succesfully")
+
+    @classmethod
+    def merge_csv_streaming(cls, chunksize: int, sorted_by_date: bool = False) -> pd.DataFrame:
+        """Merges the input file reading it in chunks of *chunksize* rows, so the raw expedients are never
+        fully loaded in memory. Only the daily totals (one row per date, disaster and province) are kept.
+
+        If the input is ordered by date, runs that can no longer be extended by later chunks are closed as soon
+        as possible and only the days of the still open runs are carried over to the next chunk.
+        Otherwise, all the daily totals are kept until the whole input has been read.
+
+        :param chunksize: Number of raw rows read at a time
+        :param sorted_by_date: Whether the rows of the input are ordered by date
+        :return: The merged dataframe, identical to the one produced by loading the whole input at once
+        """
+        reader = cls.read_raw_expedients(chunksize=chunksize)
+        closed_runs = []
+        # Daily totals not yet assigned to a closed run. Days split between chunks appear in several parts
+        open_parts = []
+        compacted_length = 0
+        for chunk in reader:
+            chunk_days = cls.aggregate_by_day(cls.clean_expedients(chunk))
+            open_parts.append(chunk_days)
+            # Re-aggregating the parts is postponed until they have doubled in size, to keep the cost linear
+            if not sorted_by_date and sum(len(part) for part in open_parts) < 2 * compacted_length + chunksize:
+                continue
+            open_days = cls._combine_daily_parts(open_parts)
+            open_parts = [open_days]
+            compacted_length = len(open_days)
+            if not sorted_by_date or len(chunk_days) == 0:
+                continue
+
+            # No later chunk can contain a day before the last day of this one, so a run ending before
+            # the day previous to it cannot be extended anymore
+            open_days = open_days.sort_values(by=['province', 'disaster', 'date'],
+                                              key=alphabetical_order).reset_index(drop=True)
+            run_ids = cls.label_runs(open_days)
+            run_end = open_days['date'].groupby(run_ids).transform('max')
+            is_closed = (run_end < chunk_days['date'].max() - pd.Timedelta(days=1)).to_numpy()
+            if is_closed.any():
+                closed_days = cls.round_daily_totals(open_days[is_closed].reset_index(drop=True))
+                closed_runs.append(cls.merge_consecutive_days(closed_days))
+                open_parts = [open_days[~is_closed].reset_index(drop=True)]
+
+        open_days = cls.round_daily_totals(cls._combine_daily_parts(open_parts))
+        if len(open_days) > 0:
+            open_days = open_days.sort_values(by=['province', 'disaster', 'date'],
+                                              key=alphabetical_order).reset_index(drop=True)
+            closed_runs.append(cls.merge_consecutive_days(open_days))
+        if len(closed_runs) == 0:
+            raise ValueError(f"No expedients were found in {cls.INPUT_PATH}")
+        return cls._concat_runs(closed_runs)
+
+    @classmethod
+    def merge_csv_incremental(cls) -> None:
+        """Merges a new batch of raw expedients into an already merged output, without reprocessing the history.
+        INPUT_PATH must only contain the new expedients, OUTPUT_PATH contains the merged history and is updated.
+
+        Only the last run of each province and disaster can still be extended. Those runs are kept at the end of the
+        output and persisted in STATE_PATH, together with the position of the output where they start. The new days
+        extend or join those runs or start new ones, and the output is truncated at that position and appended the
+        runs that can no longer be extended and the new last runs. The cost is proportional to the batch and to the
+        number of provinces and disasters, not to the history: csv outputs are truncated in place, and parquet
+        outputs are partitioned (see `FrameWriter`), so each batch adds a part with its closed runs and only the
+        part with the last runs is rewritten.
+
+        The first time (or if the output was written by something else, like `merge_csv`), the output is reordered
+        once to move the last runs to its end, and parquet outputs become a partitioned directory. So the rows of an
+        incrementally merged output are ordered by province, disaster and date only within the runs closed by each
+        batch and within the last runs
+
+        :except ValueError: If the batch contains days previous to the last run of their province and disaster.
+            Such batches require merging the whole history again with `merge_csv`
+        """
+        disaster_df = cls.read_raw_expedients()
+        new_days = cls.round_daily_totals(cls.aggregate_by_day(cls.clean_expedients(disaster_df)))
+        state, tail_position = cls.read_state()
+        if state is None:
+            state, tail_position = cls.move_last_runs_to_end()
+        state = state.astype({'province': str, 'disaster': str})
+
+        # Express the persisted runs and the new days as blocks of consecutive days
+        state_blocks = state.assign(start=state['date'] - pd.to_timedelta(state['duration'] - 1, unit='D'),
+                                    is_new=False)
+        new_blocks = new_days.assign(start=new_days['date'], duration=1, is_new=True)
+        too_old = new_blocks.merge(state_blocks[['province', 'disaster', 'start']], on=['province', 'disaster'],
+                                   suffixes=('', '_state'))
+        too_old = too_old[too_old['start'] < too_old['start_state']]
+        if len(too_old) > 0:
+            raise ValueError(f"{len(too_old)} new days are previous to the last run of their province and disaster; "
+                             f"the whole history must be merged again")
+        runs = cls.merge_overlapping_blocks(pd.concat([state_blocks, new_blocks], ignore_index=True))
+
+        # Replace the previous last runs with the runs that were closed and the new last runs
+        is_last_run = cls.find_last_runs(runs)
+        columns = list(state.columns)
+        last_runs = runs.loc[is_last_run, columns].reset_index(drop=True)
+        with FrameWriter(cls.OUTPUT_PATH, resume_from=tail_position,
+                         partitioned=is_parquet_path(cls.OUTPUT_PATH)) as writer:
+            writer.write(runs.loc[~is_last_run, columns])
+            tail_position = writer.tell()
+            writer.write(last_runs)
+        cls.write_state(last_runs, tail_position)
+        print(f"INFO: Incremental merge completed succesfully; {runs['is_new'].sum()} runs were added or updated")
+
+    @classmethod
+    def read_state(cls) -> tuple[pd.DataFrame | None, tuple[int, int] | None]:
+        """Returns the last runs persisted in STATE_PATH and the position of the output where they start,
+        or None twice if there is no state or the output was modified after it was saved"""
+        if not os.path.exists(cls.STATE_PATH) or not os.path.exists(cls.OUTPUT_PATH):
+            return None, None
+        metadata = read_frame_metadata(cls.STATE_PATH)
+        if metadata is None or metadata.get("output_signature") != get_frame_signature(cls.OUTPUT_PATH):
+            return None, None
+        return read_frame(cls.STATE_PATH), tuple(metadata["tail_position"])
+
+    @classmethod
+    def write_state(cls, last_runs: pd.DataFrame, tail_position: tuple[int, int]) -> None:
+        """Persists the last runs at the end of the output in STATE_PATH, together with the position where they start
+        and the sizes and modification times of the output files, to detect modifications done by other steps"""
+        write_frame(last_runs, cls.STATE_PATH, metadata={"tail_position": list(tail_position),
+                                                         "output_signature": get_frame_signature(cls.OUTPUT_PATH)})
+
+    @classmethod
+    def move_last_runs_to_end(cls) -> tuple[pd.DataFrame, tuple[int, int]]:
+        """Rewrites the output with the last run of each province and disaster at its end
+
+        :return: The last runs and the position of the output where they start
+        """
+        merged_df = read_frame(cls.OUTPUT_PATH).astype({'province': str, 'disaster': str})
+        merged_df = merged_df.sort_values(by=['province', 'disaster', 'date']).reset_index(drop=True)
+        is_last_run = cls.find_last_runs(merged_df)
+        last_runs = merged_df[is_last_run].reset_index(drop=True)
+        with FrameWriter(cls.OUTPUT_PATH, partitioned=is_parquet_path(cls.OUTPUT_PATH)) as writer:
+            writer.write(merged_df[~is_last_run])
+            tail_position = writer.tell()
+            writer.write(last_runs)
+        return last_runs, tail_position
+
+    @staticmethod
+    def find_last_runs(runs: pd.DataFrame) -> np.ndarray:
+        """Returns whether each run is the last one of its province and disaster
+
+        :param runs: Dataframe of runs sorted by province, disaster and date
+        """
+        return (runs['province'].ne(runs['province'].shift(-1))
+                | runs['disaster'].ne(runs['disaster'].shift(-1))).to_numpy()
+
+    @staticmethod
+    def merge_overlapping_blocks(blocks: pd.DataFrame) -> pd.DataFrame:
+        """Merges blocks of consecutive days (each one a row with a `start` and a last `date`) that overlap or touch,
+        in the same way `merge_consecutive_days` merges single days.
+
+        Besides the merged columns, each resulting row reports whether it contains a new block (`is_new`),
+        whether it contains a block that was not new (`has_old_block`) and the last date of that block (`old_date`)
+        """
+        blocks = blocks.sort_values(by=['province', 'disaster', 'start', 'date'],
+                                    key=alphabetical_order).reset_index(drop=True)
+        starts_group = (blocks['province'].ne(blocks['province'].shift())
+                        | blocks['disaster'].ne(blocks['disaster'].shift())).to_numpy()
+        group_ids = np.cumsum(starts_group)
+        reach = blocks['date'].groupby(group_ids).cummax().shift()
+        breaks_run = (blocks['start'] > reach + pd.Timedelta(days=1)).to_numpy()
+        run_ids = np.cumsum(starts_group | breaks_run) - 1
+
+        runs = blocks.assign(old_date=blocks['date'].where(~blocks['is_new'])).groupby(run_ids, sort=False).agg(
+            date=('date', 'max'),
+            disaster=('disaster', 'first'),
+            province=('province', 'first'),
+            total_cost=('total_cost', 'sum'),
+            claims=('claims', 'sum'),
+            start=('start', 'min'),
+            is_new=('is_new', 'any'),
+            old_date=('old_date', 'max'))
+        runs['has_old_block'] = runs['old_date'].notnull()
+        runs['postal_codes'] = union_postal_codes_by_group(blocks['postal_codes'], run_ids, len(runs))
+        runs['duration'] = (runs['date'] - runs['start']).dt.days + 1
+        runs['losses_day'] = runs['total_cost'] / runs['duration']
+        return runs.reset_index(drop=True)
+
+    @classmethod
+    def merge_shards_in_parallel(cls, disaster_df: pd.DataFrame, n_workers: int) -> pd.DataFrame:
+        """Merges the cleaned expedients using a pool of processes.
+
+        Runs never span more than one province and disaster, so the expedients are split into *n_workers* shards
+        containing whole (province, disaster) groups, balanced by number of expedients.
+        The result doesn't depend on the number of workers
+
+        :param disaster_df: Expedients, as returned by `clean_expedients`
+        :param n_workers: Number of processes (and shards) to use
+        """
+        group_ids = disaster_df.groupby(['province', 'disaster'], sort=True, observed=True).ngroup().to_numpy()
+        group_sizes = np.bincount(group_ids)
+        # Assign the largest groups first, each one to the least loaded shard
+        shard_of_group = np.empty(len(group_sizes), dtype=int)
+        shard_loads = np.zeros(n_workers, dtype=int)
+        for group in np.argsort(-group_sizes, kind='stable'):
+            shard = int(np.argmin(shard_loads))
+            shard_of_group[group] = shard
+            shard_loads[shard] += group_sizes[group]
+        shard_ids = shard_of_group[group_ids]
+        shards = [disaster_df[shard_ids == shard] for shard in range(n_workers) if shard_loads[shard] > 0]
+
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            merged_shards = list(executor.map(cls._merge_shard, shards))
+        return cls._concat_runs(merged_shards)
+
+    @classmethod
+    def _merge_shard(cls, disaster_df: pd.DataFrame) -> pd.DataFrame:
+        """Aggregates cleaned expedients by day and merges the runs of consecutive days"""
+        df = cls.aggregate_by_day(disaster_df)
+        df = cls.round_daily_totals(df)
+
+        # Sort the dataframe by province, disaster, and date to prepare for duration calculation
+        df = df.sort_values(by=['province', 'disaster', 'date'],
+                            key=alphabetical_order).reset_index(drop=True)
+
+        # Convert the 'date' column to datetime format
+        df['date'] = pd.to_datetime(df['date'], errors='raise')
+
+        # Collapse each run of consecutive days into a single row
+        return cls.merge_consecutive_days(df)
+
+    @staticmethod
+    def _concat_runs(run_dfs: list[pd.DataFrame]) -> pd.DataFrame:
+        """Joins several dataframes of merged runs covering different days, ordered as if they were merged at once"""
+        df = pd.concat(run_dfs).sort_values(by=['province', 'disaster', 'date'], key=alphabetical_order)
+        # Every day belongs to exactly one run, so the index of the last day of each run can be recovered
+        df.index = (df['duration'].cumsum() - 1).rename(None)
+        return df
+
+    @staticmethod
+    def _combine_daily_parts(parts: list[pd.DataFrame]) -> pd.DataFrame:
+        """Adds up several dataframes of daily totals into one with a single row per date, disaster and province"""
+        if len(parts) == 1:
+            return parts[0]
+        daily_df = pd.concat(parts, ignore_index=True)
+        return ExpedientMerger._group_by_day(daily_df, {"total_cost": "sum", "claims": "sum"})
 
     @classmethod
-    def merge_csv(cls):
-        """The input and output paths are defined as class attributes"""
-        # Importing the disaster data
-        disaster_df = pd.read_csv(filepath_or_buffer=cls.INPUT_PATH,
-                                  sep=";",
-                                  converters={" COSTE TOTAL ": lambda x: x.replace(".", "")},
-                                  encoding='utf-8')
+    def read_raw_expedients(cls, chunksize: int | None = None):
+        """Reads the raw expedients found in INPUT_PATH. Labels are read as categories, so they are parsed only once
+
+        :param chunksize: If provided, returns an iterator of chunks of *chunksize* rows instead of a dataframe"""
+        return pd.read_csv(filepath_or_buffer=cls.INPUT_PATH,
+                           sep=";",
+                           converters={" COSTE TOTAL ": lambda x: x.replace(".", "")},
+                           dtype={"PROVINCIA": "category", "CAUSA SINIESTRO": "category"},
+                           encoding='utf-8',
+                           chunksize=chunksize)
 
+    @staticmethod
+    def clean_expedients(disaster_df: pd.DataFrame) -> pd.DataFrame:
+        """Drops the unnecessary columns of the raw expedients and normalizes the remaining ones"""
         # Dropping unnecessary columns and adjusting the data
-        disaster_df.drop(
-            columns=['ID RMC', 'ID CAUSA SINIESTRO', 'MUNICIPIO', 'POBLACION', 'CLASE RIESGO N1', 'CLASE RIESGO N2'],
-            inplace=True
+        disaster_df = disaster_df.drop(
+            columns=['ID RMC', 'ID CAUSA SINIESTRO', 'MUNICIPIO', 'POBLACION', 'CLASE RIESGO N1', 'CLASE RIESGO N2']
         )
 
         # Renaming Remaining Collumns for conviniency
@@ -32,104 +315,79 @@ class ExpedientMerger:
                                     "CODIGO POSTAL": "postal_codes"},
                            inplace=True)
 
-        # Replacing specific province names for consistency
         disaster_df['date'] = pd.to_datetime(disaster_df['date'], dayfirst=True)
-        disaster_df = disaster_df.replace({'province': {'Alicante/Alacant': 'Alicante',
-                                                  'Araba/Álava': 'Araba',
-                                                  'Balears, Illes': 'Illes Balears',
-                                                  'Coruña, A': 'A Coruña',
-                                                  'Rioja, La': 'La Rioja',
-                                                  'Palmas, Las': 'Las Palmas',
-                                                  'Castellón/Castelló': 'Castellón',
-                                                  'Valencia/València': 'Valencia'}})
-        disaster_df['province'] = disaster_df['province'].str.normalize('NFKD').str.encode('ascii', errors='ignore').str.decode(
-            'utf-8')
+        # Normalizing each distinct province name and disaster type once and encoding them as categories
+        disaster_df['province'] = LabelRegistry.encode_provinces(disaster_df['province'])
+        disaster_df['disaster'] = LabelRegistry.encode_disasters(disaster_df['disaster'])
         disaster_df['claims'] = 0
         disaster_df["total_cost"] = pd.to_numeric(disaster_df["total_cost"], errors="coerce")
+        return disaster_df
 
-        # Transform the postal code column type from int to list
-        disaster_df["postal_codes"] = disaster_df["postal_codes"].apply(lambda x: [x])
+    @staticmethod
+    def aggregate_by_day(disaster_df: pd.DataFrame) -> pd.DataFrame:
+        """Groups the cleaned expedients by date, disaster and province, adding up their cost and claims
+        and joining their postal codes"""
+        return ExpedientMerger._group_by_day(disaster_df, {"total_cost": "sum", "claims": "count"})
 
-        aggregation_dict = {"total_cost": "sum", "claims": "count"}
+    @staticmethod
+    def _group_by_day(disaster_df: pd.DataFrame, aggregation_dict: dict[str, str]) -> pd.DataFrame:
+        """Groups a dataframe by date, disaster and province, applying the aggregation dictionary
+        and joining the postal codes of each group into a single set"""
+        grouped = disaster_df.groupby(['date', 'disaster', 'province'], observed=True)
+        daily_df = grouped.agg(aggregation_dict).reset_index()
+        group_ids = grouped.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+        daily_df['postal_codes'] = union_postal_codes_by_group(disaster_df['postal_codes'], group_ids, len(daily_df))
+        return daily_df
 
-        # Adding sum aggregation for all other columns except date, disaster, province, total_cost, and claims
-        for col in disaster_df.columns:
-            if col not in ['date', 'disaster', 'province', 'total_cost', 'claims']:
-                aggregation_dict[col] = 'sum'
-
-        # Grouping the dataframe by date, disaster, and province, and applying the aggregation dictionary
-        disaster_df = disaster_df.groupby(['date', 'disaster', 'province']).agg(aggregation_dict).reset_index()
+    @staticmethod
+    def round_daily_totals(disaster_df: pd.DataFrame) -> pd.DataFrame:
+        """Drops the days without a known cost and rounds the totals. Must only be applied to complete days"""
         disaster_df = disaster_df[disaster_df["total_cost"].notnull()]
-        disaster_df = disaster_df.round(2).reset_index(drop=True)
-        df = disaster_df
+        return disaster_df.round(2).reset_index(drop=True)
 
-        # Sort the dataframe by province, disaster, and date to prepare for duration calculation
-        df = df.sort_values(by=['province', 'disaster', 'date']).reset_index(drop=True)
+    @staticmethod
+    def label_runs(df: pd.DataFrame) -> np.ndarray:
+        """Assigns a run id to each row of a daily dataframe
+        A run is a maximal sequence of consecutive days of the same disaster in the same province.
+        Unlike the original row loop, which only compared the dates of consecutive rows, a run never continues into
+        another province or disaster (eg: Madrid on the 5th followed by Sevilla on the 6th are two runs)
 
-        # Convert the 'date' column to datetime format
-        df['date'] = pd.to_datetime(df['date'], errors='raise')
+        :param df: Dataframe with one row per date, disaster and province, sorted by province, disaster and date
+        :return: An array of run ids, increasing from 0 and contiguous along the rows"""
+        starts_group = (df['province'].ne(df['province'].shift())
+                        | df['disaster'].ne(df['disaster'].shift())).to_numpy()
+        # Dates are unique inside each group, so a difference other than 1 day always breaks the run
+        breaks_run = df['date'].diff().dt.days.ne(1).to_numpy()
+        return np.cumsum(starts_group | breaks_run) - 1
 
-        # Calculate the difference in days between consecutive rows
-        df['dif'] = df['date'].diff().dt.days
+    @staticmethod
+    def merge_consecutive_days(df: pd.DataFrame) -> pd.DataFrame:
+        """Collapses each run of consecutive days into a single row, using grouped operations instead of row loops
 
-        # Replace 0s in 'dif' with 1 to ensure at least a one-day duration
-        df['dif'] = df['dif'].replace(0, 1)
+        Each resulting row keeps the date of the last day of its run and the index of that day in *df*.
+        The cost and claims are summed, the sets of postal codes are joined
+        and `duration` and `losses_day` are added as new columns.
+        Runs are split by province and disaster (see `label_runs`), and `losses_day` is always a float column
+        (the original loop stored the integer cost of single-day runs in a column of mixed types)
 
-        # Add a 'notes' column initialized with empty strings
-        df['notes'] = ''
+        :param df: Dataframe with one row per date, disaster and province, sorted by province, disaster and date,
+            with a default RangeIndex
+        """
+        if len(df) == 0:
+            return df.assign(duration=pd.Series(dtype=int), losses_day=pd.Series(dtype=float))
+        run_ids = ExpedientMerger.label_runs(df)
+        bounds = np.flatnonzero(np.diff(run_ids, append=run_ids[-1] + 1))
+        runs = df.groupby(run_ids, sort=False).agg(date=('date', 'last'),
+                                                   disaster=('disaster', 'first'),
+                                                   province=('province', 'first'),
+                                                   total_cost=('total_cost', 'sum'),
+                                                   claims=('claims', 'sum'),
+                                                   duration=('date', 'size'))
 
-        # Define a function to mark the start ('Min') and end ('Max') of each event duration
-        def my_func(x):
-            a = df[x:][df.loc[x:, 'dif'] != 1]
-            if len(a) > 0:
-                df.loc[[x - 1, a.index[0] - 1], 'notes'] = ['Min', 'Max']
-                df.loc[x - 1: a.index[0] - 1, 'dif'] = 1
-            else:
-                df.loc[[x - 1, len(df) - 1], 'notes'] = ['Min', 'Max']
-                df.loc[x - 1: len(df) - 1, 'dif'] = 1
-
-        # Apply the function to mark 'Min' and 'Max' notes for each event duration
-        [my_func(i) for i in range(1, len(df)) if df.loc[i - 1, 'dif'] != df.loc[i, 'dif'] and df.loc[i, 'dif'] == 1]
-
-        # Mark rows with a single date as 'Singledate' in the 'notes' column
-        df.loc[df[df['dif'] != 1].index, 'notes'] = 'Singledate'
-
-        df['duration'] = ''
-        df['losses_day'] = ''
-        count = total_cost = claims = 0
-        postal_codes = []
-
-        # Iterate over each row to calculate duration, total cost, and daily losses
-        for i in range(0, len(df)):
-            if df.loc[i, 'notes'] == 'Min' or df.loc[i, 'notes'] == '':
-                count = count + 1
-                total_cost = total_cost + df.loc[i, 'total_cost']
-                claims = claims + df.loc[i, 'claims']
-                postal_codes = postal_codes + df.loc[i, 'postal_codes']
-
-            elif df.loc[i, 'notes'] == 'Max':
-                count = count + 1
-                total_cost = total_cost + df.loc[i, 'total_cost']
-                claims = claims + df.loc[i, 'claims']
-                postal_codes = postal_codes + df.loc[i, 'postal_codes']
-
-                df.at[i, 'duration'] = count
-                df.at[i, 'total_cost'] = total_cost
-                df.at[i, 'claims'] = claims
-                df.at[i, 'postal_codes'] = list(set(postal_codes)) #To remove duplicates
-                df.at[i, 'losses_day'] = total_cost / count
-                count = total_cost = claims = 0
-                postal_codes = []
-            else:
-                count = 0
-                df.at[i, 'duration'] = 1
-                df.at[i, 'losses_day'] = df.loc[i, 'total_cost']
-
-        df = df.loc[df['duration'] != '']
-        df = df.drop(columns=['dif', 'notes'])
-
-        df.to_csv(cls.OUTPUT_PATH)
-        print("INFO: Merge by disaster type and date completed succesfully")
+        runs.insert(5, 'postal_codes', union_postal_codes_by_group(df['postal_codes'], run_ids, len(runs)))
+        runs['losses_day'] = runs['total_cost'] / runs['duration']
+        runs.index = bounds
+        return runs
 
 
 if __name__ == '__main__':
@@ -1,6 +1,59 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import re
 from typing import Callable
+import numpy as np
 import pandas as pd
 
+from source.common.frame_storage import read_frame, write_frame, iter_frame_chunks, get_frame_columns, FrameWriter
+from source.common.quantile_sketch import KLLSketch
+
+
+class CullingCriterion:
+    """A culling rule: the rows whose key falls in the lower *lower_n_cuts* of *total_q* qcuts are culled"""
+
+    def __init__(self,
+                 key: str | Callable[[pd.DataFrame], pd.Series],
+                 total_q: int,
+                 lower_n_cuts: int):
+        """
+        :param key: Either the name of a column, an expression of columns understood by `DataFrame.eval`
+            (eg: "total_cost / claims"), or a callable returning a Series from the dataframe
+        :param total_q: Total number of partitions (qcuts)
+        :param lower_n_cuts: Number of lower partitions to be culled
+        """
+        if lower_n_cuts > total_q:
+            raise ValueError(f"Cannot cull {lower_n_cuts} qcuts out of {total_q}")
+        self.key = key
+        self.total_q = total_q
+        self.lower_n_cuts = lower_n_cuts
+
+    def get_keys(self, df: pd.DataFrame) -> np.ndarray:
+        """Returns the key of each row of the dataframe as a float array"""
+        if callable(self.key):
+            keys = self.key(df)
+        elif self.key in df.columns:
+            keys = df[self.key]
+        else:
+            keys = df.eval(self.key)
+        return np.asarray(keys, dtype=float)
+
+    def get_columns(self, columns: list[str]) -> list[str] | None:
+        """Returns the columns out of *columns* that the key reads, or None if the key is a callable
+        (which may read any column)"""
+        if callable(self.key):
+            return None
+        if self.key in columns:
+            return [self.key]
+        names = set(re.findall(r"[A-Za-z_]\w*", self.key))
+        return [col for col in columns if col in names]
+
+    def get_quantile(self) -> float:
+        """Returns the quantile at the upper edge of the culled qcuts, computed like `pd.qcut` computes its edges"""
+        return np.linspace(0, 1, self.total_q + 1)[self.lower_n_cuts]
+
+    def __repr__(self):
+        return f"<CullingCriterion: lower {self.lower_n_cuts}/{self.total_q} of {self.key}>"
+
 
 # Second step of the merging of disasters. Contains filters, methods to discard unwanted expedients, etc...
 class QuartileCuller:
@@ -25,7 +78,9 @@ class QuartileCuller:
         except ValueError as e:
             print(f"The data in the dataframe is not spread enough to make {total_q} qcuts")
             raise e
-        result = pd.Series.apply(self=qcuts, func=lambda qcut: qcut in label_lower)
+        # Missing keys have no qcut (code -1) and are never in the lower qcuts
+        codes = qcuts.cat.codes
+        result = (codes >= 0) & (codes < len(label_lower))
         return result
 
     @staticmethod
@@ -51,12 +106,204 @@ class QuartileCuller:
             new_df.reset_index(drop=True, inplace=True)
             return new_df
 
+    @staticmethod
+    def find_culled_rows(df: pd.DataFrame,
+                         criteria: list[CullingCriterion],
+                         combination: str = "or") -> np.ndarray:
+        """Evaluates several culling criteria at once, without building intermediate dataframes
+
+        The keys of all the criteria are gathered in a single array and compared against the upper edge of their
+        culled qcuts. A row is in the lower qcuts of a criterion exactly when `drop_lower_qcuts` would remove it,
+        but repeated edges don't raise an exception. Missing keys are never culled.
+
+        :param df: Target DataFrame
+        :param criteria: The criteria to evaluate
+        :param combination: "or" culls the rows culled by any criterion, "and" culls the rows culled by all of them
+        :return: A boolean array. True means the correspondent row is culled
+        """
+        if len(criteria) == 0:
+            return np.zeros(len(df), dtype=bool)
+        keys = QuartileCuller._get_criteria_keys(df, criteria)
+        thresholds = np.full(len(criteria), -np.inf)
+        for i, criterion in enumerate(criteria):
+            if criterion.lower_n_cuts > 0 and not np.isnan(keys[:, i]).all():
+                thresholds[i] = np.nanquantile(keys[:, i], criterion.get_quantile())
+        return QuartileCuller._combine_thresholds(keys, thresholds, combination)
+
+    @staticmethod
+    def find_culled_rows_by_group(df: pd.DataFrame,
+                                  criteria: list[CullingCriterion],
+                                  group_by: str | list[str],
+                                  combination: str = "or",
+                                  min_group_size: int | None = None) -> np.ndarray:
+        """Evaluates several culling criteria inside groups of rows (eg: per disaster type, per province or both),
+        so each group is culled according to its own distribution of keys
+
+        The thresholds of all the groups are computed at once with a grouped quantile per criterion.
+        Groups with fewer than *min_group_size* known keys for a criterion cannot be split into its qcuts,
+        so they fall back to the threshold of the whole dataframe instead of raising an exception
+
+        :param df: Target DataFrame
+        :param criteria: The criteria to evaluate
+        :param group_by: Column or columns defining the groups (eg: ["disaster", "province"])
+        :param combination: "or" culls the rows culled by any criterion, "and" culls the rows culled by all of them
+        :param min_group_size: Minimum number of known keys of a group to use its own threshold
+            (Default: the total number of qcuts of each criterion)
+        :return: A boolean array. True means the correspondent row is culled
+        """
+        if len(criteria) == 0:
+            return np.zeros(len(df), dtype=bool)
+        keys = QuartileCuller._get_criteria_keys(df, criteria)
+        group_ids = df.groupby(group_by, observed=True, sort=False, dropna=False).ngroup().to_numpy()
+        thresholds = np.full(keys.shape, -np.inf)
+        for i, criterion in enumerate(criteria):
+            if criterion.lower_n_cuts == 0 or np.isnan(keys[:, i]).all():
+                continue
+            q = criterion.get_quantile()
+            grouped_keys = pd.Series(keys[:, i]).groupby(group_ids)
+            group_thresholds = grouped_keys.quantile(q).to_numpy()
+            group_sizes = grouped_keys.count().to_numpy()
+            min_size = criterion.total_q if min_group_size is None else min_group_size
+            is_small = group_sizes < max(min_size, 1)
+            group_thresholds[is_small] = np.nanquantile(keys[:, i], q)
+            thresholds[:, i] = group_thresholds[group_ids]
+        return QuartileCuller._combine_thresholds(keys, thresholds, combination)
+
+    @staticmethod
+    def _get_criteria_keys(df: pd.DataFrame, criteria: list[CullingCriterion]) -> np.ndarray:
+        """Returns a 2d array with a row per row of the dataframe and a column per criterion"""
+        return np.column_stack([criterion.get_keys(df) for criterion in criteria]).reshape(len(df), len(criteria))
+
+    @staticmethod
+    def _combine_thresholds(keys: np.ndarray, thresholds: np.ndarray, combination: str) -> np.ndarray:
+        """Culls the keys under the threshold of their criterion, and combines the criteria of each row"""
+        if combination not in ("or", "and"):
+            raise ValueError(f"Unknown combination '{combination}', expected 'or' or 'and'")
+        # NaN keys compare as False, so they are never culled
+        is_lower = keys <= thresholds
+        if combination == "or":
+            return is_lower.any(axis=1)
+        return is_lower.all(axis=1)
+
+    @staticmethod
+    def drop_culled_rows(df: pd.DataFrame,
+                         criteria: list[CullingCriterion],
+                         combination: str = "or") -> pd.DataFrame:
+        """Removes the rows culled by a list of criteria (see `find_culled_rows`). Returns a new dataframe"""
+        is_culled = QuartileCuller.find_culled_rows(df, criteria, combination)
+        return df[~is_culled].reset_index(drop=True)
+
+    @staticmethod
+    def drop_culled_rows_by_group(df: pd.DataFrame,
+                                  criteria: list[CullingCriterion],
+                                  group_by: str | list[str],
+                                  combination: str = "or",
+                                  min_group_size: int | None = None) -> pd.DataFrame:
+        """Removes the rows culled by a list of criteria inside their groups (see `find_culled_rows_by_group`).
+        Returns a new dataframe"""
+        is_culled = QuartileCuller.find_culled_rows_by_group(df, criteria, group_by, combination, min_group_size)
+        return df[~is_culled].reset_index(drop=True)
+
+    @classmethod
+    def sketch_file(cls,
+                    criteria: list[CullingCriterion],
+                    chunksize: int = 100000,
+                    error: float = 0.01,
+                    n_workers: int = 1) -> list[KLLSketch]:
+        """Reads INPUT_PATH in chunks and builds a quantile sketch of the keys of each criterion
+
+        :param error: Approximate rank error of the sketches (see `KLLSketch`)
+        :param n_workers: If greater than 1, the chunks are sketched in a pool of processes and the sketches merged.
+            The keys of the criteria must then be column names or expressions, as lambdas cannot be sent to a process
+        :return: A sketch per criterion
+        """
+        k = KLLSketch.k_for_error(error)
+        sketches = [KLLSketch(k) for _ in criteria]
+        chunks = iter_frame_chunks(cls.INPUT_PATH, chunksize, cls._get_criteria_columns(criteria))
+        if n_workers > 1:
+            # Only a window of chunks is in flight at a time, so the file is never held in memory
+            max_in_flight = 2 * n_workers
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                in_flight = set()
+                for chunk in chunks:
+                    in_flight.add(executor.submit(cls._sketch_chunk, chunk, criteria, k))
+                    if len(in_flight) >= max_in_flight:
+                        finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        cls._merge_chunk_sketches(sketches, finished)
+                cls._merge_chunk_sketches(sketches, wait(in_flight).done)
+        else:
+            for chunk in chunks:
+                keys = cls._get_criteria_keys(chunk, criteria)
+                for i, sketch in enumerate(sketches):
+                    sketch.update(keys[:, i])
+        return sketches
+
+    @staticmethod
+    def _merge_chunk_sketches(sketches: list[KLLSketch], finished_futures) -> None:
+        for future in finished_futures:
+            for sketch, other in zip(sketches, future.result()):
+                sketch.merge(other)
+
+    @classmethod
+    def _get_criteria_columns(cls, criteria: list[CullingCriterion]) -> list[str] | None:
+        """Returns the columns of INPUT_PATH read by the criteria, or None if any of them needs every column"""
+        columns = get_frame_columns(cls.INPUT_PATH)
+        used_columns = set()
+        for criterion in criteria:
+            criterion_columns = criterion.get_columns(columns)
+            if criterion_columns is None:
+                return None
+            used_columns.update(criterion_columns)
+        if len(used_columns) == 0:
+            return None
+        return [col for col in columns if col in used_columns]
+
+    @staticmethod
+    def _sketch_chunk(chunk: pd.DataFrame, criteria: list[CullingCriterion], k: int) -> list[KLLSketch]:
+        keys = QuartileCuller._get_criteria_keys(chunk, criteria)
+        sketches = [KLLSketch(k) for _ in criteria]
+        for i, sketch in enumerate(sketches):
+            sketch.update(keys[:, i])
+        return sketches
+
+    @classmethod
+    def apply_cull_file_streaming(cls,
+                                  criteria: list[CullingCriterion],
+                                  combination: str = "or",
+                                  chunksize: int = 100000,
+                                  error: float = 0.01,
+                                  n_workers: int = 1) -> None:
+        """Culls INPUT_PATH into OUTPUT_PATH without loading the whole file in memory
+
+        A first pass over the chunks of the input builds a quantile sketch per criterion (see `sketch_file`),
+        and a second pass culls each chunk with the approximate thresholds taken from the sketches.
+        The result approximates `drop_culled_rows`: rows whose rank is within *error* of a threshold may be
+        kept or culled differently
+
+        :param criteria: The criteria to evaluate (see `find_culled_rows`)
+        :param combination: "or" culls the rows culled by any criterion, "and" culls the rows culled by all of them
+        :param chunksize: Number of rows read at a time
+        :param error: Approximate rank error of the sketches
+        :param n_workers: Number of processes used to build the sketches
+        """
+        sketches = cls.sketch_file(criteria, chunksize, error, n_workers)
+        thresholds = np.full(len(criteria), -np.inf)
+        for i, (criterion, sketch) in enumerate(zip(criteria, sketches)):
+            if criterion.lower_n_cuts > 0 and len(sketch) > 0:
+                thresholds[i] = sketch.quantile(criterion.get_quantile())
+
+        with FrameWriter(cls.OUTPUT_PATH) as writer:
+            for chunk in iter_frame_chunks(cls.INPUT_PATH, chunksize):
+                is_culled = cls._combine_thresholds(cls._get_criteria_keys(chunk, criteria), thresholds, combination)
+                writer.write(chunk[~is_culled])
+
     @classmethod
     def apply_cull_csv_file(cls, culler: Callable[[pd.DataFrame], pd.DataFrame]) -> None:
-        """The input and output paths are defined as class attributes"""
-        starting_df = pd.read_csv(cls.INPUT_PATH)
+        """The input and output paths are defined as class attributes
+        The formats are chosen by the extension of the paths (see `common.frame_storage`)"""
+        starting_df = read_frame(cls.INPUT_PATH)
         culled_df = culler(starting_df)
-        culled_df.to_csv(cls.OUTPUT_PATH)
+        write_frame(culled_df, cls.OUTPUT_PATH)
 
 
 def index_key(column: str, df: pd.DataFrame) -> pd.Series:
@@ -66,12 +313,11 @@ def index_key(column: str, df: pd.DataFrame) -> pd.Series:
 
 def losses_per_claim_key(df: pd.DataFrame) -> pd.Series:
     """Returns a series of keys corresponding to the ratio of losses per claim row"""
-    return df.apply(lambda row: row["total_cost"] / row["claims"], axis=1)
+    return df["total_cost"] / df["claims"]
 
 
 if __name__ == '__main__':
-    og_df = pd.read_csv("../../input-output/merged_expedients_1.csv")
-    og_df.drop(columns=["Unnamed: 0"], inplace=True)
+    og_df = read_frame("../../input-output/merged_expedients_1.csv")
     number_of_qcuts = 10
     drop_lower_n = 2
     df_filtering_by_total_cost = QuartileCuller.drop_lower_qcuts(df=og_df,
@@ -97,4 +343,15 @@ if __name__ == '__main__':
     print(og_df.sort_values(by="total_cost"))
     print(og_df.shape)
     print(df_filtering_by_total_cost.sort_values(by="total_cost"))
-    print(df_filtering_by_total_cost.shape)
\ No newline at end of file
+    print(df_filtering_by_total_cost.shape)
+    # The same criteria evaluated at once, culling the rows that any of them would remove
+    all_criteria = [CullingCriterion("total_cost", number_of_qcuts, drop_lower_n),
+                    CullingCriterion("losses_day", number_of_qcuts, drop_lower_n),
+                    CullingCriterion("claims", 2, 1),
+                    CullingCriterion("total_cost / claims", number_of_qcuts, drop_lower_n)]
+    df_filtering_by_all = QuartileCuller.drop_culled_rows(df=og_df, criteria=all_criteria, combination="or")
+    print(df_filtering_by_all.shape)
+    # The same criteria, with the qcuts computed separately for each type of disaster
+    df_filtering_by_disaster = QuartileCuller.drop_culled_rows_by_group(df=og_df, criteria=all_criteria,
+                                                                        group_by="disaster", combination="or")
+    print(df_filtering_by_disaster["disaster"].value_counts())
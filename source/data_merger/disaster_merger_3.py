@@ -1,43 +1,106 @@
 from __future__ import annotations
 
-from typing import Callable
+import os
+from itertools import islice
+from typing import Callable, Generator, Iterable
 
 import pandas as pd
 import numpy as np
-from json import load as jsonload
+
+from source.common.frame_storage import write_frame, FrameWriter
+from source.common.label_registry import LabelRegistry
+from source.common.postal_codes import union_postal_codes
+from source.data_merger.cluster_linking import ClusterLinking
+from source.data_merger.cluster_store import ClusterStore
+from source.data_merger.linking_context import LinkingContext
 
 
 # Third step of the merging process. Merge groups of disasters by spatial adjacency
 
 class DisasterLinker:
     """Each instance represents a cluster of rows in the 'expedients' dataframe
-    that are considered to be the same disaster"""
+    that are considered to be the same disaster
+
+    Instances are either built from a list of row indexes, or are views of a cluster of a `ClusterStore`
+    (see `from_store`). The aggregates of the latter are read from the store, and their row indexes are only
+    listed when accessed.
+    The rows belong to a `LinkingContext`. Unless another context is provided, the files in INPUT_PATH and
+    CONFIG_PATH are loaded the first time an instance is created"""
 
     INPUT_PATH = "../input-output/merged_expedients_1.csv"
     OUTPUT_PATH = "../input-output/merged_expedients_2.csv"
-    ADJACENCY_TABLE_PATH = "../data/provinces_adjacency/adjacency_table.csv"
-    CONFIG_PATH = "../config/disaster_merger_3/config.json"
-
-    expedients = pd.read_csv(INPUT_PATH)
-    expedients['date'] = pd.to_datetime(expedients['date'], errors='raise')
-    expedients.drop("Unnamed: 0", axis=1, inplace=True)
-    adjacencies = pd.read_csv(ADJACENCY_TABLE_PATH, index_col=0)
+    CONFIG_PATH = os.path.join(os.path.dirname(__file__), "../../config/disaster_merger_3/config.json")
 
-    with open(CONFIG_PATH) as fstream:
-        CONFIG = jsonload(fstream)
-
-    def __init__(self, indexes: list[int]):
-        self.indexes = indexes
+    def __init__(self, indexes: list[int] | None, context: LinkingContext | None = None):
+        self.context = context if context is not None else DisasterLinker.get_default_context()
+        self._indexes = indexes
+        self.store = None
+        self.cluster_id = None
         self.total_duration = None
+        self.total_claims = None
+        self.total_cost = None
         self.disaster_type = None
+        self.disaster_code = None
         self.province_list = None
+        self.province_code_array = None
+        self.province_mask = None
+        self.neighbourhood_mask = None
+        self.postal_codes = None
+
+    @classmethod
+    def get_default_context(cls) -> LinkingContext:
+        """Returns the context loaded from INPUT_PATH and CONFIG_PATH (see `LinkingContext.from_paths`)"""
+        return LinkingContext.from_paths(cls.INPUT_PATH, cls.CONFIG_PATH)
+
+    @classmethod
+    def from_store(cls, store: ClusterStore, cluster_id: int, context: LinkingContext) -> DisasterLinker:
+        """Creates an instance viewing a cluster of a store built from *context*. Its aggregates are copied in O(1)"""
+        disaster = DisasterLinker(None, context)
+        disaster.store = store
+        disaster.cluster_id = int(store.find(cluster_id))
+        disaster.disaster_code = int(store.disaster_codes[disaster.cluster_id])
+        disaster.total_duration = [pd.Timestamp(np.datetime64(int(store.start_days[disaster.cluster_id]), "D")),
+                                   pd.Timestamp(np.datetime64(int(store.end_days[disaster.cluster_id]), "D"))]
+        disaster.total_claims = store.claims[disaster.cluster_id]
+        disaster.total_cost = store.total_costs[disaster.cluster_id]
+        disaster.province_mask = store.province_masks[disaster.cluster_id]
+        disaster.neighbourhood_mask = store.neighbourhood_masks[disaster.cluster_id]
+        return disaster
+
+    @property
+    def indexes(self) -> list[int]:
+        """Indexes of the rows of 'expedients' in self"""
+        if self._indexes is None:
+            self._indexes = self.store.get_members(self.cluster_id).tolist()
+        return self._indexes
+
+    @staticmethod
+    def build_cluster_store(context: LinkingContext, rows: np.ndarray | None = None) -> ClusterStore:
+        """Creates a store with each row of 'expedients' in a cluster of its own
+
+        :param rows: Indexes of the rows to include in the store (Default: all the rows)
+        """
+        if rows is None:
+            rows = np.arange(len(context))
+        province_codes = context.province_codes[rows]
+        neighbourhood_masks = np.where(province_codes >= 0,
+                                       context.adjacency_masks[np.maximum(province_codes, 0)], np.uint64(0))
+        return ClusterStore(row_indexes=rows,
+                            start_days=context.start_days[rows],
+                            end_days=context.end_days[rows],
+                            total_costs=context.expedients["total_cost"].to_numpy(dtype=float)[rows],
+                            claims=context.expedients["claims"].to_numpy(dtype=np.int64)[rows],
+                            disaster_codes=context.disaster_codes[rows],
+                            province_masks=context.province_masks[rows],
+                            neighbourhood_masks=neighbourhood_masks)
 
     @classmethod
-    def build_initial_disaster_pool(cls) -> list[DisasterLinker]:
+    def build_initial_disaster_pool(cls, context: LinkingContext | None = None) -> list[DisasterLinker]:
         """Factory method creating an initial list of disaster instances by considering each row in 'expedients'
         a different disaster"""
-        n_of_rows = cls.expedients.shape[0]
-        return [DisasterLinker([n]) for n in range(n_of_rows)]
+        if context is None:
+            context = cls.get_default_context()
+        return [DisasterLinker([n], context) for n in range(len(context))]
 
     def is_compatible_with(self, other: DisasterLinker) -> bool:
         """Check if two instances represent the same disaster in a different place
@@ -48,16 +111,16 @@ class DisasterLinker:
 
         - The time elapsed between the two disasters must be less than the speficied in the config
 
-        - At least 2 of the provinces in the disasters must be adjacent
+        - At least 2 of the provinces in the disasters must be adjacent (see `is_adjacent_with`)
         """
         # Check the disasters are of the same type
-        if self.get_disaster_type() != other.get_disaster_type():
+        if self.get_disaster_code() != other.get_disaster_code():
             return False
         # Check the disasters overlap time-wise
         self_duration = self.get_total_duration()
         other_duration = other.get_total_duration()
-        if (other_duration[0] > self_duration[1] + pd.Timedelta(days=self.CONFIG["days_leniency"])
-                or self_duration[0] > other_duration[1] + pd.Timedelta(days=self.CONFIG["days_leniency"])):
+        if (other_duration[0] > self_duration[1] + pd.Timedelta(days=self.context.config["days_leniency"])
+                or self_duration[0] > other_duration[1] + pd.Timedelta(days=self.context.config["days_leniency"])):
             return False
         # Check the disasters are adjacent space-wise
         if not self.is_adjacent_with(other):
@@ -70,9 +133,15 @@ class DisasterLinker:
         Note that this method doesn't check whether the disaster types are consistent whithin the instance
         """
         if self.disaster_type is None:
-            self.disaster_type = self.expedients.loc[self.indexes[0], "disaster"]
+            self.disaster_type = self.context.expedients["disaster"].cat.categories[self.get_disaster_code()]
         return self.disaster_type
 
+    def get_disaster_code(self) -> int:
+        """Get the code of the disaster type of self in the label registry"""
+        if self.disaster_code is None:
+            self.disaster_code = int(self.context.disaster_codes[self.indexes[0]])
+        return self.disaster_code
+
     def get_total_duration(self) -> [np.datetime64, np.datetime64]:
         """
         Get the total duration of a disaster by taking into account all the rows contained in the instance
@@ -81,77 +150,148 @@ class DisasterLinker:
         :return: A list containing the start and end time of the DisasterLinker
         """
         if self.total_duration is None:
-            dates = self.expedients.loc[self.indexes, ["date", "duration"]]
-            dates.rename(columns={"date": "start_date"}, inplace=True)
-            dates["end_date"] = dates["start_date"]
-            for index in dates.index:
-                dates.loc[index, "end_date"] = (
-                        dates.loc[index, "end_date"] + pd.Timedelta(days=dates.loc[index, "duration"]))
-            self.total_duration = [min(dates["start_date"]), max(dates["end_date"])]
+            self.total_duration = [pd.Timestamp(np.datetime64(int(self.context.start_days[self.indexes].min()), "D")),
+                                   pd.Timestamp(np.datetime64(int(self.context.end_days[self.indexes].max()), "D"))]
         return self.total_duration
 
     def get_province_list(self) -> list[str]:
         """Return a list of the provinces covered by a self"""
         if self.province_list is None:
-            self.province_list = list(set(self.expedients.loc[self.indexes, "province"].values))
+            categories = self.context.expedients["province"].cat.categories
+            self.province_list = list(categories[self.get_province_codes()])
         return self.province_list
 
+    def get_province_codes(self) -> np.ndarray:
+        """Return a sorted array of the codes of the provinces covered by self"""
+        if self.province_code_array is None:
+            self.province_code_array = LabelRegistry.decode_province_mask(self.get_province_mask())
+        return self.province_code_array
+
+    def get_province_mask(self) -> np.uint64:
+        """Return the bitmask of the provinces covered by self"""
+        if self.province_mask is None:
+            self.province_mask = np.bitwise_or.reduce(self.context.province_masks[self.indexes])
+        return self.province_mask
+
+    def get_neighbourhood_mask(self) -> np.uint64:
+        """Return the bitmask of the provinces covered by self or adjacent to any of them"""
+        if self.neighbourhood_mask is None:
+            self.neighbourhood_mask = np.bitwise_or.reduce(self.context.adjacency_masks[self.get_province_codes()])
+        return self.neighbourhood_mask
+
+    def get_postal_codes(self) -> np.ndarray:
+        """Return the set of postal codes covered by self, as a sorted array"""
+        if self.postal_codes is None:
+            self.postal_codes = union_postal_codes(self.context.expedients.loc[self.indexes, "postal_codes"])
+        return self.postal_codes
+
     def get_total_claims(self) -> int:
-        total_claims = self.expedients.loc[self.indexes, "claims"].sum()
-        return total_claims
+        if self.total_claims is None:
+            self.total_claims = self.context.expedients.loc[self.indexes, "claims"].sum()
+        return self.total_claims
 
     def get_total_cost(self) -> float:
-        total_cost = self.expedients.loc[self.indexes, "total_cost"].sum()
-        return total_cost
+        if self.total_cost is None:
+            self.total_cost = self.context.expedients.loc[self.indexes, "total_cost"].sum()
+        return self.total_cost
 
     def is_adjacent_with(self, other: DisasterLinker) -> bool:
-        """Check whether at least a pair of provinces covered by the disasters are adjacent"""
-        self_provinces_list = self.get_province_list()
-        other_provinces_list = other.get_province_list()
-        return self.adjacencies.loc[self_provinces_list, other_provinces_list].values.any()
+        """Check whether at least a pair of provinces covered by the disasters are adjacent or, if the context
+        has a postal prefix index, whether their postal codes share a prefix"""
+        if self.get_neighbourhood_mask() & other.get_province_mask():
+            return True
+        postal_index = self.context.postal_index
+        return postal_index is not None and postal_index.share_prefix(self.get_postal_codes(), other.get_postal_codes())
 
     def merge_with(self, other: DisasterLinker) -> DisasterLinker:
         """Merges two instances that represent the same disaster.
         :except Nothing: Even though this method doesn't check, it is expected that *self* and *other* are compatible
-        (in other words, 'self.is_compatible_with(other)' must return True)"""
+        (in other words, 'self.is_compatible_with(other)' must return True)
+
+        Instances viewing the same store are merged in the store, in which case *self* and *other* must not be
+        used afterward"""
+        if self.store is not None and self.store is other.store:
+            merged_cluster_id = self.store.merge(self.cluster_id, other.cluster_id)
+            return DisasterLinker.from_store(self.store, merged_cluster_id, self.context)
         # Join the disasters
-        new_disaster = DisasterLinker(self.indexes + other.indexes)
+        new_disaster = DisasterLinker(self.indexes + other.indexes, self.context)
         # Most of this is just preformace improvements by taking advantage of the DP nature of the class
         # Dynamically generating the attributes from the new disaster instance
         new_disaster.disaster_type = self.get_disaster_type()
-        new_disaster.province_list = list(set(self.get_province_list()).union(set(other.get_province_list())))
+        new_disaster.disaster_code = self.get_disaster_code()
+        new_disaster.province_code_array = np.union1d(self.get_province_codes(), other.get_province_codes())
+        new_disaster.province_mask = self.get_province_mask() | other.get_province_mask()
+        new_disaster.neighbourhood_mask = self.get_neighbourhood_mask() | other.get_neighbourhood_mask()
         self_durations = self.get_total_duration()
         other_durations = other.get_total_duration()
         new_disaster.total_duration = [min(self_durations[0], other_durations[0]),
                                        max(self_durations[1], other_durations[1])]
+        new_disaster.total_claims = self.get_total_claims() + other.get_total_claims()
+        new_disaster.total_cost = self.get_total_cost() + other.get_total_cost()
+        # The postal codes are only joined if they are already known, otherwise they are computed when needed
+        if self.postal_codes is not None and other.postal_codes is not None:
+            new_disaster.postal_codes = union_postal_codes([self.postal_codes, other.postal_codes])
         return new_disaster
 
-    @staticmethod
-    def collapse_disaster_list(disasters: list[DisasterLinker]) -> None:
+    @classmethod
+    def collapse_disaster_list(cls, disasters: list[DisasterLinker], n_workers: int = 1) -> None:
         """
         Takes a list of DisasterLinker instances, groups them using the adjacency table and returns a new list
         of instances
         Mutates the list in-place
+
+        The instances are joined until no pair of them is compatible (see `is_compatible_with`),
+        using the sweep of `ClusterLinking` instead of comparing every pair of instances
+
+        :param n_workers: If greater than 1, independent partitions of the instances are linked in a pool of
+            *n_workers* processes (see `ClusterLinking.link_parallel`). The result doesn't depend on it
         """
-        new_list = []
-        while len(disasters) > 0:
-            # Take a disaster from the list and check if it can be combined with any other disaster
-            current_disaster = disasters.pop()
-            compatible_disaster_index = current_disaster.find_compatible_disasters(disasters)
-
-            if compatible_disaster_index >= 0:
-                # A compatible disaster was found. Merge the two disasters and add them back to the disaster pool
-                other_disaster = disasters.pop(compatible_disaster_index)
-                disasters.append(current_disaster.merge_with(other_disaster))
-            else:
-                # No compatible disaster was found. Add the current disaster to the final list
-                new_list.append(current_disaster)
-            if DisasterLinker.CONFIG["debug_messages_on"]:
-                print(f"Remaining Disasters: {len(disasters)}")
-                print(f"Length of the new list: {len(new_list)}")
+        if len(disasters) == 0:
+            return None
+        # Each row starts in the cluster of the instance containing it
+        rows = np.concatenate([np.asarray(disaster.indexes, dtype=np.int64) for disaster in disasters])
+        n_of_rows_per_disaster = [len(disaster.indexes) for disaster in disasters]
+        first_rows = np.repeat(np.cumsum(n_of_rows_per_disaster) - n_of_rows_per_disaster, n_of_rows_per_disaster)
+        context = disasters[0].context
+        store = cls.build_cluster_store(context, rows)
+        store.merge_pairs(first_rows, np.arange(len(rows)))
         # Mutate the original list instead of returning a new list
-        # (to make clear the list gets mutated anyways during the collapsing)
-        disasters.extend(new_list)
+        disasters[:] = cls.link_store(store, context, n_workers)
+        return None
+
+    @classmethod
+    def link_expedients(cls, context: LinkingContext | None = None, n_workers: int = 1) -> list[DisasterLinker]:
+        """Groups all the rows of 'expedients' into disasters, without creating an instance for each row.
+        Equivalent to collapsing the initial disaster pool (see `collapse_disaster_list`)"""
+        if context is None:
+            context = cls.get_default_context()
+        return cls.link_store(cls.build_cluster_store(context), context, n_workers)
+
+    @classmethod
+    def sweep_days_leniency(cls,
+                            leniencies: list[int],
+                            context: LinkingContext | None = None) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """Groups all the rows of 'expedients' into disasters for several values of the days leniency at once,
+        instead of linking them again for each value (see `ClusterLinking.sweep_leniency`)
+
+        :return: The cluster of each row for each leniency, and the merges between clusters at each leniency
+        """
+        if context is None:
+            context = cls.get_default_context()
+        return ClusterLinking.sweep_leniency(cls.build_cluster_store(context), leniencies,
+                                             debug_messages_on=context.config["debug_messages_on"],
+                                             postal_index=context.postal_index)
+
+    @staticmethod
+    def link_store(store: ClusterStore, context: LinkingContext, n_workers: int = 1) -> list[DisasterLinker]:
+        """Merges the clusters of a store until no pair of them is compatible, and returns a view of each cluster
+
+        :param n_workers: Number of processes linking independent partitions of the clusters
+        """
+        ClusterLinking.link_parallel(store, days_leniency=context.config["days_leniency"], n_workers=n_workers,
+                                     debug_messages_on=context.config["debug_messages_on"],
+                                     postal_index=context.postal_index)
+        return [DisasterLinker.from_store(store, cluster_id, context) for cluster_id in store.get_cluster_ids()]
 
     def find_compatible_disasters(self, other_disasters: list[DisasterLinker]) -> int:
         """
@@ -176,6 +316,8 @@ class DisasterLinker:
         data_dict["disaster"] = self.get_disaster_type()
         # Get the list of provinces
         data_dict["provinces"] = self.get_province_list()
+        # Get the set of postal codes
+        data_dict["postal_codes"] = self.get_postal_codes()
         # Get total amount of claims
         data_dict["claims"] = self.get_total_claims()
         # Get the total cost of the disaster
@@ -185,25 +327,50 @@ class DisasterLinker:
         return data_dict
 
     @staticmethod
-    def to_dataframe(instances: list[DisasterLinker],
-                     to_dict: Callable[[DisasterLinker], dict | list[dict]] = generate_data_dict
-                     ) -> pd.DataFrame | None:
-        if len(instances) == 0:
-            return None
-        column_tags = list(to_dict(instances[0]).keys())
-        disasters_df = pd.DataFrame(columns=column_tags)
-        df_index = 0
+    def iter_data_dicts(instances: Iterable[DisasterLinker],
+                        to_dict: Callable[[DisasterLinker], dict | list[dict]] = generate_data_dict
+                        ) -> Generator[dict, None, None]:
+        """Generator yielding the rows generated by *to_dict* from each instance"""
         for disaster in instances:
             # Returns either a row or a list of rows
             data_dicts = to_dict(disaster)
             # Type cast into list for consistency
             if not isinstance(data_dicts, list):
                 data_dicts = [data_dicts]
-            # Add each row to the dataframe
-            for data_dict in data_dicts:
-                disasters_df.loc[df_index] = data_dict
-                df_index += 1
-        return disasters_df
+            yield from data_dicts
+
+    @staticmethod
+    def to_dataframe(instances: list[DisasterLinker],
+                     to_dict: Callable[[DisasterLinker], dict | list[dict]] = generate_data_dict
+                     ) -> pd.DataFrame | None:
+        """Builds a dataframe with the rows generated by *to_dict* from each instance.
+        The rows are gathered first and the dataframe is built at once"""
+        if len(instances) == 0:
+            return None
+        data_dicts = list(DisasterLinker.iter_data_dicts(instances, to_dict))
+        column_tags = list(data_dicts[0].keys()) if len(data_dicts) > 0 else None
+        return pd.DataFrame.from_records(data_dicts, columns=column_tags)
+
+    @staticmethod
+    def write_dataframe(instances: Iterable[DisasterLinker],
+                        path: str,
+                        to_dict: Callable[[DisasterLinker], dict | list[dict]] = generate_data_dict,
+                        chunksize: int = 10000) -> int:
+        """Writes the rows generated by *to_dict* from each instance straight to disk, holding at most *chunksize*
+        rows in memory. The format is chosen by the extension of the path (see `common.frame_storage`)
+
+        :return: The number of rows written
+        """
+        data_dicts = DisasterLinker.iter_data_dicts(instances, to_dict)
+        n_of_rows = 0
+        with FrameWriter(path) as writer:
+            while True:
+                chunk = list(islice(data_dicts, chunksize))
+                if len(chunk) == 0:
+                    break
+                writer.write(pd.DataFrame.from_records(chunk, columns=list(chunk[0].keys())))
+                n_of_rows += len(chunk)
+        return n_of_rows
 
     def __repr__(self):
         return f"|Indexes: {self.indexes}|"
@@ -211,12 +378,12 @@ class DisasterLinker:
 
 if __name__ == '__main__':
     # Script setup
-    disaster_list = DisasterLinker.build_initial_disaster_pool()
-    n_of_og_disasters = len(disaster_list)
+    linking_context = DisasterLinker.get_default_context()
+    n_of_og_disasters = len(linking_context)
 
     # Collapse the disaster list by merging related disasters
     print(f"Collapsing {n_of_og_disasters} disasters")
-    DisasterLinker.collapse_disaster_list(disaster_list)
+    disaster_list = DisasterLinker.link_expedients(linking_context)
     print(f"{n_of_og_disasters} disasters were collapsed into {len(disaster_list)} disasters")
 
     # Convert the final disaster list to a dataframe, sort by damages for convenience
@@ -225,4 +392,4 @@ if __name__ == '__main__':
 
     # Save the results as a csv file.
     print(f"Saving collapsed df to '{DisasterLinker.OUTPUT_PATH}'")
-    final_df.to_csv(path_or_buf=DisasterLinker.OUTPUT_PATH, index=False)
+    write_frame(final_df, DisasterLinker.OUTPUT_PATH)
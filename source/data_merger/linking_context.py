@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import os
+from json import load as jsonload
+
+import numpy as np
+import pandas as pd
+
+from source.common.frame_storage import read_frame
+from source.common.label_registry import LabelRegistry
+from source.common.postal_codes import PostalPrefixIndex
+
+
+class LinkingContext:
+    """Dataset of expedients linked by `DisasterLinker`, together with the arrays derived from it and the
+    configuration of the linking
+
+    Contexts are built explicitly, either from a dataframe or from files (see `from_paths`), so nothing is read
+    when the linking modules are imported and several datasets can be linked in the same process
+    """
+
+    _loaded_contexts: dict[tuple[str, str, float, float], LinkingContext] = {}
+
+    def __init__(self, expedients: pd.DataFrame, config: dict):
+        """
+        :param expedients: Merged expedients, as written by the previous steps of the pipeline
+        :param config: Configuration of the linking (days_leniency, debug_messages_on and, optionally,
+            province_hops and postal_prefix_digits)
+        """
+        self.config = config
+        self.expedients = expedients.copy(deep=False)
+        # Provinces and disasters are compared by their codes in the label registry.
+        # Province codes are also the positions of their bits in the province masks
+        self.expedients["province"] = LabelRegistry.encode_provinces(self.expedients["province"])
+        self.expedients["disaster"] = LabelRegistry.encode_disasters(self.expedients["disaster"])
+        self.province_codes = self.expedients["province"].cat.codes.to_numpy()
+        self.disaster_codes = self.expedients["disaster"].cat.codes.to_numpy()
+        self.province_masks = LabelRegistry.get_province_masks(self.province_codes)
+        # With postal prefixes, rows in the same province are only adjacent if their postal codes share a prefix,
+        # so the neighbourhood of each province doesn't contain the province itself
+        postal_prefix_digits = config.get("postal_prefix_digits")
+        self.postal_index = (PostalPrefixIndex(list(self.expedients["postal_codes"]), postal_prefix_digits)
+                             if postal_prefix_digits is not None else None)
+        self.adjacency_masks = LabelRegistry.get_adjacency_masks(hops=config.get("province_hops", 1),
+                                                                 include_self=self.postal_index is None)
+        # Time frame of each row, in days since the epoch
+        self.start_days = self.expedients["date"].to_numpy(dtype="datetime64[D]").astype(np.int64)
+        self.end_days = self.start_days + self.expedients["duration"].to_numpy(dtype=np.int64)
+
+    @classmethod
+    def from_paths(cls, input_path: str, config_path: str) -> LinkingContext:
+        """Loads the expedients and the config from their files (see `common.frame_storage`)
+
+        Contexts are cached, so loading the same unmodified files again doesn't read them
+        """
+        input_path, config_path = os.path.abspath(input_path), os.path.abspath(config_path)
+        key = (input_path, config_path, os.path.getmtime(input_path), os.path.getmtime(config_path))
+        if key not in cls._loaded_contexts:
+            with open(config_path) as fstream:
+                config = jsonload(fstream)
+            cls._loaded_contexts[key] = LinkingContext(read_frame(input_path), config)
+        return cls._loaded_contexts[key]
+
+    def __len__(self):
+        """Number of expedients"""
+        return self.expedients.shape[0]
+
+    def __repr__(self):
+        return f"<LinkingContext: {len(self)} expedients, config {self.config}>"
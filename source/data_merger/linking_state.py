@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from source.common.frame_storage import read_frame, write_frame
+from source.data_merger.cluster_linking import ClusterLinking
+from source.data_merger.cluster_store import ClusterStore
+from source.data_merger.disaster_merger_3 import DisasterLinker
+from source.data_merger.linking_context import LinkingContext
+
+
+class LinkingState:
+    """Linked clusters of the expedients, kept between runs so that new expedients can be linked incrementally
+
+    A state is a directory with the expedients linked so far, their `ClusterStore` (the parents of the union-find
+    structure and the aggregates of the clusters) and the configuration of the linking. When new expedients
+    arrive, they are appended as clusters of their own and only linked against the clusters whose time frames are
+    within the days leniency of theirs (see `ClusterLinking.link_new_clusters`), instead of linking every
+    expedient again. The ids of the clusters are their lowest row, so the clusters that didn't change keep their ids
+    """
+
+    EXPEDIENTS_FILE = "expedients.parquet"
+    CLUSTERS_FILE = "clusters.npz"
+    CONFIG_FILE = "config.json"
+
+    def __init__(self, context: LinkingContext, store: ClusterStore):
+        """
+        :param context: All the expedients linked so far, with the configuration of the linking
+        :param store: The clusters of all the rows of *context*
+        """
+        self.context = context
+        self.store = store
+
+    @classmethod
+    def create(cls, context: LinkingContext, n_workers: int = 1) -> LinkingState:
+        """Links all the expedients of a context (see `DisasterLinker.link_store`)"""
+        store = DisasterLinker.build_cluster_store(context)
+        DisasterLinker.link_store(store, context, n_workers)
+        return LinkingState(context, store)
+
+    def update(self, new_expedients: pd.DataFrame) -> tuple[np.ndarray, np.ndarray]:
+        """Appends new merged expedients to the state and links them with the existing clusters
+
+        :return: Two arrays of cluster ids, in increasing order:
+            - The changed clusters: the new clusters and the existing clusters that new expedients joined
+            - The removed clusters: the existing clusters merged into other clusters, whose ids no longer exist
+        """
+        previous_ids = self.store.get_cluster_ids()
+        n_of_previous_rows = len(self.context)
+        expedients = pd.concat([self.context.expedients, new_expedients], ignore_index=True)
+        self.context = LinkingContext(expedients, self.context.config)
+        new_rows = np.arange(n_of_previous_rows, len(self.context))
+        self.store.append(DisasterLinker.build_cluster_store(self.context, new_rows))
+        changed_ids = ClusterLinking.link_new_clusters(self.store, new_rows,
+                                                       days_leniency=self.context.config["days_leniency"],
+                                                       debug_messages_on=self.context.config["debug_messages_on"],
+                                                       postal_index=self.context.postal_index)
+        removed_ids = np.setdiff1d(previous_ids, self.store.get_cluster_ids())
+        return changed_ids, removed_ids
+
+    def get_disasters(self, cluster_ids: np.ndarray | None = None) -> list[DisasterLinker]:
+        """Returns a view of each cluster (see `DisasterLinker.from_store`)
+
+        :param cluster_ids: Ids of the clusters, like the changed clusters returned by `update` (Default: all)
+        """
+        if cluster_ids is None:
+            cluster_ids = self.store.get_cluster_ids()
+        return [DisasterLinker.from_store(self.store, cluster_id, self.context) for cluster_id in cluster_ids]
+
+    def save(self, directory: str) -> None:
+        """Saves the state into a directory, which is created if needed"""
+        os.makedirs(directory, exist_ok=True)
+        write_frame(self.context.expedients, os.path.join(directory, self.EXPEDIENTS_FILE))
+        self.store.save(os.path.join(directory, self.CLUSTERS_FILE))
+        with open(os.path.join(directory, self.CONFIG_FILE), "w") as fstream:
+            json.dump(self.context.config, fstream, indent=2)
+
+    @classmethod
+    def load(cls, directory: str) -> LinkingState:
+        """Loads a state saved with `save`"""
+        with open(os.path.join(directory, cls.CONFIG_FILE)) as fstream:
+            config = json.load(fstream)
+        context = LinkingContext(read_frame(os.path.join(directory, cls.EXPEDIENTS_FILE)), config)
+        store = ClusterStore.load(os.path.join(directory, cls.CLUSTERS_FILE))
+        # The codes of the labels depend on the order in which they were first seen by the process
+        # (see `LabelRegistry`), so they are computed again
+        rows = DisasterLinker.build_cluster_store(context)
+        store.set_row_labels(rows.disaster_codes, rows.province_masks, rows.neighbourhood_masks)
+        return LinkingState(context, store)
+
+    def __len__(self):
+        """Number of expedients"""
+        return len(self.context)
+
+    def __repr__(self):
+        return f"<LinkingState: {len(self)} expedients, {len(self.store.get_cluster_ids())} clusters>"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Incremental linking of merged expedients")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    create_parser = subparsers.add_parser("create", help="Link a file of merged expedients into a new state")
+    create_parser.add_argument("input_path")
+    create_parser.add_argument("state_path", help="Directory of the state")
+    create_parser.add_argument("--config", default=DisasterLinker.CONFIG_PATH, help="Config of the linking")
+    update_parser = subparsers.add_parser("update", help="Link a file of new merged expedients into a state")
+    update_parser.add_argument("state_path")
+    update_parser.add_argument("input_path")
+    args = parser.parse_args()
+
+    if args.command == "create":
+        linking_state = LinkingState.create(LinkingContext.from_paths(args.input_path, args.config))
+        print(f"Linked {len(linking_state)} expedients into {len(linking_state.store.get_cluster_ids())} clusters")
+    else:
+        linking_state = LinkingState.load(args.state_path)
+        changed, removed = linking_state.update(read_frame(args.input_path))
+        print(f"Changed clusters: {changed.tolist()}")
+        print(f"Removed clusters: {removed.tolist()}")
+    linking_state.save(args.state_path)
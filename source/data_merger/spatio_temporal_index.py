@@ -0,0 +1,268 @@
+from __future__ import annotations
+
+import argparse
+import json
+
+import numpy as np
+import pandas as pd
+
+from source.common.frame_storage import read_frame
+from source.common.label_registry import LabelRegistry
+
+
+class SpatioTemporalIndex:
+    """Index answering window / province / disaster type queries over merged expedients or linked disasters
+
+    The records are split by disaster type and by duration class (durations up to 1, 2, 4, 8... days), and each
+    split is a sorted array of start days. A record of a class lasting at most D days can only overlap a window
+    [a, b] if it starts between a - D and b, so each split is searched with two binary searches and only the
+    records in that range are checked. The provinces of each record are a bitmask (see `LabelRegistry`), so
+    province filters are a single AND.
+
+    The time frames of the two kinds of frames follow the conventions of the steps that produce them:
+    - Merged expedients keep the last day of their run in 'date' (see `ExpedientMerger.merge_consecutive_days`),
+      so they cover [date - duration + 1, date]
+    - Linked disasters keep the first day of their time frame in 'date' and its length in 'duration'
+      (see `DisasterLinker.get_total_duration`), so they cover [date, date + duration]
+
+    Indexes are saved as a single .npz file, containing their vocabularies and province adjacencies, so they can
+    be queried without the files they were built from
+    """
+
+    # Numeric columns of the indexed frame kept in the index, returned together with the results of queries
+    VALUE_COLUMNS = ["total_cost", "claims"]
+
+    def __init__(self,
+                 start_days: np.ndarray,
+                 end_days: np.ndarray,
+                 disaster_codes: np.ndarray,
+                 province_masks: np.ndarray,
+                 row_ids: np.ndarray,
+                 values: dict[str, np.ndarray],
+                 disasters: list[str],
+                 provinces: list[str],
+                 adjacency_masks: np.ndarray,
+                 date_is_last_day: bool = False):
+        """
+        :param start_days: First day of the time frame of each record, in days since the epoch
+        :param end_days: Last day of the time frame of each record, in days since the epoch
+        :param disaster_codes: Code of the disaster type of each record, in *disasters*
+        :param province_masks: Bitmask of the provinces of each record, with the bits of the codes in *provinces*
+        :param row_ids: Index of each record in the indexed frame
+        :param values: Other columns of the records (see VALUE_COLUMNS)
+        :param disasters: Disaster type of each disaster code
+        :param provinces: Province of each province code
+        :param adjacency_masks: Bitmask of the closed neighbourhood of each province code
+        :param date_is_last_day: Whether the indexed frame kept the last day of each record in 'date', like merged
+            expedients, or the first one, like linked disasters. Only used to rebuild 'date' and 'duration'
+            (see `query_frame`)
+        """
+        duration_classes = np.ceil(np.log2(np.maximum(end_days - start_days, 1))).astype(np.int64)
+        order = np.lexsort((start_days, duration_classes, disaster_codes))
+        self.start_days = np.asarray(start_days, dtype=np.int64)[order]
+        self.end_days = np.asarray(end_days, dtype=np.int64)[order]
+        self.disaster_codes = np.asarray(disaster_codes, dtype=np.int64)[order]
+        self.province_masks = np.asarray(province_masks, dtype=np.uint64)[order]
+        self.row_ids = np.asarray(row_ids, dtype=np.int64)[order]
+        self.values = {name: np.asarray(column)[order] for name, column in values.items()}
+        self.disasters = list(disasters)
+        self.provinces = list(provinces)
+        self.adjacency_masks = np.asarray(adjacency_masks, dtype=np.uint64)
+        self.date_is_last_day = bool(date_is_last_day)
+        # Limits of each split of records with the same disaster type and duration class
+        duration_classes = duration_classes[order]
+        is_split_start = np.ones(len(order), dtype=bool)
+        is_split_start[1:] = ((self.disaster_codes[1:] != self.disaster_codes[:-1])
+                              | (duration_classes[1:] != duration_classes[:-1]))
+        split_starts = np.flatnonzero(is_split_start)
+        self.splits = [(int(self.disaster_codes[start]), 2 ** int(duration_classes[start]), int(start), int(end))
+                       for start, end in zip(split_starts, np.append(split_starts[1:], len(order)))]
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> SpatioTemporalIndex:
+        """Indexes a frame of merged expedients (with a 'province' column) or of linked disasters
+        (with a 'provinces' column containing lists of provinces). Both need 'date', 'duration' and 'disaster'"""
+        is_linked = "provinces" in df.columns
+        if is_linked:
+            province_lists = df["provinces"]
+            lengths = np.fromiter((len(names) for names in province_lists), dtype=np.int64, count=len(df))
+            flat_provinces = pd.Series(np.concatenate([np.asarray(names, dtype=object) for names in province_lists])
+                                       if len(df) > 0 else [], dtype=object)
+        else:
+            lengths = np.ones(len(df), dtype=np.int64)
+            flat_provinces = df["province"]
+        flat_codes = LabelRegistry.encode_provinces(flat_provinces).codes
+        flat_masks = LabelRegistry.get_province_masks(flat_codes)
+        row_of_province = np.repeat(np.arange(len(df)), lengths)
+        province_masks = np.zeros(len(df), dtype=np.uint64)
+        np.bitwise_or.at(province_masks, row_of_province, flat_masks)
+
+        disasters = LabelRegistry.encode_disasters(df["disaster"])
+        days = pd.to_datetime(df["date"]).to_numpy(dtype="datetime64[D]").astype(np.int64)
+        durations = df["duration"].to_numpy(dtype=np.int64)
+        if is_linked:
+            start_days, end_days = days, days + durations
+        else:
+            start_days, end_days = days - durations + 1, days
+        return SpatioTemporalIndex(start_days=start_days,
+                                   end_days=end_days,
+                                   disaster_codes=disasters.codes,
+                                   province_masks=province_masks,
+                                   row_ids=np.arange(len(df)),
+                                   values={col: df[col].to_numpy() for col in cls.VALUE_COLUMNS if col in df.columns},
+                                   disasters=LabelRegistry.get_disasters(),
+                                   provinces=LabelRegistry.get_provinces(),
+                                   adjacency_masks=LabelRegistry.get_adjacency_masks(),
+                                   date_is_last_day=not is_linked)
+
+    @classmethod
+    def from_file(cls, path: str) -> SpatioTemporalIndex:
+        """Indexes a file saved with `common.frame_storage.write_frame`"""
+        return cls.from_frame(read_frame(path))
+
+    def save(self, path: str) -> None:
+        """Saves the index as a .npz file"""
+        vocabularies = json.dumps({"disasters": self.disasters, "provinces": self.provinces,
+                                   "date_is_last_day": self.date_is_last_day})
+        np.savez(path,
+                 start_days=self.start_days,
+                 end_days=self.end_days,
+                 disaster_codes=self.disaster_codes,
+                 province_masks=self.province_masks,
+                 row_ids=self.row_ids,
+                 adjacency_masks=self.adjacency_masks,
+                 vocabularies=np.array(vocabularies),
+                 **{f"value_{name}": column for name, column in self.values.items()})
+
+    @classmethod
+    def load(cls, path: str) -> SpatioTemporalIndex:
+        """Loads an index saved with `save`"""
+        with np.load(path) as arrays:
+            vocabularies = json.loads(str(arrays["vocabularies"]))
+            return SpatioTemporalIndex(start_days=arrays["start_days"],
+                                       end_days=arrays["end_days"],
+                                       disaster_codes=arrays["disaster_codes"],
+                                       province_masks=arrays["province_masks"],
+                                       row_ids=arrays["row_ids"],
+                                       values={name[len("value_"):]: arrays[name] for name in arrays.files
+                                               if name.startswith("value_")},
+                                       disasters=vocabularies["disasters"],
+                                       provinces=vocabularies["provinces"],
+                                       adjacency_masks=arrays["adjacency_masks"],
+                                       date_is_last_day=vocabularies.get("date_is_last_day", False))
+
+    def get_province_mask(self, provinces: list[str], include_neighbours: bool = False) -> np.uint64:
+        """Returns the bitmask of a list of province names, optionally extended to their adjacent provinces
+
+        :except KeyError: If a province is not in the vocabulary of the index
+        """
+        positions = {name: code for code, name in enumerate(self.provinces)}
+        mask = np.uint64(0)
+        for name in provinces:
+            code = positions.get(LabelRegistry.normalize_province(name))
+            if code is None:
+                raise KeyError(f"Unknown province '{name}'")
+            mask |= self.adjacency_masks[code] if include_neighbours else np.uint64(1) << np.uint64(code)
+        return mask
+
+    def get_disaster_codes(self, disasters: list[str]) -> list[int]:
+        """Returns the codes of the disaster types whose name contains any of the given names (case insensitive)"""
+        names = [name.strip().lower() for name in disasters]
+        return [code for code, disaster in enumerate(self.disasters) if any(name in disaster.lower() for name in names)]
+
+    def query(self,
+              start: str | np.datetime64 | None = None,
+              end: str | np.datetime64 | None = None,
+              provinces: list[str] | None = None,
+              disasters: list[str] | None = None,
+              include_neighbours: bool = False) -> np.ndarray:
+        """Finds the records whose time frame overlaps a window, in some provinces and of some disaster types
+
+        :param start: First day of the window (Default: no limit)
+        :param end: Last day of the window (Default: no limit)
+        :param provinces: Names of the provinces. Records covering any of them match (Default: any province)
+        :param disasters: Names (or parts of names) of the disaster types (Default: any type)
+        :param include_neighbours: Also match the records covering provinces adjacent to *provinces*
+        :return: The positions of the matching records in the indexed frame, in increasing order
+        """
+        first_day = np.iinfo(np.int64).min // 2 if start is None else self._to_day(start)
+        last_day = np.iinfo(np.int64).max // 2 if end is None else self._to_day(end)
+        codes = None if disasters is None else set(self.get_disaster_codes(disasters))
+        mask = None if provinces is None else self.get_province_mask(provinces, include_neighbours)
+
+        matches = []
+        for code, max_duration, split_start, split_end in self.splits:
+            if codes is not None and code not in codes:
+                continue
+            split_starts = self.start_days[split_start:split_end]
+            lower = split_start + np.searchsorted(split_starts, first_day - max_duration, side="left")
+            upper = split_start + np.searchsorted(split_starts, last_day, side="right")
+            is_match = self.end_days[lower:upper] >= first_day
+            if mask is not None:
+                is_match &= (self.province_masks[lower:upper] & mask) != 0
+            matches.append(np.arange(lower, upper)[is_match])
+        positions = np.concatenate(matches) if len(matches) > 0 else np.empty(0, dtype=np.int64)
+        return np.sort(self.row_ids[positions])
+
+    def query_frame(self, *args, **kwargs) -> pd.DataFrame:
+        """Same as `query`, but returns the matching records as a dataframe
+        (date, duration, disaster, provinces and the VALUE_COLUMNS of the indexed frame), indexed by their position.
+        'date' and 'duration' follow the convention of the indexed frame"""
+        row_ids = self.query(*args, **kwargs)
+        positions = np.empty(len(self.row_ids), dtype=np.int64)
+        positions[self.row_ids] = np.arange(len(self.row_ids))
+        positions = positions[row_ids]
+        provinces = np.array(self.provinces, dtype=object)
+        start_days, end_days = self.start_days[positions], self.end_days[positions]
+        if self.date_is_last_day:
+            days, durations = end_days, end_days - start_days + 1
+        else:
+            days, durations = start_days, end_days - start_days
+        result = pd.DataFrame({
+            "date": days.astype("datetime64[D]").astype("datetime64[ns]"),
+            "duration": durations,
+            "disaster": pd.Categorical.from_codes(self.disaster_codes[positions], categories=self.disasters),
+            "provinces": [list(provinces[LabelRegistry.decode_province_mask(mask)])
+                          for mask in self.province_masks[positions]],
+        }, index=row_ids)
+        for name, column in self.values.items():
+            result[name] = column[positions]
+        return result
+
+    @staticmethod
+    def _to_day(date: str | np.datetime64) -> int:
+        return int(pd.Timestamp(date).to_datetime64().astype("datetime64[D]").astype(np.int64))
+
+    def __len__(self):
+        return len(self.row_ids)
+
+    def __repr__(self):
+        return f"<SpatioTemporalIndex: {len(self)} records, {len(self.splits)} splits>"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Spatio-temporal index of merged expedients or linked disasters")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="Index a csv or parquet file")
+    build_parser.add_argument("input_path")
+    build_parser.add_argument("index_path", help="Path of the .npz index")
+    query_parser = subparsers.add_parser("query", help="Query an index")
+    query_parser.add_argument("index_path")
+    query_parser.add_argument("--start", help="First day of the window (eg: 2023-01-31)")
+    query_parser.add_argument("--end", help="Last day of the window")
+    query_parser.add_argument("--province", action="append", dest="provinces", help="Can be repeated")
+    query_parser.add_argument("--neighbours", action="store_true", help="Also match adjacent provinces")
+    query_parser.add_argument("--disaster", action="append", dest="disasters", help="Part of the name of a type")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        index = SpatioTemporalIndex.from_file(args.input_path)
+        index.save(args.index_path)
+        print(f"Indexed {len(index)} records into '{args.index_path}'")
+    else:
+        index = SpatioTemporalIndex.load(args.index_path)
+        results = index.query_frame(start=args.start, end=args.end, provinces=args.provinces,
+                                    disasters=args.disasters, include_neighbours=args.neighbours)
+        with pd.option_context("display.max_rows", None, "display.width", 200):
+            print(results)
+        print(f"{len(results)} matches")
@@ -10,27 +10,26 @@ from auxiliary_main import culler, disaster_to_dict_factory, generate_search_que
 if __name__ == '__main__':
     # First, we merge the raw expedients into articles
     ExpedientMerger.INPUT_PATH = "../input-output/raw_expedients.csv"
-    ExpedientMerger.OUTPUT_PATH = "../input-output/all_events.csv"
+    ExpedientMerger.OUTPUT_PATH = "../input-output/all_events.parquet"
     ExpedientMerger.merge_csv()
 
     # Then, we filter the articles by quartile exclusion
-    QuartileCuller.INPUT_PATH = "../input-output/all_events.csv"
-    QuartileCuller.OUTPUT_PATH = "../input-output/culled_events.csv"
+    QuartileCuller.INPUT_PATH = "../input-output/all_events.parquet"
+    QuartileCuller.OUTPUT_PATH = "../input-output/culled_events.parquet"
 
     QuartileCuller.apply_cull_csv_file(culler)
 
     #exit(0) # AVOID INNECESARY API CALLS WHEN TESTING
 
     # We extract information about each event in the remaining articles
-    Event.INPUT_PATH = "../input-output/culled_events.csv"
+    Event.INPUT_PATH = "../input-output/culled_events.parquet"
     events = Event.from_csv()
     events = Event.extract_info_events(events, generate_search_query)
 
     # Link the information extrated from articles into disasters
-    DisasterLinker.INPUT_PATH = "../input-output/culled_events.csv"
+    DisasterLinker.INPUT_PATH = "../input-output/culled_events.parquet"
     DisasterLinker.OUTPUT_PATH = "../input-output/results.csv"
-    disaster_list = DisasterLinker.build_initial_disaster_pool()
-    DisasterLinker.collapse_disaster_list(disaster_list)
+    disaster_list = DisasterLinker.link_expedients()
 
     final_df = DisasterLinker.to_dataframe(disaster_list, disaster_to_dict_factory(events))
     questions_id = Questionnaire.get_question_id_dict()
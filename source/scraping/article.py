@@ -2,18 +2,22 @@ from __future__ import annotations
 
 from typing import Callable
 
+import os
 import random
 import requests
 from concurrent.futures import ThreadPoolExecutor
 import asyncio
+import aiohttp
 from numpy import datetime64
 from googlesearch import search as g_search
 from bs4 import BeautifulSoup
 import openai
 import json
+from urllib.parse import urlencode
 
 from scraping.questionnaire import Questionnaire
 from common.retriable_decorator import retriable
+from source.common.http_cache import HttpCache, CacheMissError
 from common.merge_dictionaries import merge_dicts
 from common.idempotent_attribute_setter import idempotent_attribute_setter
 
@@ -26,24 +30,51 @@ class InformationFetchingError(IOError):
         self.inner_exception = inner_exception
 
 
+class ConcurrencyLimits:
+    """Limits to the number of concurrent operations of the articles processed in the same event loop.
+    The number of concurrent requests (in total and to each host) is limited by the session instead"""
+
+    def __init__(self, max_concurrent_searches: int, max_concurrent_completions: int):
+        """
+        :param max_concurrent_searches: Maximum number of google searches running at once
+        :param max_concurrent_completions: Maximum number of articles being answered by OpenAI at once
+        """
+        self.searches = asyncio.Semaphore(max_concurrent_searches)
+        self.completions = asyncio.Semaphore(max_concurrent_completions)
+
+
 class Article:
-    OPEN_AI_KEY_PATH = "../config/credentials/OPENAI_API_KEY.json"
-    CONFIG_PATH = "../config/article/article.json"
-
-    try:
-        with open(OPEN_AI_KEY_PATH, "r", encoding="utf-8") as fstream:
-            openai_api_key = json.load(fstream)["OPENAI_API_KEY"]
-            openai_client = openai.OpenAI(api_key=openai_api_key)
-    except FileNotFoundError as e:
-        raise FileNotFoundError(f"{OPEN_AI_KEY_PATH} not found")
-    except KeyError as e:
-        raise KeyError(f"'OPENAI_API_KEY' attribute not found in {OPEN_AI_KEY_PATH}")
-
-    try:
-        with open(CONFIG_PATH, "r") as fstream:
-            CONFIG = json.load(fstream)
-    except FileNotFoundError as e:
-        raise FileNotFoundError(f"{CONFIG_PATH} not found")
+    OPEN_AI_KEY_PATH = os.path.join(os.path.dirname(__file__), "../../config/credentials/OPENAI_API_KEY.json")
+    CONFIG_PATH = os.path.join(os.path.dirname(__file__), "../../config/article/article.json")
+
+    # Loaded the first time they are needed (see `get_config` and `get_openai_client`)
+    _config = None
+    _openai_client = None
+
+    @classmethod
+    def get_config(cls) -> dict:
+        """Returns the config in CONFIG_PATH, reading it on the first call"""
+        if cls._config is None:
+            try:
+                with open(cls.CONFIG_PATH, "r") as fstream:
+                    cls._config = json.load(fstream)
+            except FileNotFoundError as e:
+                raise FileNotFoundError(f"{cls.CONFIG_PATH} not found")
+        return cls._config
+
+    @classmethod
+    def get_openai_client(cls) -> openai.OpenAI:
+        """Returns the OpenAI client, building it with the key in OPEN_AI_KEY_PATH on the first call"""
+        if cls._openai_client is None:
+            try:
+                with open(cls.OPEN_AI_KEY_PATH, "r", encoding="utf-8") as fstream:
+                    openai_api_key = json.load(fstream)["OPENAI_API_KEY"]
+            except FileNotFoundError as e:
+                raise FileNotFoundError(f"{cls.OPEN_AI_KEY_PATH} not found")
+            except KeyError as e:
+                raise KeyError(f"'OPENAI_API_KEY' attribute not found in {cls.OPEN_AI_KEY_PATH}")
+            cls._openai_client = openai.OpenAI(api_key=openai_api_key)
+        return cls._openai_client
 
     def __init__(self,
                  title_arg: str,
@@ -89,12 +120,72 @@ class Article:
             self.sucessfully_built = False
             print(f"Error building {self.title}; Message: {e.message}; Exception ocurred: {e.inner_exception}")
 
+    async def async_process_article(self, session: aiohttp.ClientSession, limits: ConcurrencyLimits) -> None:
+        """Same as `process_article`, in an event loop shared with other articles
+
+        The page of the article is fetched with the shared *session*, while the google search, the parsing of
+        the page and the OpenAI calls (which are blocking) run in threads, bounded by *limits*"""
+        if self.sucessfully_built:
+            return None
+        try:
+            if self.link is None:
+                async with limits.searches:
+                    await asyncio.to_thread(self.obtain_link_by_google)
+            if self.contents is None:
+                await self.async_obtain_contents_from_link(session)
+            async with limits.completions:
+                await asyncio.to_thread(self.classify_into_sectors)
+                await asyncio.to_thread(self.obtain_answers_to_bool_questions)
+            self.severity = Questionnaire(self.sectors).get_severity_score_by_sector(self.answers)
+            self.sucessfully_built = True
+        except InformationFetchingError as e:
+            self.sucessfully_built = False
+            print(f"Error building {self.title}; Message: {e.message}; Exception ocurred: {e.inner_exception}")
+        return None
+
+    def copy_results_from(self, other: Article) -> None:
+        """Takes the results of the processing of another article with the same page"""
+        self.link = other.link
+        self.contents = other.contents
+        self.sectors = other.sectors
+        self.answers = other.answers
+        self.severity = other.severity
+        self.sucessfully_built = other.sucessfully_built
+
+    async def async_obtain_contents_from_link(self, session: aiohttp.ClientSession) -> None:
+        cache = HttpCache.get_default()
+        page_content = await asyncio.to_thread(cache.get, self.link)
+        if page_content is None:
+            try:
+                cache.check_online(self.link)
+                async with session.get(self.link) as response:
+                    page_content = await response.read()
+                    if response.status == 200:
+                        await asyncio.to_thread(cache.put, self.link, page_content)
+            except CacheMissError as e:
+                raise InformationFetchingError(inner_exception=e, message=f"The url is not cached: {self.link}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise InformationFetchingError(inner_exception=e,
+                                               message=f"Could not get a response from the url: {self.link}")
+        self.contents = await asyncio.to_thread(self.extract_contents, page_content)
+        return None
+
     @idempotent_attribute_setter("link")
     def obtain_link_by_google(self) -> None:
         # TODO Refine this search query
         query = f'"{self.title}, {self.source_name}"'
+        # The results of the searches are cached like the bodies of the urls of their queries
+        cache = HttpCache.get_default()
+        search_url = f"https://www.google.com/search?{urlencode({'q': query, 'num': 1})}"
+        cached_link = cache.get(search_url)
+        if cached_link is not None:
+            self.link = cached_link.decode("utf-8")
+            return None
         try:
+            cache.check_online(search_url)
             enlaces = list(g_search(query, num_results=1))
+        except CacheMissError as e:
+            raise InformationFetchingError(inner_exception=e, message="The search is not cached")
         except requests.exceptions.RequestException as e:
             raise InformationFetchingError(
                 inner_exception=e,
@@ -102,26 +193,40 @@ class Article:
         if len(enlaces) == 0:
             raise InformationFetchingError(message="Article could not be found by a google search of its title")
         self.link = enlaces[0]
+        cache.put(search_url, self.link.encode("utf-8"))
 
     @idempotent_attribute_setter("contents")
     def obtain_contents_from_link(self) -> None:
         # TODO Implement performance upgrades
-        try:
-            response = requests.get(self.link)
-            page = BeautifulSoup(response.content, 'html.parser')
-        except requests.exceptions.RequestException as e:
-            raise InformationFetchingError(inner_exception=e,
-                                           message=f"Could not get a response from the url: {self.link}")
+        cache = HttpCache.get_default()
+        page_content = cache.get(self.link)
+        if page_content is None:
+            try:
+                cache.check_online(self.link)
+                response = requests.get(self.link)
+            except CacheMissError as e:
+                raise InformationFetchingError(inner_exception=e, message=f"The url is not cached: {self.link}")
+            except requests.exceptions.RequestException as e:
+                raise InformationFetchingError(inner_exception=e,
+                                               message=f"Could not get a response from the url: {self.link}")
+            page_content = response.content
+            if response.status_code == 200:
+                cache.put(self.link, page_content)
+        self.contents = self.extract_contents(page_content)
+        return None
 
+    @staticmethod
+    def extract_contents(page_content: bytes | str) -> str:
+        """Extracts the text of an article from the html of its page
+        :except InformationFetchingError: If the page has no paragraphs"""
+        page = BeautifulSoup(page_content, 'html.parser')
         # Extraer título y párrafos como ejemplo de contenido
         # TODO extracting all the paragraphs MAY be just a little unprecise, fetching paragraphs that dont
         #  necesarilly belong on the new and could affect the OpenAI performace
         parrafos = page.find_all('p')
         if len(parrafos) == 0:
             raise InformationFetchingError(message="No <p> tags were found in the article")
-        contenido = ' '.join([p.text for p in parrafos])
-        self.contents = contenido
-        return None
+        return ' '.join([p.text for p in parrafos])
 
     @idempotent_attribute_setter("sectors")
     def classify_into_sectors(self) -> None:
@@ -146,7 +251,7 @@ class Article:
                 answers[q.id] = a
         self.answers = answers
 
-    @retriable(CONFIG["max_openai_call_tries"])
+    @retriable(lambda: Article.get_config()["max_openai_call_tries"])
     def ask_bool_question(self, bool_question: str) -> bool:
         sys_prompt = ("Eres una herramienta de extraccion de datos.\n"
                       "A continuacion, se te provera un fragmento de un articulo de un noticiario. "
@@ -178,7 +283,7 @@ class Article:
                 message="Error ocurred when parsing OpenAI response (in `article.ask_bool_question`)"
             )
 
-    @retriable(CONFIG["max_openai_call_tries"])
+    @retriable(lambda: Article.get_config()["max_openai_call_tries"])
     def answer_single_question(self, question: str) -> str | None:
         sys_prompt = ("Eres una herramienta de extraccion de datos.\n"
                       "A continuacion, se te provera un fragmento de un articulo de un noticiario. "
@@ -213,7 +318,7 @@ class Article:
         if system_prompt != "":
             messages.append({"role": "system", "content": system_prompt})
         messages.append({"role": "user", "content": content_prompt})
-        response = cls.openai_client.chat.completions.create(
+        response = cls.get_openai_client().chat.completions.create(
             model="gpt-3.5-turbo",
             messages=messages
         )
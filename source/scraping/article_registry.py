@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import tempfile
+
+import aiohttp
+import numpy as np
+
+from source.common.http_cache import HttpCache
+from source.common.single_flight import SingleFlightCache
+from source.scraping.article import Article, ConcurrencyLimits, InformationFetchingError
+
+
+class ArticleRegistry:
+    """Process-wide registry of the news articles related to any event, so each article is processed only once
+
+    The same news article is usually related to several events (one per theme of each row, neighbouring provinces
+    and overlapping months). The registry hands out a single `Article` per title and source (see `get_key`), and
+    processes each of them once (see `process_article`). Articles with different titles whose google search
+    finds the same page are also processed once, and share their results.
+
+    If the registry has a path, the results of the successfully built articles are saved to it (see `save`) and
+    loaded by the following runs, which don't process those articles again
+    """
+
+    CONFIG_PATH = os.path.join(os.path.dirname(__file__), "../../config/article/article.json")
+
+    # Built the first time it is needed (see `get_default`)
+    _default_registry = None
+
+    def __init__(self, path: str | None = None):
+        """
+        :param path: Json file with the results of the articles of previous runs. Created by `save` if it doesn't
+            exist (Default: not persistent)
+        """
+        self.path = path
+        self._articles: dict[tuple[str, str], Article] = {}
+        # First article of each page (by normalized link), whose processing is shared by the articles of the page
+        self._articles_by_link: dict[str, Article] = {}
+        self._processings = SingleFlightCache()
+        self._page_processings = SingleFlightCache()
+        self._saved_records: dict[tuple[str, str], dict] = {}
+        if path is not None and os.path.exists(path):
+            with open(path, encoding="utf-8") as fstream:
+                for record in json.load(fstream):
+                    self._saved_records[self.get_key(record["title"], record["source_name"])] = record
+
+    @classmethod
+    def get_default(cls) -> ArticleRegistry:
+        """Returns the registry configured in CONFIG_PATH ('registry_path', relative to the config),
+        building it on the first call"""
+        if cls._default_registry is None:
+            registry_path = Article.get_config().get("registry_path")
+            if registry_path is not None:
+                registry_path = os.path.normpath(os.path.join(os.path.dirname(cls.CONFIG_PATH), registry_path))
+            cls._default_registry = ArticleRegistry(registry_path)
+        return cls._default_registry
+
+    @staticmethod
+    def get_key(title: str, source_name: str | None) -> tuple[str, str]:
+        """Articles with the same key are the same news article. Titles are compared ignoring case and spacing"""
+        return " ".join(title.split()).casefold(), (source_name or "").strip()
+
+    def get_article(self, title: str, source_url: str, source_name: str, date: np.datetime64) -> Article:
+        """Returns the registered article with the given title and source, registering a new (unprocessed) one if
+        there isn't any"""
+        key = self.get_key(title, source_name)
+        article = self._articles.get(key)
+        if article is None:
+            article = Article(title_arg=title,
+                              source_url_arg=source_url,
+                              source_name_arg=source_name,
+                              date_arg=date,
+                              do_processing_on_instanciation=False)
+            record = self._saved_records.get(key)
+            if record is not None:
+                self._restore_results(article, record)
+            self._articles[key] = article
+        return article
+
+    async def process_article(self,
+                              article: Article,
+                              session: aiohttp.ClientSession,
+                              limits: ConcurrencyLimits) -> None:
+        """Processes an article of the registry (see `Article.async_process_article`), unless it has already been
+        processed, in which case it does nothing, or is being processed, in which case it waits for it"""
+        await self._processings.get(self.get_key(article.title, article.source_name),
+                                    lambda: self._process_article(article, session, limits))
+
+    async def _process_article(self, article: Article, session: aiohttp.ClientSession, limits: ConcurrencyLimits):
+        if article.sucessfully_built:
+            return None
+        if article.link is None:
+            try:
+                async with limits.searches:
+                    await asyncio.to_thread(article.obtain_link_by_google)
+            except InformationFetchingError as e:
+                print(f"Error building {article.title}; Message: {e.message}; Exception ocurred: {e.inner_exception}")
+                return None
+        # Articles with the same page are only processed once
+        link = HttpCache.normalize_url(article.link)
+        page_article = self._articles_by_link.setdefault(link, article)
+        await self._page_processings.get(link, lambda: page_article.async_process_article(session, limits))
+        if page_article is not article:
+            article.copy_results_from(page_article)
+        return None
+
+    def save(self) -> None:
+        """Saves the results of the successfully built articles (including the previously saved ones) to the path
+        of the registry. Does nothing if it has no path"""
+        if self.path is None:
+            return None
+        records = dict(self._saved_records)
+        for key, article in self._articles.items():
+            if article.sucessfully_built:
+                records[key] = self._get_results(article)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        # Written to a temporary file first, so an interrupted save doesn't corrupt the registry
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(file_descriptor, "w", encoding="utf-8") as fstream:
+            json.dump(list(records.values()), fstream, ensure_ascii=False)
+        os.replace(temporary_path, self.path)
+        self._saved_records = records
+        return None
+
+    @staticmethod
+    def _get_results(article: Article) -> dict:
+        return {"title": article.title,
+                "source_url": article.source_url,
+                "source_name": article.source_name,
+                "date": str(article.date),
+                "link": article.link,
+                "sectors": article.sectors,
+                # Json keys are strings, so the question ids are stored as pairs
+                "answers": list(article.answers.items()),
+                "severity": article.severity}
+
+    @staticmethod
+    def _restore_results(article: Article, record: dict) -> None:
+        article.link = record["link"]
+        article.sectors = record["sectors"]
+        article.answers = {question_id: answer for question_id, answer in record["answers"]}
+        article.severity = record["severity"]
+        article.sucessfully_built = True
+
+    def clear(self) -> None:
+        """Forgets the articles registered in this process. The saved results are kept"""
+        self._articles.clear()
+        self._articles_by_link.clear()
+        self._processings = SingleFlightCache()
+        self._page_processings = SingleFlightCache()
+
+    def __len__(self):
+        """Number of articles registered in this process"""
+        return len(self._articles)
+
+    def __repr__(self):
+        n_of_built = sum(article.sucessfully_built for article in self._articles.values())
+        return (f"<ArticleRegistry: {len(self)} articles ({n_of_built} built), "
+                f"{len(self._saved_records)} saved results>")
@@ -1,10 +1,10 @@
 from __future__ import annotations
 
+import os
+import time
 import warnings
-from datetime import datetime
 from typing import Callable, Generator, Coroutine
 
-from bs4 import BeautifulSoup as soup
 from urllib.request import urlopen
 import pandas as pd
 import numpy as np
@@ -12,8 +12,33 @@ import json
 import asyncio
 import aiohttp
 
-from source.scraping.article import Article
+from source.scraping.article import Article, ConcurrencyLimits
+from source.scraping.article_registry import ArticleRegistry
+from source.scraping.feed_reader import FeedReader
 from source.common.merge_dictionaries import merge_dicts
+from source.common.frame_storage import read_frame
+from source.common.http_cache import HttpCache
+from source.common.single_flight import SingleFlightCache
+
+
+class ExtractionProgress:
+    """Counters of an ongoing extraction of info from a list of events (see `Event.extract_info_events`)"""
+
+    def __init__(self, n_of_events: int):
+        self.n_of_events = n_of_events
+        self.n_of_finished_events = 0
+        self.n_of_failed_events = 0
+        self.n_of_articles = 0
+        self.n_of_built_articles = 0
+        self.start_time = time.monotonic()
+
+    def get_elapsed_seconds(self) -> float:
+        return time.monotonic() - self.start_time
+
+    def __repr__(self):
+        return (f"<ExtractionProgress: {self.n_of_finished_events}/{self.n_of_events} events "
+                f"({self.n_of_failed_events} failed), {self.n_of_built_articles}/{self.n_of_articles} articles built, "
+                f"{self.get_elapsed_seconds():.0f}s>")
 
 
 class Event:
@@ -22,9 +47,11 @@ class Event:
     INPUT_PATH = ""
     OUTPUT_PATH = ""
 
-    CONFIG_PATH = "../config/event/event.json"
-    with open(CONFIG_PATH) as fstream:
-        CONFIG = json.load(fstream)
+    CONFIG_PATH = os.path.join(os.path.dirname(__file__), "../../config/event/event.json")
+    # Loaded the first time it is needed (see `get_config`)
+    _config = None
+    # Items of the news feeds fetched by any event, by url (see `_async_get_related_news_task`)
+    _feed_cache = SingleFlightCache()
 
     def __init__(self,
                  theme_arg: str,
@@ -40,6 +67,14 @@ class Event:
         self.end_time = end_time
         self.related_articles = None
 
+    @classmethod
+    def get_config(cls) -> dict:
+        """Returns the config in CONFIG_PATH, reading it on the first call"""
+        if cls._config is None:
+            with open(cls.CONFIG_PATH) as fstream:
+                cls._config = json.load(fstream)
+        return cls._config
+
     def get_related_news(self,
                          query_generator: Callable[[Event], str],
                          do_date_filter: bool = True,
@@ -72,9 +107,30 @@ class Event:
                 event.build_related_articles()
 
     @staticmethod
-    async def _fetch(url, session):
+    async def _fetch(url: str,
+                     session: aiohttp.ClientSession,
+                     check: Callable[[bytes], None] | None = None) -> bytes:
+        """Returns the body of a url, from the http cache if possible (see `HttpCache.get_default`)
+
+        :param check: Raises if a body is not valid, before it is returned or cached (Default: no check)
+        :except CacheMissError: If the url is not cached and the cache is offline
+        :except aiohttp.ClientResponseError: If the response is an error (eg: 429 or 503), so its body is neither
+            cached nor taken for the requested one"""
+        cache = HttpCache.get_default()
+        body = await asyncio.to_thread(cache.get, url)
+        if body is not None:
+            if check is not None:
+                check(body)
+            return body
+        cache.check_online(url)
         async with session.get(url) as response:
-            return await response.text()
+            response.raise_for_status()
+            body = await response.read()
+        if check is not None:
+            check(body)
+        if response.status == 200:
+            await asyncio.to_thread(cache.put, url, body)
+        return body
 
     @staticmethod
     async def _async_get_related_news(events: Event | list[Event],
@@ -96,39 +152,35 @@ class Event:
                                            session: aiohttp.ClientSession,
                                            query_generator: Callable[[Event], str],
                                            do_date_filter: bool = True) -> None:
-        """Asyncronous search of related articles
-        :exception NotImplementedError: Asyncronous article processing is not yet supported.
-            Setting do_article_processing to True will cause an exception to be raised"""
-        # TODO modify to integrate the filtering in the fetching process
+        """Asyncronous search of related articles. Their processing is done separately
+        (see `_async_build_related_articles`)"""
         try:
             # Convertir el tema en un formato adecuado para la URL
             # formatted_theme = self.theme.replace(' ', '+')
             url_google_news = \
                 f'https://news.google.com/rss/search?q={query_generator(self)}&hl=es&gl=US&ceid=US:es-419'
 
-            # Conexión
-            contenido_xml = await Event._fetch(url_google_news, session)
-
-            # Lectura en el formato XML
-            pagina = soup(contenido_xml, 'xml')
-            items = pagina.findAll('item')
+            # Many events share the same query, which is only fetched once, and its items only parsed once
+            feed = await Event._feed_cache.get(url_google_news, lambda: Event._fetch_feed(url_google_news, session))
 
-            # Lista para almacenar las noticias
+            # The items are filtered by date and deduplicated before instanciating their Articles,
+            # and the feed is only read until enough Articles are found
+            max_articles = self.get_config()["max_articles_per_event"]
+            start_time, end_time = self.get_article_time_window()
+            # The Articles are shared with the other events that found them (see `ArticleRegistry`)
+            registry = ArticleRegistry.get_default()
             articles = []
-
-            # Instanciate the Articles, toggling the automatic processing off
-            for item in items[:self.CONFIG["max_articles_per_event"]]:
-                articles.append(Article(
-                    title_arg=item.title.text,
-                    source_url_arg=item.source.get("url"),
-                    source_name_arg=item.source.text,
-                    date_arg=np.datetime64(datetime.strptime(item.pubDate.text, "%a, %d %b %Y %H:%M:%S %Z")),
-                    do_processing_on_instanciation=False
-                ))
-
-            # Filter out irrelevent articles
-            if do_date_filter:
-                articles = self.filter_articles_by_date(articles)
+            seen_keys = set()
+            for item in feed:
+                if len(articles) >= max_articles:
+                    break
+                if do_date_filter and not start_time <= item.date <= end_time:
+                    continue
+                key = registry.get_key(item.title, item.source_name)
+                if key in seen_keys:
+                    continue
+                seen_keys.add(key)
+                articles.append(registry.get_article(item.title, item.source_url, item.source_name, item.date))
             self.related_articles = articles
 
         except Exception as e:
@@ -136,6 +188,18 @@ class Event:
             print("Error al obtener noticias:")
             raise e
 
+    @staticmethod
+    async def _fetch_feed(url: str, session: aiohttp.ClientSession) -> FeedReader:
+        """Fetches a Google News RSS feed. Its items are parsed when they are read, but the whole feed is checked
+        first (see `FeedReader.validate`), so failed requests and malformed feeds raise here and are neither cached
+        nor memoized by `_feed_cache`"""
+        return FeedReader(await Event._fetch(url, session, check=FeedReader.validate))
+
+    @classmethod
+    def clear_feed_cache(cls) -> None:
+        """Forgets the fetched feeds, so the next searches fetch them again"""
+        cls._feed_cache.clear()
+
     def build_related_articles(self) -> None:
         """Builds related articles. Discards those news who couldn't be built"""
         if self.related_articles is None:
@@ -144,14 +208,11 @@ class Event:
             article.process_article()
         self.related_articles = [article for article in self.related_articles if article.sucessfully_built]
 
-    def filter_articles_by_date(self, articles: list[Article]) -> list[Article]:
-        effective_end_time = self.end_time + pd.Timedelta(days=self.CONFIG["article_days_leniency"]).to_timedelta64()
-
-        def filter_key(article: Article) -> bool:
-            return self.start_time <= article.date <= effective_end_time
-
-        filtered_news = list(filter(filter_key, articles))
-        return filtered_news
+    def get_article_time_window(self) -> tuple[np.datetime64, np.datetime64]:
+        """Returns the first and last dates of the articles related to self"""
+        days_leniency = pd.Timedelta(days=self.get_config()["article_days_leniency"])
+        effective_end_time = pd.Timestamp(self.end_time) + days_leniency
+        return pd.Timestamp(self.start_time).to_datetime64(), effective_end_time.to_datetime64()
 
     @staticmethod
     def filter_out_irrelevant_events(events_arg: list[Event]) -> list[Event]:
@@ -170,8 +231,9 @@ class Event:
 
     @classmethod
     def from_csv(cls) -> list[Event]:
-        """The input path is defined as a class attribute"""
-        df = pd.read_csv(cls.INPUT_PATH, parse_dates=["date"])
+        """The input path is defined as a class attribute
+        The format is chosen by the extension of the path (see `common.frame_storage`)"""
+        df = read_frame(cls.INPUT_PATH)
         possible_themes_dictionary = {  # TODO REFINE THIS DICTIONARY
             "CAUSAS NATURALES/INUNDACIÓN EXTRAORDINARIA":
                 ["Inundacion", "Luvias Torrenciales", "Desbordamiento de rìos"],
@@ -216,14 +278,72 @@ class Event:
     @staticmethod
     def extract_info_events(events: list[Event],
                             query_generator: Callable[[Event], str],
-                            do_relevancy_filter: bool = True) -> list[Event]:
-        """In-place extraction of info from a list of disaster"""
-        for event in events:
-            event.get_related_news(query_generator)
+                            do_relevancy_filter: bool = True,
+                            on_event_done: Callable[[Event, ExtractionProgress], None] | None = None) -> list[Event]:
+        """In-place extraction of info from a list of disaster
+
+        All the events are processed concurrently in a single event loop (see `_async_extract_info_events`)
+
+        :param on_event_done: Called as soon as each event is processed, with the event (a partial result) and the
+            progress of the extraction
+        """
+        asyncio.run(Event._async_extract_info_events(events, query_generator, on_event_done))
         if do_relevancy_filter:
             events = Event.filter_out_irrelevant_events(events)
         return events
 
+    @staticmethod
+    async def _async_extract_info_events(events: list[Event],
+                                         query_generator: Callable[[Event], str],
+                                         on_event_done: Callable[[Event, ExtractionProgress], None] | None = None,
+                                         do_date_filter: bool = True) -> ExtractionProgress:
+        """Fetches the related news of each event and processes their articles, sharing a single session
+
+        The fetching of the news of an event, of the pages of its articles and the OpenAI calls of different
+        events overlap. The number of concurrent requests (in total and per host) is limited by the connection
+        pool of the session, and the number of concurrent searches and completions by `ConcurrencyLimits`,
+        according to the config. The events whose news cannot be fetched are left without related articles"""
+        config = Event.get_config()
+        progress = ExtractionProgress(len(events))
+        limits = ConcurrencyLimits(config["max_concurrent_searches"], config["max_concurrent_completions"])
+        connector = aiohttp.TCPConnector(limit=config["max_concurrent_requests"],
+                                         limit_per_host=config["max_requests_per_host"])
+
+        async def extract_info_event(event: Event, session: aiohttp.ClientSession) -> Event:
+            try:
+                await event._async_get_related_news_task(session, query_generator, do_date_filter)
+                await event._async_build_related_articles(session, limits, progress)
+            except Exception as e:
+                progress.n_of_failed_events += 1
+                print(f"Error extracting info of {event}; Exception ocurred: {e!r}")
+            return event
+
+        async with aiohttp.ClientSession(connector=connector) as session:
+            for finished_event in asyncio.as_completed([extract_info_event(event, session) for event in events]):
+                event = await finished_event
+                progress.n_of_finished_events += 1
+                if on_event_done is not None:
+                    on_event_done(event, progress)
+        ArticleRegistry.get_default().save()
+        return progress
+
+    async def _async_build_related_articles(self,
+                                            session: aiohttp.ClientSession,
+                                            limits: ConcurrencyLimits,
+                                            progress: ExtractionProgress | None = None) -> None:
+        """Same as `build_related_articles`, processing the articles concurrently. Articles shared with other
+        events are only processed once (see `ArticleRegistry.process_article`)"""
+        if self.related_articles is None:
+            return None
+        if progress is not None:
+            progress.n_of_articles += len(self.related_articles)
+        registry = ArticleRegistry.get_default()
+        await asyncio.gather(*(registry.process_article(article, session, limits) for article in self.related_articles))
+        self.related_articles = [article for article in self.related_articles if article.sucessfully_built]
+        if progress is not None:
+            progress.n_of_built_articles += len(self.related_articles)
+        return None
+
     @staticmethod
     def get_articles_iterable(events: list[Event]) -> Generator[Article, None, None]:
         """Generator that yields all the related articles in a list of articles"""
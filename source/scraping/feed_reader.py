@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+from email.utils import parsedate_to_datetime
+from io import BytesIO
+from typing import Iterator
+
+import numpy as np
+from lxml import etree
+
+
+class FeedItem:
+    """An item of an RSS feed, with the arguments needed to build its `Article`"""
+
+    __slots__ = ("title", "source_url", "source_name", "date")
+
+    def __init__(self, title: str, source_url: str | None, source_name: str | None, date: np.datetime64):
+        self.title = title
+        self.source_url = source_url
+        self.source_name = source_name
+        self.date = date
+
+    def __repr__(self):
+        return f"<FeedItem: {self.title}, {self.source_name}, {self.date}>"
+
+
+class FeedReader:
+    """Incremental reader of the items of an RSS feed
+
+    The feed is parsed with `lxml.etree.iterparse` only as far as its items are requested, and each parsed item
+    is freed from the tree. Parsed items are kept, so several readers of the same feed (like the events sharing
+    a query) only parse it once and stop as soon as each one has enough items
+    """
+
+    MONTHS = {"Jan": 1, "Feb": 2, "Mar": 3, "Apr": 4, "May": 5, "Jun": 6,
+              "Jul": 7, "Aug": 8, "Sep": 9, "Oct": 10, "Nov": 11, "Dec": 12}
+
+    def __init__(self, body: bytes):
+        """
+        :param body: The contents of the feed
+        """
+        self._body = body
+        self._items: list[FeedItem] = []
+        self._parser: Iterator[FeedItem] | None = self._parse_items()
+        self._error: Exception | None = None
+
+    def __iter__(self) -> Iterator[FeedItem]:
+        """Yields the items of the feed in order, parsing them when needed
+        :except lxml.etree.XMLSyntaxError: When the malformed part of the feed is reached"""
+        position = 0
+        while True:
+            if position < len(self._items):
+                yield self._items[position]
+                position += 1
+                continue
+            if self._parser is None:
+                if self._error is not None:
+                    raise self._error
+                return None
+            try:
+                self._items.append(next(self._parser))
+            except StopIteration:
+                self._parser = None
+            except Exception as e:
+                self._parser = None
+                self._error = e
+
+    @staticmethod
+    def validate(body: bytes) -> None:
+        """Checks that the whole of a feed is a well-formed RSS document, without parsing its items
+        (error pages and truncated feeds would otherwise only fail once their items are read)
+
+        :except lxml.etree.XMLSyntaxError: If the feed is malformed, empty or truncated
+        :except ValueError: If the document is not an RSS feed (eg: an html page)
+        """
+        root = etree.fromstring(body)
+        if root.tag != "rss":
+            raise ValueError(f"The document is not an RSS feed, its root element is <{root.tag}>")
+
+    def _parse_items(self) -> Iterator[FeedItem]:
+        for _, element in etree.iterparse(BytesIO(self._body), events=("end",), tag="item"):
+            source = element.find("source")
+            yield FeedItem(title=element.findtext("title", default=""),
+                           source_url=None if source is None else source.get("url"),
+                           source_name=None if source is None else source.text,
+                           date=self.parse_pub_date(element.findtext("pubDate")))
+            # Free the parsed items
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+        self._body = None
+
+    @classmethod
+    def parse_pub_date(cls, text: str | None) -> np.datetime64:
+        """Parses an RFC 822 date (eg: 'Wed, 02 Oct 2024 07:00:00 GMT'), ignoring its time zone like
+        `datetime.strptime(text, "%a, %d %b %Y %H:%M:%S %Z")`. Unparseable dates are NaT"""
+        if text is None:
+            return np.datetime64("NaT", "s")
+        parts = text.split()
+        # Fast path for the format of Google News, without the weekday
+        if len(parts) >= 5 and parts[2] in cls.MONTHS and parts[1].isdigit() and len(parts[4]) == 8:
+            try:
+                return np.datetime64(f"{parts[3]}-{cls.MONTHS[parts[2]]:02d}-{int(parts[1]):02d}T{parts[4]}", "s")
+            except ValueError:
+                pass
+        try:
+            date = parsedate_to_datetime(text)
+        except (TypeError, ValueError):
+            return np.datetime64("NaT", "s")
+        return np.datetime64(date.replace(tzinfo=None), "s")
+
+    def __repr__(self):
+        return f"<FeedReader: {len(self._items)} items parsed{'' if self._parser is None else ' so far'}>"
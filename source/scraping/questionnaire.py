@@ -1,4 +1,5 @@
 import json
+import os
 from typing import Iterator
 
 
@@ -20,24 +21,36 @@ class Question:
 
 
 class Questionnaire:
-    QUESTIONS_PATH = "../data/gpt_parser_data/questions.json"
+    QUESTIONS_PATH = os.path.join(os.path.dirname(__file__), "../../data/gpt_parser_data/questions.json")
 
-    with open(QUESTIONS_PATH) as fstream:
-        raw_questions = json.load(fstream)
-        questions, sectors_descriptions, sector_weight_sum = {}, {}, {}
-    for sector in raw_questions.keys():
-        curr_questions = []
-        for q in raw_questions[sector]["questions"]:
-            curr_questions.append(Question(sector, q["q"], q["w"]))
-        questions[sector] = curr_questions
-        sectors_descriptions[sector] = raw_questions[sector]["description"]
-        sector_weight_sum[sector] = sum([q.weight for q in questions.get(sector)])
-    del raw_questions, curr_questions
+    # Loaded the first time they are needed (see `load_questions`)
+    questions, sectors_descriptions, sector_weight_sum = None, None, None
 
     def __init__(self, sectors_arg: list[str]):
         self.sectors = sectors_arg
 
+    @classmethod
+    def load_questions(cls) -> None:
+        """Reads the questions in QUESTIONS_PATH. Does nothing if they are already loaded"""
+        if cls.questions is not None:
+            return None
+        with open(cls.QUESTIONS_PATH) as fstream:
+            raw_questions = json.load(fstream)
+        questions, sectors_descriptions, sector_weight_sum = {}, {}, {}
+        for sector in raw_questions.keys():
+            curr_questions = []
+            for q in raw_questions[sector]["questions"]:
+                curr_questions.append(Question(sector, q["q"], q["w"]))
+            questions[sector] = curr_questions
+            sectors_descriptions[sector] = raw_questions[sector]["description"]
+            sector_weight_sum[sector] = sum([q.weight for q in questions.get(sector)])
+        cls.questions = questions
+        cls.sectors_descriptions = sectors_descriptions
+        cls.sector_weight_sum = sector_weight_sum
+        return None
+
     def __iter__(self) -> Iterator[Question]:
+        self.load_questions()
         for sector in self.sectors:
             sector_questions = self.questions.get(sector)
             if sector_questions is None:
@@ -47,14 +60,17 @@ class Questionnaire:
 
     @classmethod
     def get_sector_list(cls) -> list[str]:
+        cls.load_questions()
         return list(cls.questions.keys())
 
     @classmethod
     def get_sector_descriptions(cls):
+        cls.load_questions()
         return cls.sectors_descriptions
 
     @classmethod
     def get_question_id_dict(cls) -> dict[int, str]:
+        cls.load_questions()
         question_dict = {}
         for sector_questions in cls.questions.values():
             for q in sector_questions:
@@ -70,6 +86,7 @@ class Questionnaire:
         :param answers: A dictionary of answers to questuons in which keys are the id of the question being answered
             missing answers are considered as false
         :return: A dictionary in which each sector is a sector their value represents their score over 1"""
+        self.load_questions()
         # Initialize sector scores
         actual_scores = {}
         for sector in self.sectors:
@@ -92,6 +109,7 @@ class Questionnaire:
 
 
 if __name__ == '__main__':
+    Questionnaire.load_questions()
     print(Questionnaire.questions)
     questionnaire_test = Questionnaire(["Agua y Alimentos", "Transporte"])
     answers_test = {14: True, 1: False, 16: True, 15: False, 7: True}
@@ -0,0 +1,95 @@
+import os
+import tempfile
+
+import numpy as np
+
+from source.data_merger.cluster_store import ClusterStore
+
+
+def make_store(n_of_rows: int, seed: int) -> ClusterStore:
+    rng = np.random.default_rng(seed)
+    start_days = rng.integers(0, 1000, n_of_rows)
+    return ClusterStore(row_indexes=np.arange(n_of_rows) + 7,
+                        start_days=start_days,
+                        end_days=start_days + rng.integers(0, 5, n_of_rows),
+                        total_costs=np.where(rng.random(n_of_rows) < 0.05, np.nan, rng.exponential(100, n_of_rows)),
+                        claims=rng.integers(1, 10, n_of_rows),
+                        disaster_codes=np.zeros(n_of_rows, dtype=np.int64),
+                        province_masks=np.uint64(1) << rng.integers(0, 50, n_of_rows).astype(np.uint64),
+                        neighbourhood_masks=rng.integers(0, 2 ** 62, n_of_rows).astype(np.uint64))
+
+
+def naive_components(n_of_rows: int, first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    """Lowest row of the component of each row, joining one pair at a time"""
+    parent = list(range(n_of_rows))
+
+    def find(x: int) -> int:
+        while parent[x] != x:
+            x = parent[x]
+        return x
+
+    for a, b in zip(first.tolist(), second.tolist()):
+        root_a, root_b = find(a), find(b)
+        parent[max(root_a, root_b)] = min(root_a, root_b)
+    return np.array([find(x) for x in range(n_of_rows)])
+
+
+def check_aggregates(store: ClusterStore, initial: ClusterStore) -> None:
+    """The aggregates of each cluster are those of its rows in the initial store"""
+    for cluster_id in store.get_cluster_ids():
+        rows = store.get_members(cluster_id) - 7
+        assert store.start_days[cluster_id] == initial.start_days[rows].min()
+        assert store.end_days[cluster_id] == initial.end_days[rows].max()
+        assert np.isclose(store.total_costs[cluster_id], initial.total_costs[rows].sum())
+        assert store.claims[cluster_id] == initial.claims[rows].sum()
+        assert store.province_masks[cluster_id] == np.bitwise_or.reduce(initial.province_masks[rows])
+        assert store.neighbourhood_masks[cluster_id] == np.bitwise_or.reduce(initial.neighbourhood_masks[rows])
+
+
+def test_merge_pairs_matches_naive_union_find():
+    n_of_rows = 2000
+    rng = np.random.default_rng(0)
+    store, initial = make_store(n_of_rows, 0), make_store(n_of_rows, 0)
+    all_first, all_second = [], []
+    for _ in range(5):
+        first, second = rng.integers(0, n_of_rows, (2, 600))
+        n_of_clusters = len(store.get_cluster_ids())
+        n_of_merges = store.merge_pairs(first, second)
+        assert len(store.get_cluster_ids()) == n_of_clusters - n_of_merges
+        all_first.append(first)
+        all_second.append(second)
+    expected_roots = naive_components(n_of_rows, np.concatenate(all_first), np.concatenate(all_second))
+    # The id of each cluster is its lowest row
+    assert (store.find(np.arange(n_of_rows)) == expected_roots).all()
+    assert (store.get_cluster_ids() == np.unique(expected_roots)).all()
+    check_aggregates(store, initial)
+    # Merging two rows of the same cluster changes nothing
+    assert store.merge_pairs(np.array([expected_roots[5]]), np.array([5])) == 0
+    assert store.merge(3, 1500) == min(store.find(3), store.find(1500))
+    check_aggregates(store, initial)
+
+
+def test_save_load_and_append():
+    store, initial = make_store(500, 1), make_store(500, 1)
+    rng = np.random.default_rng(1)
+    store.merge_pairs(*rng.integers(0, 500, (2, 300)))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "clusters.npz")
+        store.save(path)
+        loaded = ClusterStore.load(path)
+    assert (loaded.find(np.arange(500)) == store.find(np.arange(500))).all()
+    check_aggregates(loaded, initial)
+
+    # Appended clusters keep their structure, shifted by the length of the store
+    other = make_store(200, 2)
+    other.merge_pairs(np.array([0, 1]), np.array([5, 6]))
+    loaded.append(other)
+    assert len(loaded) == 700
+    assert loaded.find(505) == 500 and loaded.find(506) == 501
+    assert (loaded.find(np.arange(500)) == store.find(np.arange(500))).all()
+
+
+if __name__ == '__main__':
+    test_merge_pairs_matches_naive_union_find()
+    test_save_load_and_append()
+    print("All the cluster store tests passed")
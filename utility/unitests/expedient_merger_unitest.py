@@ -0,0 +1,89 @@
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from source.common.frame_storage import read_frame, iter_frame_chunks, get_frame_columns, get_frame_signature
+from source.data_merger.disaster_merger_1 import ExpedientMerger
+
+RAW_COLUMNS = ['ID RMC', 'ID CAUSA SINIESTRO', 'MUNICIPIO', 'POBLACION', 'CLASE RIESGO N1', 'CLASE RIESGO N2',
+               'FECHA SINIESTRO', 'CAUSA SINIESTRO', 'PROVINCIA', ' COSTE TOTAL ', 'CODIGO POSTAL']
+
+
+def make_raw_expedients(n_of_rows: int, seed: int) -> pd.DataFrame:
+    """Random raw expedients, sorted by date, in the format of the input of `ExpedientMerger`"""
+    rng = np.random.default_rng(seed)
+    dates = np.sort(pd.Timestamp("2022-01-01") + pd.to_timedelta(rng.integers(0, 400, n_of_rows), unit="D"))
+    costs = [f"{cost:,}".replace(",", ".") for cost in rng.integers(10, 200000, n_of_rows)]
+    return pd.DataFrame({'ID RMC': np.arange(n_of_rows), 'ID CAUSA SINIESTRO': 1, 'MUNICIPIO': "x",
+                         'POBLACION': "y", 'CLASE RIESGO N1': "a", 'CLASE RIESGO N2': "b",
+                         'FECHA SINIESTRO': pd.DatetimeIndex(dates).strftime("%d/%m/%Y"),
+                         'CAUSA SINIESTRO': rng.choice(["CAUSAS NATURALES/INUNDACIÓN EXTRAORDINARIA",
+                                                        "CAUSAS NATURALES/EMBATE DE MAR"], n_of_rows),
+                         'PROVINCIA': rng.choice(["Madrid", "Coruña, A", "Valencia/València", "Sevilla"], n_of_rows),
+                         ' COSTE TOTAL ': costs,
+                         'CODIGO POSTAL': rng.integers(1000, 1100, n_of_rows)})[RAW_COLUMNS]
+
+
+def canonical_runs(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.astype({"province": str, "disaster": str})
+    df["postal_codes"] = [tuple(int(code) for code in codes) for codes in df["postal_codes"]]
+    return df.sort_values(by=["province", "disaster", "date"]).reset_index(drop=True)
+
+
+def test_incremental_merge_matches_full_merge():
+    raw_expedients = make_raw_expedients(1500, 0)
+    # Batches are split by rows, so the days on their limits are split between two batches
+    batches = np.array_split(np.arange(len(raw_expedients)), 5)
+    with tempfile.TemporaryDirectory() as directory:
+        ExpedientMerger.INPUT_PATH = os.path.join(directory, "raw.csv")
+        raw_expedients.to_csv(ExpedientMerger.INPUT_PATH, sep=";", index=False)
+        ExpedientMerger.OUTPUT_PATH = os.path.join(directory, "full.parquet")
+        ExpedientMerger.merge_csv()
+        expected = canonical_runs(read_frame(ExpedientMerger.OUTPUT_PATH))
+
+        for extension in ["csv", "parquet"]:
+            ExpedientMerger.OUTPUT_PATH = os.path.join(directory, f"incremental.{extension}")
+            ExpedientMerger.STATE_PATH = os.path.join(directory, f"state_{extension}.parquet")
+            for i, rows in enumerate(batches):
+                ExpedientMerger.INPUT_PATH = os.path.join(directory, f"batch_{i}.csv")
+                raw_expedients.iloc[rows].to_csv(ExpedientMerger.INPUT_PATH, sep=";", index=False)
+                if i == 0:
+                    ExpedientMerger.merge_csv()
+                    continue
+                signature = get_frame_signature(ExpedientMerger.OUTPUT_PATH)
+                ExpedientMerger.merge_csv_incremental()
+                if extension == "parquet" and i > 1:
+                    # Only the last part, with the last runs, is replaced. The closed runs are appended in a new part
+                    new_signature = get_frame_signature(ExpedientMerger.OUTPUT_PATH)
+                    assert new_signature[:-2] == signature[:-1] and len(new_signature) == len(signature) + 1
+            result = canonical_runs(read_frame(ExpedientMerger.OUTPUT_PATH))
+            pd.testing.assert_frame_equal(result, expected, check_dtype=False, check_exact=False)
+            chunks = pd.concat(iter_frame_chunks(ExpedientMerger.OUTPUT_PATH, 100))
+            pd.testing.assert_frame_equal(canonical_runs(chunks), expected, check_dtype=False, check_exact=False)
+            assert get_frame_columns(ExpedientMerger.OUTPUT_PATH) == list(chunks.columns)
+            # The persisted state is the last run of each province and disaster
+            state = canonical_runs(read_frame(ExpedientMerger.STATE_PATH))
+            last_runs = expected[ExpedientMerger.find_last_runs(expected)].reset_index(drop=True)
+            pd.testing.assert_frame_equal(state, last_runs, check_dtype=False, check_exact=False)
+
+            # Days previous to the last runs cannot be merged incrementally
+            ExpedientMerger.INPUT_PATH = os.path.join(directory, "batch_0.csv")
+            try:
+                ExpedientMerger.merge_csv_incremental()
+            except ValueError:
+                pass
+            else:
+                raise AssertionError("Merging old days incrementally must raise ValueError")
+
+        # A full merge replaces the partitioned output
+        ExpedientMerger.INPUT_PATH = os.path.join(directory, "raw.csv")
+        ExpedientMerger.merge_csv()
+        result = canonical_runs(read_frame(ExpedientMerger.OUTPUT_PATH))
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False, check_exact=False)
+
+
+if __name__ == '__main__':
+    test_incremental_merge_matches_full_merge()
+    print("All the expedient merger tests passed")
@@ -0,0 +1,97 @@
+import os
+import tempfile
+
+from source.common.http_cache import HttpCache, CacheMissError
+
+
+def age_entry(cache: HttpCache, url: str, seconds: float) -> None:
+    """Makes a cached body look *seconds* older, both its storing time and its last use"""
+    file_path = cache.get_file_path(url)
+    with open(file_path, "rb") as fstream:
+        data = fstream.read()
+    stored_time = cache._HEADER.unpack_from(data)[0] - seconds
+    with open(file_path, "wb") as fstream:
+        fstream.write(cache._HEADER.pack(stored_time) + data[cache._HEADER.size:])
+    os.utime(file_path, (stored_time, stored_time))
+
+
+def test_normalized_urls_share_entries():
+    with tempfile.TemporaryDirectory() as directory:
+        cache = HttpCache(directory)
+        cache.put("HTTPS://News.Example.com:443/a?b=2&a=1#fragment", b"body")
+        assert cache.get("https://news.example.com/a?a=1&b=2") == b"body"
+        assert cache.get("https://news.example.com/a?a=1") is None
+        assert cache.n_of_hits == 1 and cache.n_of_misses == 1
+        assert len(cache) == 1
+
+
+def test_time_to_live_and_offline_mode():
+    with tempfile.TemporaryDirectory() as directory:
+        cache = HttpCache(directory, ttl_seconds=3600)
+        cache.put("https://example.com/old", b"old")
+        cache.put("https://example.com/new", b"new")
+        age_entry(cache, "https://example.com/old", 7200)
+        assert cache.get("https://example.com/old") is None
+        assert cache.get("https://example.com/new") == b"new"
+        cache.check_online("https://example.com/missing")
+
+        # Offline caches serve expired bodies, as they cannot be downloaded again
+        offline_cache = HttpCache(directory, ttl_seconds=3600, offline=True)
+        assert offline_cache.get("https://example.com/old") == b"old"
+        assert offline_cache.get("https://example.com/missing") is None
+        try:
+            offline_cache.check_online("https://example.com/missing")
+        except CacheMissError as e:
+            assert e.url == "https://example.com/missing"
+        else:
+            raise AssertionError("An offline cache must raise CacheMissError for missing urls")
+        offline_cache.evict()
+        assert offline_cache.get("https://example.com/old") == b"old"
+
+        # Online evictions remove the bodies that haven't been used for longer than the time to live
+        age_entry(cache, "https://example.com/old", 7200)
+        cache.evict()
+        assert len(cache) == 1
+
+
+def test_eviction_of_least_recently_used():
+    with tempfile.TemporaryDirectory() as directory:
+        probe = HttpCache(directory)
+        probe.put("https://example.com/probe", os.urandom(1000))
+        entry_size = os.path.getsize(probe.get_file_path("https://example.com/probe"))
+        probe.clear()
+        assert len(probe) == 0
+
+        urls = [f"https://example.com/{i}" for i in range(5)]
+        for i, url in enumerate(urls):
+            probe.put(url, os.urandom(1000))
+            age_entry(probe, url, 100 - i)
+        cache = HttpCache(directory, max_size_bytes=int(entry_size * 5.5))
+        # Overwriting an entry doesn't grow the cache
+        for _ in range(10):
+            cache.put(urls[4], os.urandom(1000))
+        assert len(cache) == 5 and cache._size_bytes == cache._compute_size()
+        # Using the oldest entry makes the second oldest the least recently used one
+        assert cache.get(urls[0]) is not None
+        cache.put("https://example.com/5", os.urandom(1000))
+        remaining = [url for url in urls + ["https://example.com/5"] if os.path.exists(cache.get_file_path(url))]
+        assert urls[1] not in remaining and urls[0] in remaining
+        assert cache._compute_size() <= cache.max_size_bytes * cache.EVICTION_TARGET
+
+
+def test_atomic_writes_leave_no_temporary_files():
+    with tempfile.TemporaryDirectory() as directory:
+        cache = HttpCache(directory)
+        for i in range(20):
+            cache.put("https://example.com/same", str(i).encode())
+        assert cache.get("https://example.com/same") == b"19"
+        file_names = [name for _, _, names in os.walk(directory) for name in names]
+        assert len(file_names) == 1 and not file_names[0].endswith(".tmp")
+
+
+if __name__ == '__main__':
+    test_normalized_urls_share_entries()
+    test_time_to_live_and_offline_mode()
+    test_eviction_of_least_recently_used()
+    test_atomic_writes_leave_no_temporary_files()
+    print("All the http cache tests passed")
@@ -0,0 +1,39 @@
+import tempfile
+
+import numpy as np
+
+from source.data_merger.disaster_merger_3 import DisasterLinker
+from source.data_merger.linking_context import LinkingContext
+from source.data_merger.linking_state import LinkingState
+
+from linking_unitest import CONFIGS, make_expedients, canonical_clusters
+
+
+def test_update_matches_create():
+    for seed, config in enumerate(CONFIGS):
+        config = {"debug_messages_on": False, **config}
+        # Shuffled, so the new expedients fall anywhere in time
+        expedients = make_expedients(600, seed + 20).sample(frac=1, random_state=seed).reset_index(drop=True)
+        expected = canonical_clusters(DisasterLinker.link_expedients(LinkingContext(expedients, config)))
+
+        cuts = [int(len(expedients) * fraction) for fraction in [0.7, 0.8, 0.95]] + [len(expedients)]
+        state = LinkingState.create(LinkingContext(expedients.iloc[:cuts[0]].reset_index(drop=True), config))
+        with tempfile.TemporaryDirectory() as directory:
+            for start, end in zip(cuts[:-1], cuts[1:]):
+                state.save(directory)
+                state = LinkingState.load(directory)
+                previous = {disaster.cluster_id: sorted(disaster.indexes) for disaster in state.get_disasters()}
+                changed_ids, removed_ids = state.update(expedients.iloc[start:end])
+                current = {disaster.cluster_id: sorted(disaster.indexes) for disaster in state.get_disasters()}
+                # The changed clusters are exactly the new or modified ones, and the removed ones no longer exist
+                assert set(changed_ids.tolist()) == {cluster_id for cluster_id, rows in current.items()
+                                                     if previous.get(cluster_id) != rows}
+                assert set(removed_ids.tolist()) == set(previous) - set(current)
+                assert (np.diff(changed_ids) > 0).all() and (np.diff(removed_ids) > 0).all()
+        assert len(state) == len(expedients)
+        assert canonical_clusters(state.get_disasters()) == expected
+
+
+if __name__ == '__main__':
+    test_update_matches_create()
+    print("All the linking state tests passed")
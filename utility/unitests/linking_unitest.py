@@ -0,0 +1,138 @@
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+
+from source.common.frame_storage import read_frame
+from source.common.label_registry import LabelRegistry
+from source.data_merger.disaster_merger_3 import DisasterLinker
+from source.data_merger.linking_context import LinkingContext
+
+
+def make_expedients(n_of_rows: int, seed: int, n_of_provinces: int = 12) -> pd.DataFrame:
+    """Random merged expedients, dense enough in time and space for long chains of links"""
+    rng = np.random.default_rng(seed)
+    provinces = LabelRegistry.get_provinces()[:n_of_provinces]
+    return pd.DataFrame({
+        "date": pd.Timestamp("2023-01-01") + pd.to_timedelta(rng.integers(0, 120, n_of_rows), unit="D"),
+        "disaster": rng.choice(LabelRegistry.KNOWN_DISASTERS[:2], n_of_rows),
+        "province": rng.choice(provinces, n_of_rows),
+        "total_cost": rng.exponential(1000, n_of_rows).round(2),
+        "claims": rng.integers(1, 20, n_of_rows),
+        "postal_codes": [np.unique(rng.integers(1000, 1400, rng.integers(1, 4))).astype(np.int32)
+                         for _ in range(n_of_rows)],
+        "duration": rng.integers(1, 4, n_of_rows),
+    })
+
+
+def brute_force_clusters(context: LinkingContext) -> list[list[int]]:
+    """Joins any compatible pair of disasters, comparing every pair, until no pair is compatible"""
+    disasters = DisasterLinker.build_initial_disaster_pool(context)
+    is_linked = True
+    while is_linked:
+        is_linked = False
+        for i, j in combinations(range(len(disasters)), 2):
+            if disasters[i].is_compatible_with(disasters[j]):
+                disasters[i] = disasters[i].merge_with(disasters[j])
+                del disasters[j]
+                is_linked = True
+                break
+    return canonical_clusters(disasters)
+
+
+def order_dependent_clusters(context: LinkingContext) -> list[list[int]]:
+    """The clusters of the original pairwise loop, which never compared the disasters it had already finished"""
+    disasters = DisasterLinker.build_initial_disaster_pool(context)
+    finished = []
+    while len(disasters) > 0:
+        current_disaster = disasters.pop()
+        compatible_disaster_index = current_disaster.find_compatible_disasters(disasters)
+        if compatible_disaster_index >= 0:
+            disasters.append(current_disaster.merge_with(disasters.pop(compatible_disaster_index)))
+        else:
+            finished.append(current_disaster)
+    return canonical_clusters(finished)
+
+
+def canonical_clusters(disasters: list[DisasterLinker]) -> list[list[int]]:
+    return sorted(sorted(disaster.indexes) for disaster in disasters)
+
+
+SHIPPED_EXPEDIENTS_PATH = "../input-output/merged_expedients_1.csv"
+
+CONFIGS = [{"days_leniency": 1},
+           {"days_leniency": 0, "province_hops": 2},
+           {"days_leniency": 3, "postal_prefix_digits": 3},
+           {"days_leniency": 1, "province_hops": 2, "postal_prefix_digits": 2}]
+
+
+def test_linking_matches_brute_force():
+    for seed, config in enumerate(CONFIGS):
+        context = LinkingContext(make_expedients(150, seed), {"debug_messages_on": False, **config})
+        expected = brute_force_clusters(context)
+        # Make sure the data is not trivially linked
+        assert 1 < len(expected) < len(context) - 10
+        assert canonical_clusters(DisasterLinker.link_expedients(context)) == expected
+        assert canonical_clusters(DisasterLinker.link_expedients(context, n_workers=2)) == expected
+        # Collapsing a pool of partially linked disasters gives the same clusters
+        first, second = next(cluster[:2] for cluster in expected if len(cluster) > 1)
+        disasters = DisasterLinker.build_initial_disaster_pool(context)
+        disasters = ([disasters[first].merge_with(disasters[second])]
+                     + [disaster for i, disaster in enumerate(disasters) if i not in (first, second)])
+        DisasterLinker.collapse_disaster_list(disasters)
+        assert canonical_clusters(disasters) == expected
+
+
+def test_linking_joins_clusters_left_apart_by_order():
+    # Madrid and Toledo are linked. Segovia is adjacent to Madrid but not to Toledo, and its time frame only
+    # reaches the one of Toledo, so it is only compatible with the cluster of both
+    expedients = pd.DataFrame({"date": pd.to_datetime(["2023-01-01", "2023-01-03", "2023-01-04"]),
+                               "disaster": LabelRegistry.KNOWN_DISASTERS[0],
+                               "province": ["Madrid", "Toledo", "Segovia"],
+                               "total_cost": 100.0,
+                               "claims": 1,
+                               "postal_codes": [np.array([28001], dtype=np.int32),
+                                                np.array([45001], dtype=np.int32),
+                                                np.array([40001], dtype=np.int32)],
+                               "duration": 1})
+    context = LinkingContext(expedients, {"days_leniency": 1, "debug_messages_on": False})
+    # The original loop finished Segovia before Madrid and Toledo were joined
+    assert order_dependent_clusters(context) == [[0, 1], [2]]
+    assert canonical_clusters(DisasterLinker.link_expedients(context)) == [[0, 1, 2]]
+
+
+def test_order_dependent_clusters_are_joined():
+    context = LinkingContext(read_frame(SHIPPED_EXPEDIENTS_PATH), {"days_leniency": 1, "debug_messages_on": False})
+    clusters = canonical_clusters(DisasterLinker.link_expedients(context))
+    old_clusters = order_dependent_clusters(context)
+    # The original loop left some compatible clusters apart in the shipped expedients
+    assert (len(old_clusters), len(clusters)) == (189, 186)
+    cluster_of_row = {row: i for i, cluster in enumerate(clusters) for row in cluster}
+    # Every cluster of the original loop is contained in a single cluster
+    for old_cluster in old_clusters:
+        assert len({cluster_of_row[row] for row in old_cluster}) == 1
+
+
+def test_sweep_matches_linking_each_leniency():
+    leniencies = [0, 1, 3, 7]
+    for seed, config in enumerate(CONFIGS[:3]):
+        expedients = make_expedients(400, seed + 10)
+        context = LinkingContext(expedients, {"debug_messages_on": False, **config})
+        assignments, merges = DisasterLinker.sweep_days_leniency(leniencies, context)
+        assert list(assignments.columns) == leniencies
+        for days_leniency in leniencies:
+            linked = DisasterLinker.link_expedients(
+                LinkingContext(expedients, {"debug_messages_on": False, **config, "days_leniency": days_leniency}))
+            swept = assignments[days_leniency].groupby(assignments[days_leniency]).groups.values()
+            assert sorted(sorted(rows) for rows in swept) == canonical_clusters(linked)
+        # Every merge is recorded once, at a leniency not greater than the swept ones
+        assert (merges["days_leniency"] <= max(leniencies)).all()
+        assert len(merges) == len(expedients) - assignments[max(leniencies)].nunique()
+
+
+if __name__ == '__main__':
+    test_linking_matches_brute_force()
+    test_linking_joins_clusters_left_apart_by_order()
+    test_order_dependent_clusters_are_joined()
+    test_sweep_matches_linking_each_leniency()
+    print("All the linking tests passed")
@@ -0,0 +1,99 @@
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from source.common.frame_storage import write_frame
+from source.common.quantile_sketch import KLLSketch
+from source.data_merger.disaster_merger_2 import QuartileCuller, CullingCriterion
+
+ERROR = 0.01
+# The rank error of a KLL sketch is probabilistic, so the checks allow some margin over it
+TOLERANCE = 2 * ERROR
+QUANTILES = np.linspace(0.05, 0.95, 19)
+
+
+def rank_errors(values: np.ndarray, sketch: KLLSketch) -> np.ndarray:
+    """Returns the difference between each quantile in QUANTILES and the actual rank of its approximation"""
+    sorted_values = np.sort(values)
+    approximations = sketch.quantile(QUANTILES)
+    return np.abs(np.searchsorted(sorted_values, approximations, side="right") / len(values) - QUANTILES)
+
+
+def test_quantiles_within_error():
+    values = np.random.default_rng(0).lognormal(3, 1.5, 200_000)
+    sketch = KLLSketch(KLLSketch.k_for_error(ERROR), seed=0)
+    for batch in np.array_split(values, 37):
+        sketch.update(batch)
+    assert len(sketch) == len(values)
+    assert rank_errors(values, sketch).max() <= TOLERANCE
+
+
+def test_merged_sketches_within_error():
+    values = np.random.default_rng(1).exponential(100, 200_000)
+    sketches = []
+    for seed, part in enumerate(np.array_split(values, 10)):
+        sketch = KLLSketch(KLLSketch.k_for_error(ERROR), seed=seed)
+        sketch.update(part)
+        sketches.append(sketch)
+    merged = sketches[0]
+    for sketch in sketches[1:]:
+        merged.merge(sketch)
+    assert len(merged) == len(values)
+    assert rank_errors(values, merged).max() <= TOLERANCE
+
+
+def test_missing_values_ignored():
+    sketch = KLLSketch(seed=0)
+    sketch.update([np.nan, 1.0, np.nan, 2.0, 3.0])
+    assert len(sketch) == 3
+    assert sketch.quantile(0.5) == 2.0
+    try:
+        KLLSketch().quantile(0.5)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("The quantiles of an empty sketch must raise ValueError")
+
+
+def test_streaming_cull_matches_qcut():
+    rng = np.random.default_rng(2)
+    n = 100_000
+    df = pd.DataFrame({"total_cost": rng.exponential(1000, n).round(2),
+                       "claims": rng.integers(1, 30, n),
+                       "losses_day": rng.exponential(100, n)})
+    criteria = [CullingCriterion("total_cost", 10, 2), CullingCriterion("total_cost / claims", 10, 3)]
+    exact = QuartileCuller.find_culled_rows(df, criteria)
+    # The exact culling agrees with the qcuts of `drop_lower_qcuts`
+    is_lower_qcut = QuartileCuller._find_lower_qcuts(df, lambda frame: frame["total_cost"], 10, 2).to_numpy()
+    assert (QuartileCuller.find_culled_rows(df, criteria[:1]) == is_lower_qcut).all()
+
+    with tempfile.TemporaryDirectory() as directory:
+        for extension in ["parquet", "csv"]:
+            QuartileCuller.INPUT_PATH = os.path.join(directory, f"input.{extension}")
+            QuartileCuller.OUTPUT_PATH = os.path.join(directory, f"output.{extension}")
+            write_frame(df, QuartileCuller.INPUT_PATH)
+            for n_workers in [1, 2]:
+                QuartileCuller.apply_cull_file_streaming(criteria, chunksize=7_000, error=ERROR, n_workers=n_workers)
+                output = pd.read_parquet(QuartileCuller.OUTPUT_PATH) if extension == "parquet" \
+                    else pd.read_csv(QuartileCuller.OUTPUT_PATH)
+                # Only the rows whose rank is close to a threshold may be culled differently
+                assert abs(len(output) - (~exact).sum()) <= TOLERANCE * n * len(criteria)
+
+
+def test_criteria_columns():
+    columns = ["date", "total_cost", "claims", "losses_day"]
+    assert CullingCriterion("total_cost", 10, 2).get_columns(columns) == ["total_cost"]
+    assert CullingCriterion("total_cost / claims", 10, 3).get_columns(columns) == ["total_cost", "claims"]
+    # Callable keys may read any column
+    assert CullingCriterion(lambda frame: frame["claims"], 10, 3).get_columns(columns) is None
+
+
+if __name__ == '__main__':
+    test_quantiles_within_error()
+    test_merged_sketches_within_error()
+    test_missing_values_ignored()
+    test_streaming_cull_matches_qcut()
+    test_criteria_columns()
+    print("All the quantile sketch tests passed")
@@ -0,0 +1,138 @@
+import asyncio
+import tempfile
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from lxml import etree
+
+from source.common.http_cache import HttpCache
+from source.common.single_flight import SingleFlightCache
+from source.scraping.event import Event
+
+FEED = (b"<?xml version='1.0' encoding='UTF-8'?><rss version='2.0'><channel><title>News</title>"
+        b"<item><title>Floods in Valencia</title><pubDate>Mon, 30 Oct 2023 08:00:00 GMT</pubDate>"
+        b"<source url='https://example.com'>Example</source></item></channel></rss>")
+
+
+def test_concurrent_calls_share_one_execution():
+    cache = SingleFlightCache()
+    n_of_executions = {"a": 0, "b": 0}
+
+    async def compute(key: str) -> str:
+        n_of_executions[key] += 1
+        await asyncio.sleep(0.01)
+        return key.upper()
+
+    async def run():
+        results = await asyncio.gather(*(cache.get(key, lambda key=key: compute(key)) for key in "abababab"))
+        # Later calls return the memoized result without executing again
+        results.append(await cache.get("a", lambda: compute("a")))
+        return results
+
+    assert asyncio.run(run()) == list("ABABABAB") + ["A"]
+    assert n_of_executions == {"a": 1, "b": 1}
+    assert cache.n_of_misses == 2 and cache.n_of_hits == 7
+    assert "a" in cache and len(cache) == 2
+    # Results are kept across event loops
+    assert asyncio.run(cache.get("b", lambda: compute("b"))) == "B"
+    assert n_of_executions["b"] == 1
+    cache.clear()
+    assert asyncio.run(cache.get("b", lambda: compute("b"))) == "B"
+    assert n_of_executions["b"] == 2
+
+
+def test_errors_are_shared_but_not_memoized():
+    cache = SingleFlightCache()
+    n_of_executions = [0]
+
+    async def fail():
+        n_of_executions[0] += 1
+        await asyncio.sleep(0.01)
+        raise ValueError("failed")
+
+    async def succeed():
+        n_of_executions[0] += 1
+        return 1
+
+    async def run():
+        results = await asyncio.gather(*(cache.get("key", fail) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        assert n_of_executions[0] == 1
+        assert "key" not in cache
+        # The next call executes again
+        assert await cache.get("key", succeed) == 1
+        assert n_of_executions[0] == 2
+
+    asyncio.run(run())
+
+
+def test_cancelled_caller_does_not_cancel_others():
+    cache = SingleFlightCache()
+
+    async def slow():
+        await asyncio.sleep(0.05)
+        return "done"
+
+    async def run():
+        first = asyncio.ensure_future(cache.get("key", slow))
+        second = asyncio.ensure_future(cache.get("key", slow))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        assert await second == "done"
+        assert first.cancelled()
+
+    asyncio.run(run())
+    assert "key" in cache
+
+
+def test_failed_feed_requests_are_not_memoized():
+    # Each request of the feed gets the next response: two errors, an html page, a truncated feed and the feed
+    responses = [web.Response(status=429, body=b"<html><body>Too Many Requests</body></html>"),
+                 web.Response(status=503, body=b""),
+                 web.Response(status=200, body=b"<html><body>Consent</body></html>"),
+                 web.Response(status=200, body=FEED[:150]),
+                 web.Response(status=200, body=FEED)]
+    expected_errors = [aiohttp.ClientResponseError, aiohttp.ClientResponseError, ValueError, etree.XMLSyntaxError]
+
+    async def handler(request: web.Request) -> web.Response:
+        return responses.pop(0)
+
+    app = web.Application()
+    app.router.add_get("/rss/search", handler)
+
+    async def run(url: str):
+        async with aiohttp.ClientSession() as session:
+            for error in expected_errors:
+                results = await asyncio.gather(*(Event._feed_cache.get(url, lambda: Event._fetch_feed(url, session))
+                                                 for _ in range(3)), return_exceptions=True)
+                # Concurrent searches share the failed request, and the next search requests the feed again
+                assert all(isinstance(result, error) for result in results)
+                assert url not in Event._feed_cache
+            feed = await Event._feed_cache.get(url, lambda: Event._fetch_feed(url, session))
+            assert [item.title for item in feed] == ["Floods in Valencia"]
+            assert url in Event._feed_cache
+
+    async def serve():
+        async with TestServer(app) as server:
+            await run(str(server.make_url("/rss/search?q=valencia")))
+
+    with tempfile.TemporaryDirectory() as directory:
+        default_cache = HttpCache._default_cache
+        HttpCache._default_cache = HttpCache(directory)
+        try:
+            asyncio.run(serve())
+            # Only the feed was stored in the http cache
+            assert len(HttpCache._default_cache) == 1
+        finally:
+            HttpCache._default_cache = default_cache
+            Event.clear_feed_cache()
+    assert len(responses) == 0
+
+
+if __name__ == '__main__':
+    test_concurrent_calls_share_one_execution()
+    test_errors_are_shared_but_not_memoized()
+    test_cancelled_caller_does_not_cancel_others()
+    test_failed_feed_requests_are_not_memoized()
+    print("All the single flight cache tests passed")